@@ -20,9 +20,32 @@ class JournalEntryAdmin(admin.ModelAdmin):
 
 admin.site.register(PurchaseOrder)
 admin.site.register(PurchaseOrderLine)
-admin.site.register(VendorBill)
+
+@admin.register(VendorBill)
+class VendorBillAdmin(admin.ModelAdmin):
+    # stored totals are maintained from the lines and payments; never edit them by hand
+    readonly_fields = ('total_amount', 'paid_amount', 'outstanding_amount')
+
 admin.site.register(VendorBillLine)
 admin.site.register(Payment)
-admin.site.register(CustomerInvoice)
+
+@admin.register(CustomerInvoice)
+class CustomerInvoiceAdmin(admin.ModelAdmin):
+    # stored totals are maintained from the lines and payments; never edit them by hand
+    readonly_fields = ('untaxed_total', 'tax_total', 'grand_total', 'amount_paid', 'amount_due')
+
 admin.site.register(CustomerInvoiceLine)
     
+
+
+class RecurringInvoiceLineInline(admin.TabularInline):
+    model = RecurringInvoiceLine
+    extra = 1
+
+@admin.register(RecurringInvoice)
+class RecurringInvoiceAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'customer', 'cadence', 'next_run_date', 'auto_confirm', 'active')
+    list_filter = ('cadence', 'active', 'auto_confirm')
+    inlines = [RecurringInvoiceLineInline]
+
+admin.site.register(RecurringInvoiceRun)
@@ -0,0 +1,281 @@
+"""
+Client for the external HSN / tax APIs: the GST portal's HSN search
+(settings.GST_HSN_SEARCH_URL) and the optional rate service at
+settings.TAX_API_BASE.
+
+One client per process shares a pooled requests.Session, so calls reuse
+keep-alive connections instead of a new TLS handshake each. The portal search
+variants (by code, by goods description, by services description) are sent in
+parallel and the first one with results wins. Answers are cached in the
+GST_API_CACHE_ALIAS cache (file based by default, so shared by workers and kept
+across restarts) for GST_API_CACHE_TTL, and "no such code" answers (every variant answered,
+none had results) for the shorter GST_API_NEGATIVE_TTL. Failures (timeouts, connection errors, 5xx) are
+never cached; they feed a per-endpoint circuit breaker that, once open, fails
+calls immediately for GST_API_COOLDOWN seconds so a slow portal can't hold up
+every worker.
+"""
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from django.core.cache import caches
+
+from .hsn import normalize_hsn
+
+logger = logging.getLogger(__name__)
+
+GST_HSN_SEARCH_URL = "https://services.gst.gov.in/commonservices/hsn/search/qsearch"
+BROWSER_HEADERS = {
+    # a browser UA, Referer and Origin keep the portal's simple bot blocks quiet
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/140 Safari/537.36',
+    'Accept': 'application/json, text/plain, */*',
+    'Referer': 'https://services.gst.gov.in/',
+    'Origin': 'https://services.gst.gov.in',
+}
+NO_ANSWER = '__none__'  # cached for lookups the API answered with nothing
+RATE_KEYS = ('rate', 'gst_rate', 'value', 'sale_rate', 'purchase_rate')
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure breaker: after `threshold` failures in a row calls are
+    refused for `cooldown` seconds, then a single trial call is let through;
+    its success closes the breaker, its failure opens it again.
+    """
+
+    def __init__(self, threshold=5, cooldown=30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self._opened_at >= self.cooldown else 'open'
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.cooldown and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.threshold:
+                self._opened_at = time.monotonic()
+            self._trial = False
+
+
+def _parse_rate(data):
+    """ GST rate from a rate API body: {"rate": ..}, {"data": [{"rate": ..}]} or [{"rate": ..}]. """
+    if isinstance(data, dict):
+        for key in RATE_KEYS:
+            if data.get(key) not in (None, ''):
+                try:
+                    return float(data[key])
+                except (TypeError, ValueError):
+                    continue
+        data = data.get('data')
+    if isinstance(data, list) and data and isinstance(data[0], dict):
+        for key in ('rate', 'gst_rate', 'value'):
+            if data[0].get(key) not in (None, ''):
+                try:
+                    return float(data[0][key])
+                except (TypeError, ValueError):
+                    continue
+    return None
+
+
+class GstApiClient:
+    def __init__(self, search_url=GST_HSN_SEARCH_URL, tax_api_base=None, timeout=(3.05, 8), pool_size=10,
+                 max_workers=6, cache_alias='default', ttl=24 * 3600, negative_ttl=600,
+                 failure_threshold=5, cooldown=30, verify_ssl=True):
+        self.search_url = search_url
+        self.tax_api_base = tax_api_base
+        self.timeout = timeout
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.verify_ssl = verify_ssl
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='gst-api')
+        self._failure_threshold = failure_threshold
+        self._cooldown = cooldown
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def breaker(self, url):
+        """ The circuit breaker for url's host. """
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(self._failure_threshold, self._cooldown)
+            return self._breakers[host]
+
+    def status(self):
+        """ {host: breaker state}, for debug output. """
+        with self._lock:
+            return {host: b.state for host, b in self._breakers.items()}
+
+    def _get_json(self, url, params, headers=None):
+        """
+        GET url and return (answered, body): answered is False when the call
+        failed (breaker open, network error, timeout, 5xx, unparsable body) and
+        the result must not be cached; body is the parsed JSON or None.
+        """
+        breaker = self.breaker(url)
+        if not breaker.allow():
+            return False, None
+        try:
+            resp = self.session.get(url, params=params, headers=headers or {'Accept': 'application/json'},
+                                    timeout=self.timeout, verify=self.verify_ssl)
+        except requests.RequestException as e:
+            breaker.failure()
+            logger.warning("GET %s failed: %s", url, e)
+            return False, None
+        if resp.status_code >= 500 or resp.status_code == 429:
+            breaker.failure()
+            logger.warning("GET %s -> %s", resp.url, resp.status_code)
+            return False, None
+        breaker.success()
+        logger.debug("GET %s -> %s", resp.url, resp.status_code)
+        if resp.status_code != 200:
+            return True, None
+        try:
+            return True, resp.json()
+        except ValueError:
+            logger.warning("GET %s returned a non-JSON body", resp.url)
+            return False, None
+
+    def _first_answer(self, calls):
+        """
+        Run the (answered, value) calls in parallel and return (value, True)
+        for the first one with a non-empty value; else (None, whether every
+        call got an answer). A lookup is only "not found" when no attempt
+        failed: a failed variant might have had the results.
+        """
+        futures = [self._executor.submit(call) for call in calls]
+        answered = bool(futures)
+        try:
+            for future in as_completed(futures, timeout=sum(self.timeout) + 1):
+                ok, value = future.result()
+                if value:
+                    return value, True
+                answered = answered and ok
+        except TimeoutError:
+            logger.warning("HSN API lookups timed out")
+            answered = False
+        finally:
+            for future in futures:
+                future.cancel()
+        return None, answered
+
+    def _cached(self, key, fetch):
+        """ Cached value for key, else fetch() -> (value, answered) with the value or NO_ANSWER cached. """
+        cached = self.cache.get(key)
+        if cached is not None:
+            return None if cached == NO_ANSWER else cached
+        value, answered = fetch()
+        if value:
+            self.cache.set(key, value, self.ttl)
+        elif answered:
+            self.cache.set(key, NO_ANSWER, self.negative_ttl)
+        return value
+
+    def _search_attempt(self, query, selected_type, category):
+        params = {'inputText': query, 'selectedType': selected_type, 'category': category}
+        answered, body = self._get_json(self.search_url, params, headers=BROWSER_HEADERS)
+        results = []
+        data = body.get('data') if isinstance(body, dict) else None
+        if isinstance(data, list):
+            for item in data:
+                if not isinstance(item, dict):
+                    continue
+                hsn = item.get('c') or item.get('hsn')
+                if hsn:
+                    results.append({'hsn': hsn, 'description': item.get('n') or item.get('description')})
+        return answered, results
+
+    def search_hsn(self, query):
+        """ [{'hsn', 'description'}] from the GST portal's HSN search, [] if it has nothing or is down. """
+        query = (query or '').strip()
+        if not query:
+            return []
+        if query.isdigit():
+            attempts = [('byCode', 'null'), ('byDesc', 'P'), ('byDesc', 'S')]
+        else:
+            attempts = [('byDesc', 'P'), ('byDesc', 'S'), ('byCode', 'null')]
+        key = 'gst_hsn_search:' + hashlib.sha1(query.lower().encode('utf-8')).hexdigest()
+        calls = [lambda t=t, c=c: self._search_attempt(query, t, c) for t, c in attempts]
+        return self._cached(key, lambda: self._first_answer(calls)) or []
+
+    def _rate_attempt(self, hsn):
+        answered, body = self._get_json(self.tax_api_base, {'hsn': hsn})
+        return answered, _parse_rate(body)
+
+    def tax_rate(self, hsn):
+        """ GST rate for hsn from TAX_API_BASE as a float, or None (not configured, unknown code, or down). """
+        hsn = normalize_hsn(hsn)
+        if not self.tax_api_base or not hsn:
+            return None
+
+        def fetch():
+            answered, rate = self._rate_attempt(hsn)
+            # a 0% rate is an answer, wrap it so the cache doesn't take it for a miss
+            return ({'rate': rate} if rate is not None else None), answered
+
+        cached = self._cached(f'gst_tax_rate:{hsn}', fetch)
+        return None if cached is None else cached['rate']
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def gst_client():
+    """ The process-wide client, configured from settings.GST_API_* / GST_HSN_SEARCH_URL / TAX_API_BASE. """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = GstApiClient(
+                    search_url=getattr(settings, 'GST_HSN_SEARCH_URL', None) or GST_HSN_SEARCH_URL,
+                    tax_api_base=getattr(settings, 'TAX_API_BASE', None),
+                    timeout=(getattr(settings, 'GST_API_CONNECT_TIMEOUT', 3.05),
+                             getattr(settings, 'GST_API_READ_TIMEOUT', 8)),
+                    pool_size=getattr(settings, 'GST_API_POOL_SIZE', 10),
+                    max_workers=getattr(settings, 'GST_API_MAX_WORKERS', 6),
+                    cache_alias=getattr(settings, 'GST_API_CACHE_ALIAS', 'default'),
+                    ttl=getattr(settings, 'GST_API_CACHE_TTL', 24 * 3600),
+                    negative_ttl=getattr(settings, 'GST_API_NEGATIVE_TTL', 600),
+                    failure_threshold=getattr(settings, 'GST_API_FAILURE_THRESHOLD', 5),
+                    cooldown=getattr(settings, 'GST_API_COOLDOWN', 30),
+                )
+    return _client
@@ -0,0 +1,111 @@
+"""
+Local stand-in for the GST portal's HSN search and the TAX_API_BASE rate
+service, answering from the offline HSN indexes. Point GST_HSN_SEARCH_URL and
+TAX_API_BASE at it (see `manage.py run_gst_stub`) to exercise the API client
+without network access; `delay` and `fail_every` simulate a slow or flaky
+portal for the circuit breaker.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from .hsn import hsn_tax_index
+from .hsn_search import hsn_search_index
+
+SEARCH_PATH = '/commonservices/hsn/search/qsearch'
+TAX_PATH = '/tax'
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep-alive, like the real portal, so the client's connection pool is exercised
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        super().setup()
+        self.server.stub.connections.append(self.client_address)
+
+    def _send(self, status, body):
+        raw = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def do_GET(self):
+        stub = self.server.stub
+        url = urlsplit(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        with stub.lock:
+            stub.requests.append((url.path, params))
+            count = len(stub.requests)
+        if stub.delay:
+            time.sleep(stub.delay)
+        if stub.fail_every and count % stub.fail_every == 0:
+            return self._send(503, {'error': 'stub failure'})
+
+        if url.path == SEARCH_PATH:
+            query = params.get('inputText', '')
+            by_code = params.get('selectedType') == 'byCode'
+            # the portal answers a code search only for digits and a description search only for words
+            if by_code != query.isdigit():
+                return self._send(200, {'data': []})
+            results = hsn_search_index().search(query)
+            return self._send(200, {'data': [{'c': r['hsn'], 'n': r['description']} for r in results]})
+        if url.path == TAX_PATH:
+            rate = hsn_tax_index().rate(params.get('hsn', ''))
+            if rate is None:
+                return self._send(404, {'error': 'unknown hsn'})
+            return self._send(200, {'hsn': params.get('hsn'), 'rate': rate})
+        return self._send(404, {'error': 'not found'})
+
+
+class GstStubServer:
+    """ The stub on host:port (port 0 picks a free one) served from a background thread. """
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0, fail_every=0):
+        self.delay = delay
+        self.fail_every = fail_every
+        self.lock = threading.Lock()
+        self.requests = []
+        self.connections = []
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def search_url(self):
+        return self.base_url + SEARCH_PATH
+
+    @property
+    def tax_url(self):
+        return self.base_url + TAX_PATH
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,348 @@
+"""
+HSN code index over data/hsn_tax_map.json (code -> GST rate) and
+data/hsn_codes.json (code -> description).
+
+HSN codes are hierarchical (chapter 2 digits, heading 4, sub-heading 6,
+tariff item 8), so the index is kept as a table sorted by code: every code's
+descendants sit in one contiguous run right after it, which makes the table a
+flattened prefix trie. A full code resolves to the rate of its most specific
+ancestor in the map, and a prefix's children are a bisect away.
+
+`manage.py compile_hsn_index` writes the table to settings.HSN_INDEX_PATH as
+fixed-width records that every worker process memory-maps read-only, so the
+pages are shared and startup does no parsing. Until the compiled file exists
+(or while it is older than the JSON sources) the same table is built in memory
+from the JSON files. Either way the sources are re-read only when a file
+changes.
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+from pathlib import Path
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'HSNIDX1\0'
+# magic, record count, (mtime_ns, size) of the tax map and of the codes file
+HEADER = struct.Struct('<8sI4q')
+# code (NUL padded), code length, rate in hundredths of a percent (-1: none),
+# description offset and length in the string table that follows the records
+RECORD = struct.Struct('<8sBhIH')
+CODE_WIDTH = 8
+NO_RATE = -1
+
+
+def normalize_hsn(code):
+    """ Canonical form of an HSN/SAC code: digits only ("9401 10.00" -> "94011000"). """
+    return ''.join(ch for ch in str(code or '') if ch.isdigit())
+
+
+def _entry_rate(entry):
+    """ GST rate of a map entry: {"gst_rate": ..} / {"rate": ..} / {"value": ..} or a bare number. """
+    if isinstance(entry, dict):
+        for key in ('gst_rate', 'rate', 'value'):
+            if entry.get(key) not in (None, ''):
+                try:
+                    return float(entry[key])
+                except (TypeError, ValueError):
+                    continue
+        return None
+    try:
+        return float(entry)
+    except (TypeError, ValueError):
+        return None
+
+
+def file_signature(path):
+    """
+    (mtime_ns, size) of path, or (0, -1) if it doesn't exist. The file-backed
+    indexes compare it on each lookup to notice a changed source.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return (0, -1)
+    # size too, for rewrites within the mtime resolution
+    return (st.st_mtime_ns, st.st_size)
+
+
+def load_hsn_entries(tax_map_path, codes_path):
+    """
+    Read both JSON sources into a list of (code, rate, description) sorted by
+    code. A code from either file is included; rate and description are None
+    where that file has nothing for it. Codes longer than 8 digits are skipped.
+    """
+    entries = {}
+
+    def entry(code):
+        key = normalize_hsn(code)
+        if not key or len(key) > CODE_WIDTH:
+            return None
+        return entries.setdefault(key, [None, None])
+
+    if os.path.exists(tax_map_path):
+        with open(tax_map_path, 'r', encoding='utf-8') as f:
+            mapping = json.load(f)
+        for code, value in mapping.items():
+            e = entry(code)
+            if e is not None:
+                e[0] = _entry_rate(value)
+
+    if os.path.exists(codes_path):
+        with open(codes_path, 'r', encoding='utf-8') as f:
+            codes = json.load(f)
+        for item in codes:
+            if not isinstance(item, dict):
+                continue
+            e = entry(item.get('hsn'))
+            if e is not None and item.get('description'):
+                e[1] = str(item['description'])
+
+    return [(code, rate, desc) for code, (rate, desc) in sorted(entries.items())]
+
+
+class _MemoryTable:
+    """ The sorted table as plain lists, for when there is no (current) compiled file. """
+
+    def __init__(self, entries):
+        self._codes = [e[0] for e in entries]
+        self._rates = [e[1] for e in entries]
+        self._descriptions = [e[2] for e in entries]
+
+    def __len__(self):
+        return len(self._codes)
+
+    def code(self, i):
+        return self._codes[i]
+
+    def rate(self, i):
+        return self._rates[i]
+
+    def description(self, i):
+        return self._descriptions[i]
+
+    def close(self):
+        pass
+
+
+class _MappedTable:
+    """ The sorted table read straight out of a memory-mapped compiled file. """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, self._count, *signature = HEADER.unpack_from(self._map, 0)
+            if magic != MAGIC:
+                raise ValueError("not a compiled HSN index")
+            self.signature = ((signature[0], signature[1]), (signature[2], signature[3]))
+            self._strings = HEADER.size + self._count * RECORD.size
+            if self._strings > len(self._map):
+                raise ValueError("truncated HSN index")
+        except struct.error:
+            self._map.close()
+            raise ValueError("truncated HSN index")
+        except ValueError:
+            self._map.close()
+            raise
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, i):
+        return RECORD.unpack_from(self._map, HEADER.size + i * RECORD.size)
+
+    def code(self, i):
+        code, length, _, _, _ = self._record(i)
+        return code[:length].decode('ascii')
+
+    def rate(self, i):
+        rate = self._record(i)[2]
+        return None if rate == NO_RATE else rate / 100
+
+    def description(self, i):
+        _, _, _, offset, length = self._record(i)
+        if not length:
+            return None
+        start = self._strings + offset
+        return self._map[start:start + length].decode('utf-8')
+
+    def close(self):
+        self._map.close()
+
+
+def write_compiled_index(path, tax_map_path, codes_path):
+    """
+    Compile both JSON sources into the mmap-able file at path and return the
+    number of codes written. The file is replaced atomically, so processes that
+    still have the old one mapped keep reading it until they notice the change.
+    """
+    signature = (file_signature(tax_map_path), file_signature(codes_path))
+    entries = load_hsn_entries(tax_map_path, codes_path)
+
+    records = []
+    strings = bytearray()
+    for code, rate, desc in entries:
+        raw = (desc or '').encode('utf-8')[:0xFFFF]
+        records.append(RECORD.pack(
+            code.encode('ascii'), len(code),
+            NO_RATE if rate is None else int(round(rate * 100)),
+            len(strings), len(raw),
+        ))
+        strings += raw
+
+    path = Path(path)
+    tmp = path.with_name(path.name + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, len(records), *signature[0], *signature[1]))
+        f.writelines(records)
+        f.write(strings)
+    os.replace(tmp, path)
+    return len(records)
+
+
+class HsnTaxIndex:
+    def __init__(self, path, codes_path=None, compiled_path=None):
+        self.path = Path(path)
+        self.codes_path = Path(codes_path) if codes_path else self.path.with_name('hsn_codes.json')
+        self.compiled_path = Path(compiled_path) if compiled_path else self.path.with_name('hsn_index.bin')
+        self._lock = threading.Lock()
+        self._signature = None
+        self._table = _MemoryTable([])
+
+    def _current(self):
+        """ The table, reloaded first if a source or the compiled file changed (or appeared/vanished). """
+        signature = (file_signature(self.path), file_signature(self.codes_path),
+                     file_signature(self.compiled_path))
+        if signature != self._signature:
+            with self._lock:
+                if signature != self._signature:
+                    try:
+                        # the old table isn't closed here: another thread may still be reading it,
+                        # and its mapping goes away with the last reference
+                        self._table = self._load(signature[:2])
+                    except (OSError, ValueError, AttributeError, TypeError) as e:
+                        # keep serving the last good table until a file changes again
+                        logger.warning("Could not load HSN index from %s: %s", self.path, e)
+                    self._signature = signature
+        return self._table
+
+    def _load(self, sources):
+        if os.path.exists(self.compiled_path):
+            try:
+                table = _MappedTable(self.compiled_path)
+            except (OSError, ValueError) as e:
+                logger.warning("Ignoring compiled HSN index %s: %s", self.compiled_path, e)
+            else:
+                if table.signature == sources:
+                    return table
+                table.close()
+                logger.info("Compiled HSN index %s is stale, reading the JSON sources", self.compiled_path)
+        return _MemoryTable(load_hsn_entries(self.path, self.codes_path))
+
+    @staticmethod
+    def _lower_bound(table, key):
+        """ Index of the first code >= key. """
+        lo, hi = 0, len(table)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if table.code(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _find(self, table, key):
+        i = self._lower_bound(table, key)
+        if i < len(table) and table.code(i) == key:
+            return i
+        return None
+
+    def _row(self, table, i):
+        return {'hsn': table.code(i), 'description': table.description(i), 'rate': table.rate(i)}
+
+    def get(self, code):
+        """ {'hsn', 'description', 'rate'} for code (tried as given, then zero-padded to 4 digits), or None. """
+        table = self._current()
+        key = normalize_hsn(code)
+        if not key:
+            return None
+        i = self._find(table, key)
+        if i is None and len(key) < 4:
+            i = self._find(table, key.zfill(4))
+        return None if i is None else self._row(table, i)
+
+    def resolve(self, code):
+        """
+        The most specific entry with a rate for code: the code itself, else its
+        longest ancestor prefix in the map ("94011000" -> "940110" -> "9401").
+        Returns {'hsn', 'description', 'rate'} of that entry, or None.
+        """
+        table = self._current()
+        key = normalize_hsn(code)
+        if not key:
+            return None
+        candidates = [key[:n] for n in range(min(len(key), CODE_WIDTH), 1, -1)]
+        if len(key) < 4:
+            candidates.insert(0, key.zfill(4))
+        for candidate in candidates:
+            i = self._find(table, candidate)
+            if i is not None and table.rate(i) is not None:
+                return self._row(table, i)
+        return None
+
+    def rate(self, code):
+        """ GST rate for code as a float (longest matching prefix), or None if nothing matches. """
+        entry = self.resolve(code)
+        return None if entry is None else entry['rate']
+
+    def children(self, prefix, limit=20):
+        """
+        Codes under prefix (the prefix itself included), in code order, as
+        {'hsn', 'description', 'rate'} dicts with rate resolved through the
+        ancestors. At most limit rows.
+        """
+        table = self._current()
+        key = normalize_hsn(prefix)
+        if not key:
+            return []
+        rows = []
+        i = self._lower_bound(table, key)
+        while i < len(table) and len(rows) < limit:
+            code = table.code(i)
+            if not code.startswith(key):
+                break
+            row = self._row(table, i)
+            if row['rate'] is None:
+                row['rate'] = self.rate(code)
+            rows.append(row)
+            i += 1
+        return rows
+
+    def __len__(self):
+        return len(self._current())
+
+
+_index = None
+
+
+def hsn_tax_index():
+    """
+    The process-wide index over settings.HSN_TAX_MAP_PATH (default
+    data/hsn_tax_map.json), HSN_CODES_PATH (data/hsn_codes.json) and the
+    compiled HSN_INDEX_PATH (data/hsn_index.bin).
+    """
+    global _index
+    data = Path(settings.BASE_DIR) / 'data'
+    path = Path(getattr(settings, 'HSN_TAX_MAP_PATH', None) or data / 'hsn_tax_map.json')
+    codes_path = Path(getattr(settings, 'HSN_CODES_PATH', None) or data / 'hsn_codes.json')
+    compiled_path = Path(getattr(settings, 'HSN_INDEX_PATH', None) or data / 'hsn_index.bin')
+    if (_index is None or _index.path != path or _index.codes_path != codes_path
+            or _index.compiled_path != compiled_path):
+        _index = HsnTaxIndex(path, codes_path, compiled_path)
+    return _index
@@ -0,0 +1,197 @@
+"""
+Offline HSN description search.
+
+Codes and descriptions are kept in a small SQLite database with an FTS5 index
+over the descriptions (porter-stemmed, prefix-indexed, so "offic chai" finds
+"office chairs" while the user is still typing), ranked by bm25. Digit-only
+queries are answered by a code prefix range instead.
+
+`manage.py import_hsn_codes` builds the database at settings.HSN_SEARCH_DB_PATH
+(default data/hsn_search.sqlite3) from data/hsn_codes.json plus any full HSN
+dataset given to it. Without that file the index is built in memory from
+data/hsn_codes.json, so search works (and can be tested) with no network and
+no import step. Either source is re-read only when its file changes.
+"""
+import csv
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+
+from django.conf import settings
+
+from .hsn import file_signature, hsn_tax_index, normalize_hsn
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE hsn_code (id INTEGER PRIMARY KEY, code TEXT NOT NULL UNIQUE, description TEXT NOT NULL);
+CREATE VIRTUAL TABLE hsn_fts USING fts5(
+    description, content='hsn_code', content_rowid='id',
+    tokenize='porter unicode61 remove_diacritics 2', prefix='2 3'
+);
+"""
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _code_and_description(item):
+    """ (code, description) from one dataset row, accepting our own and the GST portal's key names. """
+    if not isinstance(item, dict):
+        return None, None
+    code = item.get('hsn') or item.get('code') or item.get('c') or item.get('hsn_code')
+    desc = item.get('description') or item.get('n') or item.get('desc')
+    return normalize_hsn(code), (str(desc).strip() if desc else '')
+
+
+def read_hsn_dataset(path):
+    """
+    Read (code, description) pairs from a JSON or CSV file. JSON may be a list
+    of objects ({"hsn", "description"} or the portal's {"c", "n"}), an object
+    with such a list under "data", or a {code: description} mapping; CSV needs
+    a header with an hsn/code and a description column.
+    """
+    path = Path(path)
+    rows = []
+    if path.suffix.lower() == '.csv':
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            for item in csv.DictReader(f):
+                item = {(k or '').strip().lower().replace(' ', '_'): v for k, v in item.items()}
+                rows.append(_code_and_description(item))
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if isinstance(data, dict) and isinstance(data.get('data'), list):
+            data = data['data']
+        if isinstance(data, dict):
+            for code, value in data.items():
+                desc = value.get('description') if isinstance(value, dict) else value
+                rows.append((normalize_hsn(code), str(desc or '').strip()))
+        else:
+            rows.extend(_code_and_description(item) for item in data)
+    return [(code, desc) for code, desc in rows if code and desc]
+
+
+def build_search_db(conn, datasets):
+    """
+    Create the schema on an empty connection and load the (code, description)
+    pairs of every dataset into it; a later dataset wins for a repeated code.
+    Returns the number of codes.
+    """
+    codes = {}
+    for rows in datasets:
+        codes.update(rows)
+    conn.executescript(SCHEMA)
+    with conn:
+        conn.executemany("INSERT INTO hsn_code (code, description) VALUES (?, ?)", sorted(codes.items()))
+        conn.execute("INSERT INTO hsn_fts (hsn_fts) VALUES ('rebuild')")
+    return len(codes)
+
+
+def write_search_db(path, datasets):
+    """ Build the search database into a temp file and move it over path; returns the number of codes. """
+    path = Path(path)
+    tmp = path.with_name(path.name + '.tmp')
+    if tmp.exists():
+        tmp.unlink()
+    conn = sqlite3.connect(tmp)
+    try:
+        count = build_search_db(conn, datasets)
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    os.replace(tmp, path)
+    return count
+
+
+class HsnSearchIndex:
+    def __init__(self, db_path, codes_path):
+        self.db_path = Path(db_path)
+        self.codes_path = Path(codes_path)
+        # one connection per index; queries are sub-millisecond, so a lock is cheaper than a pool
+        self._lock = threading.Lock()
+        self._signature = None
+        self._conn = None
+
+    def _load(self):
+        if self.db_path.exists():
+            return sqlite3.connect(f'file:{self.db_path}?mode=ro', uri=True, check_same_thread=False)
+        conn = sqlite3.connect(':memory:', check_same_thread=False)
+        datasets = [read_hsn_dataset(self.codes_path)] if self.codes_path.exists() else []
+        build_search_db(conn, datasets)
+        return conn
+
+    def _connection(self):
+        """ The open database; call with the lock held. Reopened/rebuilt when the source file changes. """
+        signature = (file_signature(self.db_path), file_signature(self.codes_path))
+        if signature != self._signature:
+            try:
+                conn = self._load()
+            except (OSError, ValueError, sqlite3.Error) as e:
+                # keep serving the last good index until a file changes again
+                logger.warning("Could not load HSN search index from %s: %s", self.db_path, e)
+            else:
+                if self._conn is not None:
+                    self._conn.close()
+                self._conn = conn
+            self._signature = signature
+        return self._conn
+
+    @staticmethod
+    def _match_expression(query):
+        """ FTS5 query: every word of the input as a quoted prefix term, all required. """
+        words = WORD_RE.findall(query.lower())
+        return ' '.join(f'"{w}"*' for w in words)
+
+    def search(self, query, limit=20):
+        """
+        Up to limit {'hsn', 'description', 'rate'} dicts for query: codes under
+        the prefix for a digit query, best description matches otherwise.
+        """
+        query = (query or '').strip()
+        compact = query.replace(' ', '').replace('.', '')
+        with self._lock:
+            conn = self._connection()
+            if conn is None or not query:
+                return []
+            if compact.isdigit():
+                rows = conn.execute(
+                    "SELECT code, description FROM hsn_code WHERE code >= ? AND code < ? ORDER BY code LIMIT ?",
+                    (compact, compact + ':', limit),  # ':' sorts right after '9'
+                ).fetchall()
+            else:
+                match = self._match_expression(query)
+                if not match:
+                    return []
+                rows = conn.execute(
+                    "SELECT c.code, c.description FROM hsn_fts JOIN hsn_code c ON c.id = hsn_fts.rowid "
+                    "WHERE hsn_fts MATCH ? ORDER BY hsn_fts.rank, length(c.code) LIMIT ?",
+                    (match, limit),
+                ).fetchall()
+        rates = hsn_tax_index()
+        return [{'hsn': code, 'description': desc, 'rate': rates.rate(code)} for code, desc in rows]
+
+    def __len__(self):
+        with self._lock:
+            conn = self._connection()
+            return conn.execute("SELECT count(*) FROM hsn_code").fetchone()[0] if conn is not None else 0
+
+
+_index = None
+
+
+def hsn_search_index():
+    """
+    The process-wide search index over settings.HSN_SEARCH_DB_PATH (default
+    data/hsn_search.sqlite3), or over HSN_CODES_PATH (data/hsn_codes.json)
+    while that database hasn't been imported.
+    """
+    global _index
+    data = Path(settings.BASE_DIR) / 'data'
+    db_path = Path(getattr(settings, 'HSN_SEARCH_DB_PATH', None) or data / 'hsn_search.sqlite3')
+    codes_path = Path(getattr(settings, 'HSN_CODES_PATH', None) or data / 'hsn_codes.json')
+    if _index is None or _index.db_path != db_path or _index.codes_path != codes_path:
+        _index = HsnSearchIndex(db_path, codes_path)
+    return _index
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.hsn import hsn_tax_index, write_compiled_index
+
+
+class Command(BaseCommand):
+    help = "Compile the HSN tax map and HSN codes into the memory-mapped index (HSN_INDEX_PATH)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', help="Write here instead of HSN_INDEX_PATH.")
+
+    def handle(self, *args, **options):
+        index = hsn_tax_index()
+        output = options['output'] or index.compiled_path
+        try:
+            count = write_compiled_index(output, index.path, index.codes_path)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not compile the HSN index: {e}")
+        self.stdout.write(self.style.SUCCESS(f"Wrote {count} HSN code(s) to {output}."))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.utils import confirm_documents, select_draft_documents, parse_date_option
+
+
+class Command(BaseCommand):
+    help = ("Confirm draft customer invoices and/or vendor bills in chunked transactions, "
+            "reporting documents that could not be posted")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=['all', 'invoices', 'bills'], default='all')
+        parser.add_argument('--start', type=parse_date_option, help="Only documents dated on/after YYYY-MM-DD.")
+        parser.add_argument('--end', type=parse_date_option, help="Only documents dated on/before YYYY-MM-DD.")
+        parser.add_argument('--partner', type=int, help="Only documents for this contact id.")
+        parser.add_argument('--chunk-size', type=int, default=200, help="Documents per transaction (default 200).")
+        parser.add_argument('--created-by', default='confirm_documents', help="Stored on the journal entries.")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the matching drafts.")
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError("--chunk-size must be at least 1.")
+        invoices, bills = select_draft_documents(
+            options['kind'], start=options['start'], end=options['end'], partner=options['partner'])
+
+        if options['dry_run']:
+            for label, qs in (('invoice', invoices), ('bill', bills)):
+                if qs is not None:
+                    self.stdout.write(f"{qs.count()} draft {label}(s) would be confirmed.")
+            return
+
+        result = confirm_documents(invoices=invoices, bills=bills, chunk_size=options['chunk_size'],
+                                   created_by=options['created_by'])
+        for f in result['failed']:
+            self.stdout.write(self.style.WARNING(f"{f['type']} {f['id']}: {f['error']}"))
+        self.stdout.write(self.style.SUCCESS(
+            f"Confirmed {len(result['confirmed'])} document(s); {len(result['failed'])} failed."))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+from core.hsn_search import hsn_search_index, read_hsn_dataset, write_search_db
+
+
+class Command(BaseCommand):
+    help = "Build the offline HSN search database (HSN_SEARCH_DB_PATH) from hsn_codes.json and HSN datasets"
+
+    def add_arguments(self, parser):
+        parser.add_argument('datasets', nargs='*', help="JSON or CSV files of HSN codes and descriptions.")
+        parser.add_argument('--output', help="Write here instead of HSN_SEARCH_DB_PATH.")
+
+    def handle(self, *args, **options):
+        index = hsn_search_index()
+        paths = ([index.codes_path] if index.codes_path.exists() else []) + options['datasets']
+        try:
+            datasets = [read_hsn_dataset(path) for path in paths]
+            count = write_search_db(options['output'] or index.db_path, datasets)
+        except (OSError, ValueError) as e:
+            raise CommandError(f"Could not import HSN codes: {e}")
+        self.stdout.write(self.style.SUCCESS(f"Imported {count} HSN code(s) into {options['output'] or index.db_path}."))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from core.models import SalesOrder
+from core.utils import invoice_sales_orders, parse_date_option
+
+
+class Command(BaseCommand):
+    help = "Create customer invoices for confirmed, not yet invoiced sales orders in bulk"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--merge', action='store_true', help="One invoice per customer instead of per order.")
+        parser.add_argument('--start', type=parse_date_option, help="Only orders dated on/after YYYY-MM-DD.")
+        parser.add_argument('--end', type=parse_date_option, help="Only orders dated on/before YYYY-MM-DD.")
+        parser.add_argument('--customer', type=int, help="Only orders for this contact id.")
+        parser.add_argument('--issue-date', type=parse_date_option, help="Invoice date (default today).")
+        parser.add_argument('--created-by', default='invoice_sales_orders', help="Stored on the invoices.")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the matching orders.")
+
+    def handle(self, *args, **options):
+        orders = SalesOrder.objects.filter(status='confirmed', invoice__isnull=True)
+        if options['start']:
+            orders = orders.filter(date__gte=options['start'])
+        if options['end']:
+            orders = orders.filter(date__lte=options['end'])
+        if options['customer']:
+            orders = orders.filter(customer_id=options['customer'])
+
+        if options['dry_run']:
+            self.stdout.write(f"{orders.count()} sales order(s) would be invoiced.")
+            return
+
+        invoices = invoice_sales_orders(orders, merge=options['merge'], issue_date=options['issue_date'],
+                                        created_by=options['created_by'])
+        self.stdout.write(self.style.SUCCESS(f"Created {len(invoices)} invoice(s)."))
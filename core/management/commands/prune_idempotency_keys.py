@@ -0,0 +1,18 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from core.models import IdempotencyKey
+
+
+class Command(BaseCommand):
+    help = "Delete idempotency keys older than IDEMPOTENCY_KEY_TTL_HOURS (default 24)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, help="Override the retention in hours.")
+
+    def handle(self, *args, **options):
+        hours = options['hours'] if options['hours'] is not None else getattr(settings, 'IDEMPOTENCY_KEY_TTL_HOURS', 24)
+        deleted, _ = IdempotencyKey.objects.filter(created_at__lt=timezone.now() - timedelta(hours=hours)).delete()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} idempotency key(s)."))
@@ -0,0 +1,82 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum, Max
+from core.models import AccountBalance, AccountDailyBalance, JournalLine
+from core.utils import bump_ledger_version
+
+
+class Command(BaseCommand):
+    help = ("Rebuild the AccountBalance store and the AccountDailyBalance rollup from JournalLine "
+            "(use --verify to only compare)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help="Report balances that differ from the ledger; don't write anything.")
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            ledger = {
+                r['account_id']: r
+                for r in (JournalLine.objects.order_by()
+                          .values('account_id')
+                          .annotate(debits=Sum('debit'), credits=Sum('credit'), last_id=Max('id')))
+            }
+            daily = {
+                (r['account_id'], r['date']): r
+                for r in (JournalLine.objects.order_by()
+                          .values('account_id', 'date')
+                          .annotate(debits=Sum('debit'), credits=Sum('credit')))
+            }
+
+            if options['verify']:
+                stored = {b.account_id: (b.debit_total, b.credit_total) for b in AccountBalance.objects.all()}
+                stored_daily = {(d.account_id, d.date): (d.debit, d.credit) for d in AccountDailyBalance.objects.all()}
+                mismatches = self._compare('Account', ledger, stored)
+                mismatches += self._compare('Daily rollup', daily, stored_daily)
+                if mismatches:
+                    raise CommandError(f"{mismatches} balance(s) out of sync; run without --verify to rebuild.")
+                self.stdout.write(self.style.SUCCESS("All account balances match the ledger."))
+                return
+
+            AccountBalance.objects.all().delete()
+            AccountBalance.objects.bulk_create([
+                AccountBalance(
+                    account_id=account_id,
+                    debit_total=r['debits'] or Decimal('0.00'),
+                    credit_total=r['credits'] or Decimal('0.00'),
+                    last_line_id=r['last_id'] or 0,
+                )
+                for account_id, r in ledger.items()
+            ])
+
+            AccountDailyBalance.objects.all().delete()
+            AccountDailyBalance.objects.bulk_create([
+                AccountDailyBalance(
+                    account_id=account_id,
+                    date=day,
+                    debit=r['debits'] or Decimal('0.00'),
+                    credit=r['credits'] or Decimal('0.00'),
+                )
+                for (account_id, day), r in daily.items()
+            ], batch_size=1000)
+            # reports read these tables, so drop any cached ones built from the old values
+            bump_ledger_version()
+        self.stdout.write(self.style.SUCCESS(
+            f"Rebuilt balances for {len(ledger)} account(s) and {len(daily)} daily rollup row(s)."))
+
+    def _compare(self, label, ledger, stored):
+        """Print every key whose stored (debit, credit) differs from the ledger; return the count."""
+        zero = (Decimal('0.00'), Decimal('0.00'))
+        mismatches = 0
+        for key in sorted(set(ledger) | set(stored), key=str):
+            r = ledger.get(key) or {}
+            # SQLite sums decimals as floats, so round the ledger side before comparing
+            want = ((r.get('debits') or zero[0]).quantize(zero[0]), (r.get('credits') or zero[1]).quantize(zero[1]))
+            have = stored.get(key, zero)
+            if want != have:
+                mismatches += 1
+                self.stdout.write(self.style.WARNING(
+                    f"{label} {key}: stored Dr {have[0]} / Cr {have[1]}, ledger Dr {want[0]} / Cr {want[1]}"))
+        return mismatches
@@ -0,0 +1,48 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F, Q
+from core.models import VendorBill
+
+TOTAL_FIELDS = ['total_amount', 'paid_amount', 'outstanding_amount']
+
+
+class Command(BaseCommand):
+    help = ("Recompute the stored VendorBill totals from their lines and posted payments "
+            "(use --verify to only compare)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help="Report bills whose stored totals differ; don't write anything.")
+
+    def handle(self, *args, **options):
+        zero = Decimal('0.00')
+        with transaction.atomic():
+            drifted = (VendorBill.objects.with_totals()
+                       .filter(~Q(total_amount=F('lines_total'))
+                               | ~Q(paid_amount=F('payments_total'))
+                               | ~Q(outstanding_amount=F('balance')))
+                       .only('pk', *TOTAL_FIELDS))
+            stale = []
+            for bill in drifted.iterator(chunk_size=2000):
+                want = {
+                    'total_amount': bill.lines_total.quantize(zero),
+                    'paid_amount': bill.payments_total.quantize(zero),
+                    'outstanding_amount': bill.balance.quantize(zero),
+                }
+                if options['verify']:
+                    have = {f: getattr(bill, f) for f in TOTAL_FIELDS}
+                    self.stdout.write(self.style.WARNING(f"Bill {bill.pk}: stored {have}, computed {want}"))
+                for f, v in want.items():
+                    setattr(bill, f, v)
+                stale.append(bill)
+
+            if options['verify']:
+                if stale:
+                    raise CommandError(f"{len(stale)} bill(s) out of sync; run without --verify to repair.")
+                self.stdout.write(self.style.SUCCESS("All bill totals match their lines and payments."))
+                return
+
+            VendorBill.objects.bulk_update(stale, TOTAL_FIELDS, batch_size=500)
+        self.stdout.write(self.style.SUCCESS(f"Repaired totals on {len(stale)} bill(s)."))
@@ -0,0 +1,61 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Sum
+from core.models import CustomerInvoice, CustomerInvoiceLine, CustomerPayment
+
+TOTAL_FIELDS = ['untaxed_total', 'tax_total', 'grand_total', 'amount_paid', 'amount_due']
+
+
+class Command(BaseCommand):
+    help = ("Recompute the stored CustomerInvoice totals from their lines and posted payments "
+            "(use --verify to only compare)")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verify', action='store_true',
+                            help="Report invoices whose stored totals differ; don't write anything.")
+
+    def handle(self, *args, **options):
+        zero = Decimal('0.00')
+        with transaction.atomic():
+            lines = {
+                r['invoice_id']: r
+                for r in (CustomerInvoiceLine.objects.order_by()
+                          .values('invoice_id')
+                          .annotate(tax=Sum('tax_amount'), total=Sum('line_total')))
+            }
+            paid = dict(CustomerPayment.objects.filter(journal_entry__isnull=False).order_by()
+                        .values('invoice_id')
+                        .annotate(total=Sum('amount'))
+                        .values_list('invoice_id', 'total'))
+
+            stale = []
+            for inv in CustomerInvoice.objects.only('pk', *TOTAL_FIELDS).iterator(chunk_size=2000):
+                r = lines.get(inv.pk) or {}
+                tax = (r.get('tax') or zero).quantize(zero)
+                grand = (r.get('total') or zero).quantize(zero)
+                amount_paid = (paid.get(inv.pk) or zero).quantize(zero)
+                want = {
+                    'untaxed_total': grand - tax,
+                    'tax_total': tax,
+                    'grand_total': grand,
+                    'amount_paid': amount_paid,
+                    'amount_due': grand - amount_paid,
+                }
+                have = {f: getattr(inv, f) for f in TOTAL_FIELDS}
+                if want != have:
+                    if options['verify']:
+                        self.stdout.write(self.style.WARNING(f"Invoice {inv.pk}: stored {have}, computed {want}"))
+                    for f, v in want.items():
+                        setattr(inv, f, v)
+                    stale.append(inv)
+
+            if options['verify']:
+                if stale:
+                    raise CommandError(f"{len(stale)} invoice(s) out of sync; run without --verify to repair.")
+                self.stdout.write(self.style.SUCCESS("All invoice totals match their lines and posted payments."))
+                return
+
+            CustomerInvoice.objects.bulk_update(stale, TOTAL_FIELDS, batch_size=500)
+        self.stdout.write(self.style.SUCCESS(f"Repaired totals on {len(stale)} invoice(s)."))
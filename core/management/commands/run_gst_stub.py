@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from core.gst_stub import GstStubServer
+
+
+class Command(BaseCommand):
+    help = "Serve a local stand-in for the GST HSN search and tax rate APIs from the offline HSN data"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8765)
+        parser.add_argument('--delay', type=float, default=0, help="Seconds to wait before every answer.")
+        parser.add_argument('--fail-every', type=int, default=0, help="Answer every Nth request with a 503.")
+
+    def handle(self, *args, **options):
+        stub = GstStubServer(options['host'], options['port'], delay=options['delay'],
+                             fail_every=options['fail_every'])
+        self.stdout.write(f"GST_HSN_SEARCH_URL={stub.search_url}")
+        self.stdout.write(f"TAX_API_BASE={stub.tax_url}")
+        try:
+            stub.serve_forever()
+        except KeyboardInterrupt:
+            pass
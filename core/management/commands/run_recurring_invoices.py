@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from core.models import RecurringInvoice
+from core.utils import run_recurring_invoices, parse_date_option
+
+
+class Command(BaseCommand):
+    help = ("Generate the invoices of every recurring template that is due, posting them for "
+            "auto-confirm templates; safe to rerun for the same period")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--as-of', type=parse_date_option, help="Bill periods up to YYYY-MM-DD (default today).")
+        parser.add_argument('--batch-size', type=int, default=500, help="Templates per transaction (default 500).")
+        parser.add_argument('--created-by', default='run_recurring_invoices', help="Stored on the invoices.")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the due templates.")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1.")
+        if options['dry_run']:
+            due = RecurringInvoice.objects.filter(active=True, next_run_date__lte=options['as_of'] or timezone.localdate())
+            self.stdout.write(f"{due.count()} recurring template(s) are due.")
+            return
+
+        result = run_recurring_invoices(as_of=options['as_of'], batch_size=options['batch_size'],
+                                        created_by=options['created_by'])
+        for f in result['failed']:
+            self.stdout.write(self.style.WARNING(f"{f['type']} {f['id']}: {f['error']}"))
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {result['created']} invoice(s); confirmed {len(result['confirmed'])}, "
+            f"{len(result['failed'])} failed to post."))
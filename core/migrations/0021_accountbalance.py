@@ -0,0 +1,45 @@
+# Generated by Django 5.1.15 on 2026-10-17 03:56
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Max, Sum
+
+
+def populate_balances(apps, schema_editor):
+    AccountBalance = apps.get_model('core', 'AccountBalance')
+    JournalLine = apps.get_model('core', 'JournalLine')
+    rows = (JournalLine.objects.order_by()
+            .values('account_id')
+            .annotate(debits=Sum('debit'), credits=Sum('credit'), last_id=Max('id')))
+    AccountBalance.objects.bulk_create([
+        AccountBalance(
+            account_id=r['account_id'],
+            debit_total=r['debits'] or Decimal('0.00'),
+            credit_total=r['credits'] or Decimal('0.00'),
+            last_line_id=r['last_id'] or 0,
+        )
+        for r in rows
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0020_payment_invoice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('debit_total', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18)),
+                ('credit_total', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18)),
+                ('last_line_id', models.PositiveBigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('account', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='balance', to='core.account')),
+            ],
+        ),
+        migrations.RunPython(populate_balances, migrations.RunPython.noop),
+    ]
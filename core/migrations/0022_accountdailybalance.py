@@ -0,0 +1,48 @@
+# Generated by Django 5.1.15 on 2026-10-17 03:57
+
+import django.db.models.deletion
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_rollup(apps, schema_editor):
+    AccountDailyBalance = apps.get_model('core', 'AccountDailyBalance')
+    JournalLine = apps.get_model('core', 'JournalLine')
+    rows = (JournalLine.objects.order_by()
+            .values('account_id', 'date')
+            .annotate(debits=Sum('debit'), credits=Sum('credit')))
+    AccountDailyBalance.objects.bulk_create([
+        AccountDailyBalance(
+            account_id=r['account_id'],
+            date=r['date'],
+            debit=r['debits'] or Decimal('0.00'),
+            credit=r['credits'] or Decimal('0.00'),
+        )
+        for r in rows
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_accountbalance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountDailyBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('debit', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18)),
+                ('credit', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_balances', to='core.account')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['date', 'account'], name='core_accoun_date_9e924f_idx')],
+                'unique_together': {('account', 'date')},
+            },
+        ),
+        migrations.RunPython(populate_rollup, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.15 on 2026-10-17 03:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('core', '0022_accountdailybalance'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='journalline',
+            options={'ordering': ['date', 'id']},
+        ),
+        migrations.AddIndex(
+            model_name='journalline',
+            index=models.Index(fields=['account', 'date'], name='core_journa_account_02079b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='journalline',
+            index=models.Index(fields=['partner_content_type', 'partner_object_id', 'date'], name='core_journa_partner_892ca3_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='journalline',
+            index=models.Index(fields=['entry', 'account'], name='core_journa_entry_i_1525e4_idx'),
+        ),
+    ]
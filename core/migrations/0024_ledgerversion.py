@@ -0,0 +1,26 @@
+# Generated by Django 5.1.15 on 2026-10-17 03:59
+
+from django.db import migrations, models
+
+
+def create_counter(apps, schema_editor):
+    LedgerVersion = apps.get_model('core', 'LedgerVersion')
+    LedgerVersion.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_journalline_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LedgerVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_counter, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.15 on 2026-10-17 04:00
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0024_ledgerversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='journalline',
+            name='partner',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='journal_lines', to='core.contact'),
+        ),
+    ]
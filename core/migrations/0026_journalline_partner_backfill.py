@@ -0,0 +1,29 @@
+from django.db import migrations
+from django.db.models import F
+
+
+def backfill_partner(apps, schema_editor):
+    """Copy the generic partner (content type + object id) into the new Contact FK."""
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    Contact = apps.get_model('core', 'Contact')
+    JournalLine = apps.get_model('core', 'JournalLine')
+
+    ct = ContentType.objects.filter(app_label='core', model='contact').first()
+    if ct is None:
+        return
+    contact_ids = Contact.objects.values('pk')
+    (JournalLine.objects
+     .filter(partner_content_type=ct, partner_object_id__in=contact_ids)
+     .update(partner_id=F('partner_object_id')))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('core', '0025_journalline_partner'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_partner, migrations.RunPython.noop),
+    ]
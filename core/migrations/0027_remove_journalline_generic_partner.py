@@ -0,0 +1,29 @@
+# Generated by Django 5.1.15 on 2026-10-17 04:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_journalline_partner_backfill'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='journalline',
+            name='core_journa_partner_892ca3_idx',
+        ),
+        migrations.RemoveField(
+            model_name='journalline',
+            name='partner_content_type',
+        ),
+        migrations.RemoveField(
+            model_name='journalline',
+            name='partner_object_id',
+        ),
+        migrations.AddIndex(
+            model_name='journalline',
+            index=models.Index(fields=['partner', 'date'], name='core_journa_partner_1ee2dc_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.15 on 2026-10-17 04:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0027_remove_journalline_generic_partner'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='customerinvoice',
+            index=models.Index(fields=['status', 'due_date'], name='core_custom_status_6b8ce6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='vendorbill',
+            index=models.Index(fields=['status', 'due_date'], name='core_vendor_status_9822f1_idx'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.1.15 on 2026-10-17 04:03
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_totals(apps, schema_editor):
+    """Fill the new stored totals from existing invoice lines and posted payments."""
+    CustomerInvoice = apps.get_model('core', 'CustomerInvoice')
+    CustomerInvoiceLine = apps.get_model('core', 'CustomerInvoiceLine')
+    CustomerPayment = apps.get_model('core', 'CustomerPayment')
+
+    zero = Decimal('0.00')
+    lines = {
+        r['invoice_id']: r
+        for r in (CustomerInvoiceLine.objects.order_by()
+                  .values('invoice_id')
+                  .annotate(tax=Sum('tax_amount'), total=Sum('line_total')))
+    }
+    paid = dict(CustomerPayment.objects.filter(journal_entry__isnull=False).order_by()
+                .values('invoice_id')
+                .annotate(total=Sum('amount'))
+                .values_list('invoice_id', 'total'))
+
+    invoices = []
+    for inv in CustomerInvoice.objects.only('pk'):
+        r = lines.get(inv.pk) or {}
+        inv.tax_total = (r.get('tax') or zero).quantize(zero)
+        inv.grand_total = (r.get('total') or zero).quantize(zero)
+        inv.untaxed_total = inv.grand_total - inv.tax_total
+        inv.amount_paid = (paid.get(inv.pk) or zero).quantize(zero)
+        inv.amount_due = inv.grand_total - inv.amount_paid
+        invoices.append(inv)
+    CustomerInvoice.objects.bulk_update(
+        invoices, ['untaxed_total', 'tax_total', 'grand_total', 'amount_paid', 'amount_due'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_documentsequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customerinvoice',
+            name='amount_due',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='customerinvoice',
+            name='amount_paid',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='customerinvoice',
+            name='grand_total',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='customerinvoice',
+            name='tax_total',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='customerinvoice',
+            name='untaxed_total',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18),
+        ),
+        migrations.RunPython(populate_totals, migrations.RunPython.noop),
+    ]
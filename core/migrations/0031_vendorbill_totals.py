@@ -0,0 +1,58 @@
+# Generated by Django 5.1.15 on 2026-10-17 04:05
+
+from decimal import Decimal
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def populate_totals(apps, schema_editor):
+    """Fill the stored bill totals from existing lines and posted payments."""
+    VendorBill = apps.get_model('core', 'VendorBill')
+    VendorBillLine = apps.get_model('core', 'VendorBillLine')
+    Payment = apps.get_model('core', 'Payment')
+
+    zero = Decimal('0.00')
+    lines = dict(VendorBillLine.objects.order_by()
+                 .values('bill_id').annotate(total=Sum('line_total'))
+                 .values_list('bill_id', 'total'))
+    paid = dict(Payment.objects.filter(journal_entry__isnull=False).order_by()
+                .values('bill_id').annotate(total=Sum('amount'))
+                .values_list('bill_id', 'total'))
+
+    bills = []
+    for bill in VendorBill.objects.only('pk'):
+        bill.total_amount = (lines.get(bill.pk) or zero).quantize(zero)
+        bill.paid_amount = (paid.get(bill.pk) or zero).quantize(zero)
+        bill.outstanding_amount = bill.total_amount - bill.paid_amount
+        bills.append(bill)
+    VendorBill.objects.bulk_update(bills, ['total_amount', 'paid_amount', 'outstanding_amount'], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0030_customerinvoice_totals'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='vendorbill',
+            name='outstanding_amount',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='vendorbill',
+            name='paid_amount',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18),
+        ),
+        migrations.AddField(
+            model_name='vendorbill',
+            name='total_amount',
+            field=models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=18),
+        ),
+        migrations.AddIndex(
+            model_name='vendorbill',
+            index=models.Index(fields=['outstanding_amount', 'bill_date'], name='core_vendor_outstan_af8adb_idx'),
+        ),
+        migrations.RunPython(populate_totals, migrations.RunPython.noop),
+    ]
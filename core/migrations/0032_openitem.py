@@ -0,0 +1,63 @@
+# Generated by Django 5.1.15 on 2026-10-17 04:07
+
+import django.db.models.deletion
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import Sum
+
+
+def open_confirmed_documents(apps, schema_editor):
+    """Create open items for invoices and bills that were confirmed before this table existed."""
+    OpenItem = apps.get_model('core', 'OpenItem')
+    CustomerInvoice = apps.get_model('core', 'CustomerInvoice')
+    CustomerPayment = apps.get_model('core', 'CustomerPayment')
+    VendorBill = apps.get_model('core', 'VendorBill')
+
+    zero = Decimal('0.00')
+    posted = dict(CustomerPayment.objects.filter(journal_entry__isnull=False).order_by()
+                  .values('invoice_id').annotate(total=Sum('amount'))
+                  .values_list('invoice_id', 'total'))
+    items = []
+    for inv in CustomerInvoice.objects.filter(status='confirmed').iterator():
+        items.append(OpenItem(
+            kind='receivable', partner_id=inv.customer_id, invoice_id=inv.pk,
+            document_date=inv.issue_date, due_date=inv.due_date or inv.issue_date,
+            amount=inv.grand_total, residual=inv.grand_total - (posted.get(inv.pk) or zero),
+        ))
+    for bill in VendorBill.objects.filter(status='confirmed').iterator():
+        items.append(OpenItem(
+            kind='payable', partner_id=bill.vendor_id, bill_id=bill.pk,
+            document_date=bill.bill_date, due_date=bill.due_date or bill.bill_date,
+            amount=bill.total_amount, residual=bill.outstanding_amount,
+        ))
+    OpenItem.objects.bulk_create(items, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0031_vendorbill_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OpenItem',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('receivable', 'Receivable'), ('payable', 'Payable')], max_length=20)),
+                ('document_date', models.DateField()),
+                ('due_date', models.DateField()),
+                ('amount', models.DecimalField(decimal_places=2, max_digits=18)),
+                ('residual', models.DecimalField(decimal_places=2, max_digits=18)),
+                ('bill', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='open_item', to='core.vendorbill')),
+                ('invoice', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='open_item', to='core.customerinvoice')),
+                ('partner', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='open_items', to='core.contact')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['partner', 'kind'], name='core_openit_partner_1a4ab5_idx'), models.Index(condition=models.Q(('residual__gt', 0)), fields=['kind', 'due_date'], name='core_openitem_open_due_idx')],
+                'constraints': [models.CheckConstraint(condition=models.Q(models.Q(('bill__isnull', True), ('invoice__isnull', False)), models.Q(('bill__isnull', False), ('invoice__isnull', True)), _connector='OR'), name='core_openitem_one_document')],
+            },
+        ),
+        migrations.RunPython(open_confirmed_documents, migrations.RunPython.noop),
+    ]
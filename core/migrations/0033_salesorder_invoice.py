@@ -0,0 +1,19 @@
+# Generated by Django 5.1.15 on 2026-10-17 04:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0032_openitem'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='salesorder',
+            name='invoice',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='sales_orders', to='core.customerinvoice'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 5.1.15 on 2026-10-17 04:16
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0033_salesorder_invoice'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringInvoice',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=200)),
+                ('cadence', models.CharField(choices=[('weekly', 'Weekly'), ('monthly', 'Monthly'), ('quarterly', 'Quarterly'), ('yearly', 'Yearly')], default='monthly', max_length=20)),
+                ('start_date', models.DateField(default=django.utils.timezone.localdate)),
+                ('next_run_date', models.DateField(default=django.utils.timezone.localdate)),
+                ('end_date', models.DateField(blank=True, null=True)),
+                ('due_days', models.PositiveIntegerField(default=0, help_text='Invoice due date = issue date + this many days.')),
+                ('auto_confirm', models.BooleanField(default=False, help_text='Post the generated invoices straight away.')),
+                ('active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='recurring_invoices', to='core.contact')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RecurringInvoiceLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('qty', models.DecimalField(decimal_places=2, default=1, max_digits=12)),
+                ('unit_price', models.DecimalField(decimal_places=2, default=0, max_digits=18)),
+                ('tax_percent', models.DecimalField(decimal_places=2, default=0, max_digits=7)),
+                ('product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, to='core.product')),
+                ('template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='core.recurringinvoice')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RecurringInvoiceRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.DateField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('invoice', models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='recurring_run', to='core.customerinvoice')),
+                ('template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='core.recurringinvoice')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='recurringinvoice',
+            index=models.Index(fields=['active', 'next_run_date'], name='core_recurr_active_927c02_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='recurringinvoicerun',
+            constraint=models.UniqueConstraint(fields=('template', 'period'), name='core_recurring_run_once'),
+        ),
+    ]
@@ -1,13 +1,16 @@
-from django.db import models,transaction 
+from django.db import models,transaction, IntegrityError
 from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from decimal import Decimal
-from datetime import date,datetime
+from datetime import date,datetime,timedelta
+import calendar
 import uuid
 from django.http import JsonResponse
 from django.contrib.auth.hashers import make_password, check_password
-from django.db.models import Sum
+from django.db.models import Sum, F, OuterRef, Subquery, DecimalField
+from django.db.models.functions import Coalesce
+from .pricing import price_line, price_lines, document_totals, apply_prices
 
 class User(models.Model):
     ROLE_CHOICES = (('admin','Admin'),('invoicing','Invoicing User'))
@@ -95,6 +98,106 @@ class Account(models.Model):
     def __str__(self):
         return f"{self.name} [{self.get_account_type_display()}]"
 
+class AccountBalance(models.Model):
+    """
+    Running totals per account, kept current by the posting helpers in utils.py
+    so current balances don't need a scan over JournalLine.
+    Rebuild / verify with: manage.py rebuild_account_balances
+    """
+    account = models.OneToOneField(Account, related_name='balance', on_delete=models.CASCADE)
+    debit_total = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    credit_total = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    # highest JournalLine id included in the totals
+    last_line_id = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.account.name}: Dr {self.debit_total} / Cr {self.credit_total}"
+
+    @property
+    def amount(self):
+        """Debit-positive balance (debit_total - credit_total)."""
+        return (self.debit_total or Decimal('0.00')) - (self.credit_total or Decimal('0.00'))
+
+class AccountDailyBalance(models.Model):
+    """
+    Per-account, per-day debit/credit rollup of JournalLine, kept current by
+    the posting helpers in utils.py. Period reports sum these rows instead of
+    scanning every line in the range.
+    """
+    account = models.ForeignKey(Account, related_name='daily_balances', on_delete=models.CASCADE)
+    date = models.DateField()
+    debit = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    credit = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+
+    class Meta:
+        unique_together = [('account', 'date')]
+        indexes = [models.Index(fields=['date', 'account'])]
+
+    def __str__(self):
+        return f"{self.account_id} @ {self.date}: Dr {self.debit} / Cr {self.credit}"
+
+class LedgerVersion(models.Model):
+    """
+    Single-row counter bumped inside every posting transaction. Report caches
+    key on it, so any new posting makes earlier cached reports unreachable.
+    """
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Ledger v{self.version}"
+
+class DocumentSequence(models.Model):
+    """
+    Next free sequence value per (prefix, year), e.g. ('INV', 2025) or
+    ('PO', 2025). Numbers are allocated with an atomic UPDATE that holds the
+    row lock until the caller's transaction ends, so concurrent documents never
+    get the same number and a rolled-back document gives its number back.
+    """
+    prefix = models.CharField(max_length=40)
+    year = models.PositiveIntegerField()
+    next_value = models.PositiveBigIntegerField(default=1)
+
+    class Meta:
+        unique_together = ('prefix', 'year')
+
+    def __str__(self):
+        return f"{self.prefix}/{self.year} next {self.next_value}"
+
+    @classmethod
+    @transaction.atomic
+    def reserve(cls, prefix, year, count=1, seed=None):
+        """
+        Reserve `count` consecutive values and return the first one.
+        seed: optional callable returning the first free value when the row does
+        not exist yet (used to continue numbering of documents created before
+        the sequence table existed); defaults to 1.
+        """
+        if count < 1:
+            raise ValueError("count must be at least 1")
+        row = cls.objects.filter(prefix=prefix, year=year)
+        if not row.update(next_value=F('next_value') + count):
+            start = seed() if seed else 1
+            try:
+                with transaction.atomic():
+                    cls.objects.create(prefix=prefix, year=year, next_value=start + count)
+                return start
+            except IntegrityError:
+                # another transaction created the row first; allocate from it
+                row.update(next_value=F('next_value') + count)
+        return row.values_list('next_value', flat=True).get() - count
+
+    @staticmethod
+    def next_after(values, parse):
+        """Seed helper: 1 + the highest sequence parse() finds in values (unparseable ones are skipped)."""
+        highest = 0
+        for v in values:
+            try:
+                highest = max(highest, int(parse(v)))
+            except (TypeError, ValueError, IndexError):
+                continue
+        return highest + 1
+
 class Product(models.Model):
     name = models.CharField(max_length=255)
     product_type = models.CharField(max_length=32, choices=[('goods','Goods'),('service','Service')], default='goods')
@@ -149,13 +252,11 @@ class JournalEntry(models.Model):
 class JournalLine(models.Model):
     """
     Individual debit/credit line. Sum of debits must equal sum of credits per JournalEntry.
-    partner is optional (useful for partner ledger).
+    partner is an optional Contact (useful for partner ledger and receivable/payable reports).
     """
     entry = models.ForeignKey(JournalEntry, related_name='lines', on_delete=models.CASCADE)
     account = models.ForeignKey('core.Account', on_delete=models.PROTECT)  # adjust app label if needed
-    partner_content_type = models.ForeignKey(ContentType, null=True, blank=True, on_delete=models.SET_NULL, related_name='+')
-    partner_object_id = models.PositiveIntegerField(null=True, blank=True)
-    partner = GenericForeignKey('partner_content_type', 'partner_object_id')
+    partner = models.ForeignKey('core.Contact', null=True, blank=True, on_delete=models.PROTECT, related_name='journal_lines')
 
     debit = models.DecimalField(max_digits=18, decimal_places=2, default=0)
     credit = models.DecimalField(max_digits=18, decimal_places=2, default=0)
@@ -164,7 +265,13 @@ class JournalLine(models.Model):
     date = models.DateField(db_index=True)
 
     class Meta:
-        ordering = ['entry__date', 'entry_id']
+        # order on the line's own (denormalized) date so default ordering needs no JOIN
+        ordering = ['date', 'id']
+        indexes = [
+            models.Index(fields=['account', 'date']),
+            models.Index(fields=['partner', 'date']),
+            models.Index(fields=['entry', 'account']),
+        ]
 
     def __str__(self):
         side = 'Dr' if self.debit and self.debit > 0 else 'Cr'
@@ -172,6 +279,28 @@ class JournalLine(models.Model):
         return f"{self.account} {side} {amt}"
 
 
+class VendorBillQuerySet(models.QuerySet):
+    def with_totals(self):
+        """
+        Annotate live totals computed from the lines and posted payments:
+        lines_total, payments_total and balance. The stored total_amount /
+        paid_amount / outstanding_amount columns should always match these.
+        """
+        money = DecimalField(max_digits=18, decimal_places=2)
+        lines = (VendorBillLine.objects.filter(bill=OuterRef('pk')).order_by()
+                 .values('bill').annotate(s=Sum('line_total')).values('s'))
+        payments = (Payment.objects.filter(bill=OuterRef('pk'), journal_entry__isnull=False).order_by()
+                    .values('bill').annotate(s=Sum('amount')).values('s'))
+        return (self
+                .annotate(lines_total=Coalesce(Subquery(lines, output_field=money), Decimal('0.00'), output_field=money),
+                          payments_total=Coalesce(Subquery(payments, output_field=money), Decimal('0.00'), output_field=money))
+                .annotate(balance=F('lines_total') - F('payments_total')))
+
+    def outstanding(self):
+        """Bills with an unpaid balance, read from the stored (indexed) outstanding_amount column."""
+        return self.filter(outstanding_amount__gt=0)
+
+
 class VendorBill(models.Model):
     DRAFT = 'draft'
     CONFIRMED = 'confirmed'
@@ -195,80 +324,96 @@ class VendorBill(models.Model):
         related_name='vendor_bills'
     )
 
+    # stored totals: total_amount follows VendorBillLine save/delete, paid_amount
+    # follows Payment.post (posted payments only); outstanding = total - paid
+    total_amount = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    paid_amount = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    outstanding_amount = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+
     created_by = models.CharField(max_length=200, blank=True, null=True)  # or FK to user if you have custom user
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = VendorBillQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # the aging report scans open (confirmed) bills by due date
+            models.Index(fields=['status', 'due_date']),
+            # bill list "outstanding only" filter
+            models.Index(fields=['outstanding_amount', 'bill_date']),
+        ]
+
     def __str__(self):
         return f"Bill/{self.pk} - {self.vendor}"
 
-    @property
-    def total_amount(self):
-        """
-        Sum of line_total across related lines (DB aggregate).
-        Returns Decimal('0.00') if no lines.
-        """
-        agg = self.lines.aggregate(total=Sum('line_total'))
-        return agg['total'] or Decimal('0.00')
+    def recompute_totals(self):
+        """Refresh the stored totals from lines and posted payments and write them with one UPDATE."""
+        zero = Decimal('0.00')
+        self.total_amount = (self.lines.aggregate(total=Sum('line_total'))['total'] or zero).quantize(zero)
+        self.paid_amount = (self.payments.filter(journal_entry__isnull=False)
+                            .aggregate(total=Sum('amount'))['total'] or zero).quantize(zero)
+        self.outstanding_amount = self.total_amount - self.paid_amount
+        VendorBill.objects.filter(pk=self.pk).update(
+            total_amount=self.total_amount,
+            paid_amount=self.paid_amount,
+            outstanding_amount=self.outstanding_amount,
+        )
+
+    def open_amount(self):
+        """What is still owed: the open item's residual once the bill has one, else outstanding_amount."""
+        residual = OpenItem.objects.filter(bill=self).values_list('residual', flat=True).first()
+        return self.outstanding_amount if residual is None else residual
+
+    def apply_line_delta(self, delta):
+        """Shift the stored totals by a line_total change with a single F() UPDATE."""
+        if delta:
+            VendorBill.objects.filter(pk=self.pk).update(
+                total_amount=F('total_amount') + delta,
+                outstanding_amount=F('outstanding_amount') + delta,
+            )
 
     # optional: also provide net / tax totals
     @property
     def net_amount(self):
         agg = self.lines.aggregate(total=Sum('unit_price' * F('qty'))) 
 
-    @transaction.atomic
-    def confirm(self):
+    def build_journal(self, accounts, created_by=None):
         """
-        Confirm the bill and post accounting entries.
-        This method:
-          - calculates net & tax totals from lines
-          - finds seeded accounts (Purchase Expense, Tax Input, Creditors)
-          - posts a balanced journal entry via post_journal_entry()
-          - sets state to CONFIRMED and stores journal_entry
-        Raises exceptions if already confirmed or something unbalanced.
+        Return the post_journal_entries() entry for confirming this bill:
+        Dr purchase expense (net), Dr input tax (tax), Cr creditors (total),
+        from the stored total_amount and the lines' stored tax_amount.
+        accounts: dict from utils.resolve_posting_accounts(). Lines are read
+        through self.lines.all(), so a prefetch_related('lines') is honoured.
+        Raises ValueError if the bill cannot be posted.
         """
-        if self.status == self.CONFIRMED:
+        if self.status == self.CONFIRMED or self.journal_entry_id:
             raise ValueError("Bill already confirmed")
 
-        # compute totals
-        net_total = Decimal('0.00')
-        tax_total = Decimal('0.00')
-        for L in self.lines.all():
-            net_amt = (Decimal(L.unit_price or 0) * Decimal(L.qty or 0))
-            net_total += net_amt
-            tax_total += Decimal(L.tax_amount or 0)
+        # post the stored total (the sum of the rounded line totals, see core.pricing)
+        # and the lines' rounded tax, so the journal always equals total_amount
+        tax_total = sum((Decimal(L.tax_amount or 0) for L in self.lines.all()), Decimal('0.00'))
+        total = self.total_amount
+        net_total = total - tax_total
+        if total == 0:
+            raise ValueError("Bill total is zero; cannot post journal.")
 
-        total = net_total + tax_total
-
-        # locate accounts (prefer by code/name deterministic)
-        from .models import Account  # local import to avoid circulars
-        # Prefer fetching by code if you seeded; else fallback to contains
-        try:
-            purchase_exp = Account.objects.get(name__iexact='Purchase Expense A/c')
-        except Account.DoesNotExist:
-            purchase_exp = Account.objects.filter(account_type='expense').first()
-
-        # optional tax input account
-        tax_input_acc = Account.objects.filter(name__icontains='Tax').first()
-
-        try:
-            creditors_acc = Account.objects.get(name__iexact='Creditors A/c')
-        except Account.DoesNotExist:
-            # fallback: liability account
-            creditors_acc = Account.objects.filter(account_type='liability').first()
+        purchase_exp = accounts.get('purchase')
+        tax_input_acc = accounts.get('input_tax')
+        creditors_acc = accounts.get('creditors')
+        if not purchase_exp or not creditors_acc:
+            raise ValueError("Configure Purchase Expense and Creditors accounts first.")
 
         # Build journal lines: debit purchases, debit tax (if separate), credit creditors
         lines = []
-        # debit purchase expense for net_total
         if net_total > 0:
             lines.append({
                 'account': purchase_exp,
                 'debit': net_total,
                 'credit': 0,
                 'narration': f'Purchase (bill {self.pk})',
-                'partner': self.vendor
+                'partner': self.vendor_id
             })
 
-        # debit tax input if available
         if tax_total and tax_total != Decimal('0.00'):
             if tax_input_acc:
                 lines.append({
@@ -276,38 +421,68 @@ class VendorBill(models.Model):
                     'debit': tax_total,
                     'credit': 0,
                     'narration': f'Input tax (bill {self.pk})',
-                    'partner': self.vendor
+                    'partner': self.vendor_id
                 })
             else:
                 # If no tax account, add tax into purchase expense (so totals still balance)
-                lines[0]['debit'] = lines[0]['debit'] + tax_total
+                lines.append({
+                    'account': purchase_exp,
+                    'debit': tax_total,
+                    'credit': 0,
+                    'narration': f'Tax added to purchase (bill {self.pk})',
+                    'partner': self.vendor_id
+                })
 
-        # credit creditors
         lines.append({
             'account': creditors_acc,
             'debit': 0,
             'credit': total,
             'narration': f'Payable to {self.vendor}',
-            'partner': self.vendor
+            'partner': self.vendor_id
         })
 
-        # post journal entry using helper
-        from .utils import post_journal_entry, JournalError
-        je = post_journal_entry(
-            date=self.bill_date or timezone.now().date(),
-            ref=f"Bill/{self.pk}",
-            narration=f"Vendor bill {self.pk} for {self.vendor}",
-            lines=lines,
-            source=self
-        )
+        return {
+            'date': self.bill_date or timezone.now().date(),
+            'ref': f"Bill/{self.pk}",
+            'narration': f"Vendor bill {self.pk} for {self.vendor}",
+            'lines': lines,
+            'source': self,
+            'created_by': created_by,
+        }
 
+    @transaction.atomic
+    def confirm(self, accounts=None, created_by=None):
+        """
+        Confirm the bill: post its journal entry, mark it confirmed and open
+        its payable. Raises ValueError if already confirmed or not postable.
+        """
+        # line saves move the stored totals with F() updates, so this instance may be stale
+        self.refresh_from_db(fields=['status', 'total_amount', 'paid_amount', 'outstanding_amount'])
+        from .utils import confirm_documents_now
+        return confirm_documents_now([self], accounts=accounts, created_by=created_by)[0]
 
-        # save JE on bill and mark confirmed
-        self.journal_entry = je
-        self.status = self.CONFIRMED
-        self.save(update_fields=['journal_entry', 'state'])
 
-        return je
+class PricedLineQuerySet(models.QuerySet):
+    """
+    Queryset for document line models. bulk_create() bypasses save(), so it
+    prices the lines itself (see core.pricing) and then lets the model bring
+    its documents' stored totals up to date via `_after_bulk_create(lines)`.
+    Pass update_totals=False when the caller has already set those totals.
+    """
+
+    def bulk_create(self, objs, *args, update_totals=True, **kwargs):
+        objs = list(objs)
+        before = getattr(self.model, '_before_bulk_create', None)
+        if before:
+            before(objs)
+        if any(f.name == 'line_total' for f in self.model._meta.concrete_fields):
+            apply_prices(objs)
+        with transaction.atomic():
+            created = super().bulk_create(objs, *args, **kwargs)
+            after = getattr(self.model, '_after_bulk_create', None)
+            if update_totals and after:
+                after(created)
+        return created
 
 
 class VendorBillLine(models.Model):
@@ -321,17 +496,33 @@ class VendorBillLine(models.Model):
     tax_amount = models.DecimalField(max_digits=18, decimal_places=2, default=0)
     line_total = models.DecimalField(max_digits=18, decimal_places=2, default=0)
 
+    objects = PricedLineQuerySet.as_manager()
+
     def save(self, *args, **kwargs):
         # compute tax_amount and line_total automatically before save (simple percent tax)
-        net = (Decimal(self.unit_price or 0) * Decimal(self.qty or 0))
-        tax_amt = Decimal('0.00')
-        try:
-            tax_amt = (net * (Decimal(self.tax_percent or 0) / Decimal('100.00')))
-        except Exception:
-            tax_amt = Decimal('0.00')
-        self.tax_amount = tax_amt.quantize(Decimal('0.01'))
-        self.line_total = (net + self.tax_amount).quantize(Decimal('0.01'))
-        super().save(*args, **kwargs)
+        apply_prices([self])
+        with transaction.atomic():
+            old_total = Decimal('0.00')
+            if self.pk:
+                old_total = (VendorBillLine.objects.filter(pk=self.pk)
+                             .values_list('line_total', flat=True).first()) or Decimal('0.00')
+            super().save(*args, **kwargs)
+            self.bill.apply_line_delta(self.line_total - old_total)
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        total = self.line_total or Decimal('0.00')
+        result = super().delete(*args, **kwargs)
+        self.bill.apply_line_delta(-total)
+        return result
+
+    @classmethod
+    def _after_bulk_create(cls, lines):
+        deltas = {}
+        for l in lines:
+            deltas[l.bill_id] = deltas.get(l.bill_id, Decimal('0.00')) + l.line_total
+        for bill_id, delta in deltas.items():
+            VendorBill(pk=bill_id).apply_line_delta(delta)
 
     def __str__(self):
         return f"{self.product} x{self.qty} @ {self.unit_price}"
@@ -360,6 +551,29 @@ class Payment(models.Model):
     def __str__(self):
         return f"Payment/{self.pk} - {self.amount} for Bill {self.bill_id}"
 
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            # refuse an overpayment before the row exists; post() re-checks atomically on the open item
+            outstanding = VendorBill.objects.get(pk=self.bill_id).open_amount()
+            if Decimal(self.amount) > outstanding:
+                raise ValueError(f"Payment exceeds outstanding amount ({outstanding}).")
+        super().save(*args, **kwargs)
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        posted = self.journal_entry_id is not None
+        result = super().delete(*args, **kwargs)
+        if posted:
+            # only posted payments count towards the bill's stored totals
+            VendorBill.objects.filter(pk=self.bill_id).update(
+                paid_amount=F('paid_amount') - self.amount,
+                outstanding_amount=F('outstanding_amount') + self.amount,
+            )
+            item = OpenItem.objects.filter(bill_id=self.bill_id).first()
+            if item:
+                item.release(self.amount)
+        return result
+
     @transaction.atomic
     def post(self):
         """
@@ -372,28 +586,16 @@ class Payment(models.Model):
         if self.journal_entry:
             raise ValueError("Payment already posted (journal_entry already present).")
 
-        # compute bill totals and outstanding
-        bill = self.bill
-        total_bill = Decimal('0.00')
-        for L in bill.lines.all():
-            total_bill += Decimal(L.line_total or 0)
-
-        paid_already = Decimal('0.00')
-        for p in bill.payments.exclude(pk=self.pk):
-            paid_already += Decimal(p.amount or 0)
+        bill = VendorBill.objects.select_related('vendor').get(pk=self.bill_id)
+        # take the amount off the bill's open item; fails (without racing) on overpayment
+        item = OpenItem.for_bill(bill)
+        item.consume(Decimal(self.amount))
 
-        outstanding = total_bill - paid_already
-        if Decimal(self.amount) > outstanding:
-            raise ValueError(f"Payment exceeds outstanding amount ({outstanding}).")
-
-        # find creditors account (liability) and the cash/bank account is self.account
-        from .models import Account
-        try:
-            creditors_acc = Account.objects.get(name__iexact='Creditors A/c')
-        except Account.DoesNotExist:
-            creditors_acc = Account.objects.filter(account_type='liability').first()
-            if not creditors_acc:
-                raise ValueError("No creditors (liability) account configured.")
+        # creditors account (liability) comes from the cached account roles; the cash/bank account is self.account
+        from .utils import resolve_posting_accounts
+        creditors_acc = resolve_posting_accounts()['creditors']
+        if not creditors_acc:
+            raise ValueError("No creditors (liability) account configured.")
 
         if not self.account:
             raise ValueError("Payment must have an account (Cash/Bank) assigned.")
@@ -434,9 +636,13 @@ class Payment(models.Model):
         self.journal_entry = je
         self.save(update_fields=['journal_entry'])
 
-        # update bill paid status/fields
-        new_paid = paid_already + Decimal(self.amount)
+        # the payment now counts towards the bill's stored paid/outstanding totals
+        VendorBill.objects.filter(pk=bill.pk).update(
+            paid_amount=F('paid_amount') + Decimal(self.amount),
+            outstanding_amount=F('outstanding_amount') - Decimal(self.amount),
+        )
 
+        # update bill paid status/fields
         # If your VendorBill uses 'status' as field (it does in your posted model), set it:
         if hasattr(bill, 'status'):
             # you may want a dedicated 'paid' state; if not, keep 'confirmed'
@@ -458,7 +664,7 @@ class Payment(models.Model):
                 pass
 
         # If you track whether fully paid, update accordingly
-        if new_paid >= total_bill:
+        if item.residual <= 0:
             # if VendorBill has a 'paid' boolean or similar, set it here; else keep status updated as above
             if hasattr(bill, 'is_paid'):
                 bill.is_paid = True
@@ -530,63 +736,39 @@ class PurchaseOrder(models.Model):
 
     def _generate_po_number(self):
         """
-        Generate PO/2025/0001 style number. Uses a safe date conversion.
+        Generate PO/2025/0001 style number from the ('PO', year) sequence.
         """
         year = self._safe_po_date().year
-        last = PurchaseOrder.objects.filter(created_at__year=year).order_by('id').last()
-        if last and last.po_number:
-            try:
-                last_seq = int(last.po_number.split('/')[-1])
-            except Exception:
-                last_seq = last.id or 0
-            seq = last_seq + 1
-        else:
-            seq = 1
+        seq = DocumentSequence.reserve('PO', year, seed=lambda: DocumentSequence.next_after(
+            PurchaseOrder.objects.filter(po_number__startswith=f"PO/{year}/").values_list('po_number', flat=True),
+            lambda n: n.split('/')[-1].split('-')[0]))
         return f"PO/{year}/{str(seq).zfill(4)}"
 
     def _generate_reference(self):
         pd_safe = self._safe_po_date()
         date_str = pd_safe.strftime("%Y%m%d")
-        last = PurchaseOrder.objects.filter(created_at__date=pd_safe).order_by('id').last()
-        if last and last.reference_id:
-            try:
-                last_seq = int(last.reference_id.split('-')[-1])
-            except Exception:
-                last_seq = last.id or 0
-            seq = last_seq + 1
-        else:
-            seq = 1
-        return f"REQ-{date_str}-{str(seq).zfill(4)}"
+        prefix = f"REQ-{date_str}"
+        seq = DocumentSequence.reserve(prefix, pd_safe.year, seed=lambda: DocumentSequence.next_after(
+            PurchaseOrder.objects.filter(reference_id__startswith=f"{prefix}-").values_list('reference_id', flat=True),
+            lambda r: r.split('-')[2]))
+        return f"{prefix}-{str(seq).zfill(4)}"
 
     @transaction.atomic
     def save(self, *args, **kwargs):
         new = self.pk is None
         if new and not self.po_number:
-            candidate = self._generate_po_number()
-            i = 0
-            while PurchaseOrder.objects.filter(po_number=candidate).exists():
-                i += 1
-                candidate = f"{candidate}-{i}"
-            self.po_number = candidate
+            self.po_number = self._generate_po_number()
 
         if new and not self.reference_id:
-            candidate_ref = self._generate_reference()
-            i = 0
-            while PurchaseOrder.objects.filter(reference_id=candidate_ref).exists():
-                i += 1
-                candidate_ref = f"{candidate_ref}-{i}"
-            self.reference_id = candidate_ref
+            self.reference_id = self._generate_reference()
 
         super().save(*args, **kwargs)
 
     def recompute_totals(self):
-        lines = self.lines.all()
-        untaxed = sum((l.untaxed_amount for l in lines), Decimal('0.00'))
-        tax = sum((l.tax_amount for l in lines), Decimal('0.00'))
-        grand = untaxed + tax
-        self.untaxed_total = untaxed.quantize(Decimal('0.01'))
-        self.tax_total = tax.quantize(Decimal('0.01'))
-        self.grand_total = grand.quantize(Decimal('0.01'))
+        totals = document_totals(price_lines(self.lines.all()))
+        self.untaxed_total = totals.untaxed
+        self.tax_total = totals.tax
+        self.grand_total = totals.total
         self.save(update_fields=["untaxed_total", "tax_total", "grand_total"])
 
     @property
@@ -612,17 +794,23 @@ class PurchaseOrderLine(models.Model):
     unit_price = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
     tax_percent = models.DecimalField(max_digits=7, decimal_places=2, default=Decimal('0.00'))
 
+    objects = PricedLineQuerySet.as_manager()
+
+    @property
+    def amounts(self):
+        return price_line(self.qty, self.unit_price, self.tax_percent)
+
     @property
     def untaxed_amount(self):
-        return (self.qty or Decimal('0.00')) * (self.unit_price or Decimal('0.00'))
+        return self.amounts.untaxed
 
     @property
     def tax_amount(self):
-        return (self.untaxed_amount * (self.tax_percent or Decimal('0.00')) / Decimal('100.00'))
+        return self.amounts.tax
 
     @property
     def line_total(self):
-        return self.untaxed_amount + self.tax_amount
+        return self.amounts.total
 
     def save(self, *args, **kwargs):
         # ensure hsn if product present
@@ -630,6 +818,15 @@ class PurchaseOrderLine(models.Model):
             self.hsn = getattr(self.product, 'hsn', '') or ''
         super().save(*args, **kwargs)
 
+    @classmethod
+    def _before_bulk_create(cls, lines):
+        # same hsn default as save(), with one product query for the batch
+        missing = {l.product_id for l in lines if l.product_id and not l.hsn}
+        hsn = dict(Product.objects.filter(pk__in=missing).values_list('pk', 'hsn')) if missing else {}
+        for l in lines:
+            if l.product_id and not l.hsn:
+                l.hsn = hsn.get(l.product_id) or ''
+
 from decimal import Decimal
 from django.db import models, transaction
 from django.utils import timezone
@@ -641,7 +838,10 @@ class SalesOrder(models.Model):
     customer = models.ForeignKey('core.Contact', on_delete=models.PROTECT)
     date = models.DateField(default=timezone.localdate)
     reference = models.CharField(max_length=200, blank=True, null=True)
-    status = models.CharField(max_length=20, default='draft')  # draft/confirmed/cancelled
+    status = models.CharField(max_length=20, default='draft')  # draft/confirmed/invoiced/cancelled
+    # the invoice this order was billed on (several orders can share one when merged)
+    invoice = models.ForeignKey('core.CustomerInvoice', null=True, blank=True, related_name='sales_orders',
+                                on_delete=models.SET_NULL)
     created_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -657,14 +857,10 @@ class SalesOrderLine(models.Model):
     tax_amount = models.DecimalField(max_digits=18, decimal_places=2, default=0)
     line_total = models.DecimalField(max_digits=18, decimal_places=2, default=0)
 
+    objects = PricedLineQuerySet.as_manager()
+
     def save(self, *args, **kwargs):
-        net = (Decimal(self.unit_price or 0) * Decimal(self.qty or 0))
-        try:
-            tax = (net * (Decimal(self.tax_percent or 0) / Decimal('100.00')))
-        except Exception:
-            tax = Decimal('0.00')
-        self.tax_amount = tax.quantize(Decimal('0.01'))
-        self.line_total = (net + self.tax_amount).quantize(Decimal('0.01'))
+        apply_prices([self])
         super().save(*args, **kwargs)
 
 
@@ -693,11 +889,22 @@ class CustomerInvoice(models.Model):
     # accounting link
     journal_entry = models.ForeignKey('core.JournalEntry', null=True, blank=True, on_delete=models.SET_NULL)
 
+    # stored totals, kept in sync by CustomerInvoiceLine / CustomerPayment save & delete;
+    # amount_paid counts posted payments only, like VendorBill.paid_amount
+    # (see recompute_totals; `manage.py recompute_invoice_totals` repairs them)
+    untaxed_total = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    tax_total = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    grand_total = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    amount_paid = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+    amount_due = models.DecimalField(max_digits=18, decimal_places=2, default=Decimal('0.00'))
+
     created_at = models.DateTimeField(auto_now_add=True)
     created_by = models.CharField(max_length=200, blank=True, null=True)
 
     class Meta:
         ordering = ['-issue_date', '-id']
+        # the aging report scans open (confirmed) invoices by due date
+        indexes = [models.Index(fields=['status', 'due_date'])]
 
     def __str__(self):
         return f"INV/{self.pk or 'n'}/{self.issue_date} - {self.customer}"
@@ -707,25 +914,24 @@ class CustomerInvoice(models.Model):
         """ Return formatted invoice number like INV/2025/0001 """
         return f"INV/{year}/{int(seq):04d}"
 
+    @classmethod
+    def reserve_numbers(cls, year, count=1):
+        """
+        Reserve `count` consecutive invoice numbers for `year` from the ('INV', year)
+        sequence and return them formatted. Call inside the transaction that
+        creates the invoices so a rollback releases them.
+        """
+        first = DocumentSequence.reserve('INV', year, count, seed=lambda: DocumentSequence.next_after(
+            cls.objects.filter(number__startswith=f"INV/{year}/").values_list('number', flat=True),
+            lambda n: n.split('/')[-1]))
+        return [cls._format_number_for_year(year, seq) for seq in range(first, first + count)]
+
     def _generate_number_and_ref(self):
         """
-        Generate a new sequential invoice number for the invoice year.
-        This implementation is simple: count invoices for the same year and use next sequence.
-        For high concurrency production you should use a dedicated sequence table or DB sequence.
+        Allocate the next sequential invoice number for the invoice year.
         """
         year = (self.issue_date or timezone.localdate()).year
-        # get last invoice with number for that year
-        last = CustomerInvoice.objects.filter(number__startswith=f"INV/{year}/").order_by('-id').first()
-        if last and last.number:
-            # parse trailing sequence
-            try:
-                seq = int(last.number.split('/')[-1])
-            except Exception:
-                seq = 0
-            seq = seq + 1
-        else:
-            seq = 1
-        return self._format_number_for_year(year, seq)
+        return self.reserve_numbers(year)[0]
 
     def save(self, *args, **kwargs):
         # On first save (no number yet), generate number and default reference if missing.
@@ -734,22 +940,114 @@ class CustomerInvoice(models.Model):
         if not self.issue_date:
             self.issue_date = timezone.localdate()
 
-        # Generate number atomically to reduce but not eliminate race conditions
-        if created and not self.number:
-            # simple locking approach using transaction.atomic: not perfect under heavy concurrency
-            with transaction.atomic():
-                # Re-check after acquiring transaction (in case another process created one)
-                if not self.number:
-                    self.number = self._generate_number_and_ref()
-                    # if reference is empty, default to same as number
-                    if not self.reference:
-                        self.reference = self.number
+        with transaction.atomic():
+            # the number is allocated in the same transaction as the insert,
+            # so a failed save releases it again
+            if created and not self.number:
+                self.number = self._generate_number_and_ref()
+                # if reference is empty, default to same as number
+                if not self.reference:
+                    self.reference = self.number
 
-        # ensure reference exists
-        if not self.reference:
-            self.reference = self.number or ''
+            # ensure reference exists
+            if not self.reference:
+                self.reference = self.number or ''
 
-        super().save(*args, **kwargs)
+            super().save(*args, **kwargs)
+
+    @property
+    def total_amount(self):
+        return self.grand_total
+
+    def open_amount(self):
+        """What is still owed: the open item's residual once the invoice has one, else amount_due."""
+        residual = OpenItem.objects.filter(invoice=self).values_list('residual', flat=True).first()
+        return self.amount_due if residual is None else residual
+
+    def build_journal(self, accounts, created_by=None):
+        """
+        Return the post_journal_entries() entry for confirming this invoice:
+        Dr debtors (grand total), Cr sales (untaxed), Cr output tax (tax),
+        from the stored totals. accounts: dict from utils.resolve_posting_accounts().
+        Raises ValueError if the invoice cannot be posted.
+        """
+        if self.status == self.CONFIRMED:
+            raise ValueError("Invoice already confirmed.")
+        untaxed, tax_total, total = self.untaxed_total, self.tax_total, self.grand_total
+        if total == 0:
+            raise ValueError("Invoice total is zero — cannot confirm.")
+
+        debtors_acc = accounts.get('debtors')
+        sales_acc = accounts.get('sales')
+        tax_acc = accounts.get('output_tax')
+        if not debtors_acc:
+            raise ValueError("No asset (Debtors) account configured.")
+        if not sales_acc:
+            raise ValueError("No sales income account configured.")
+
+        inv_label = self.number or self.pk
+        lines = [
+            # debit debtors (the customer owes us)
+            {'account': debtors_acc, 'debit': total, 'credit': 0,
+             'narration': f"Debtor: {self.customer}", 'partner': self.customer_id},
+        ]
+        # credit sales for untaxed
+        if untaxed > 0:
+            lines.append({'account': sales_acc, 'debit': 0, 'credit': untaxed,
+                          'narration': f"Sales for invoice {inv_label}", 'partner': self.customer_id})
+        # credit tax account for tax portion
+        if tax_total > 0:
+            if tax_acc:
+                lines.append({'account': tax_acc, 'debit': 0, 'credit': tax_total,
+                              'narration': f"Tax for invoice {inv_label}", 'partner': self.customer_id})
+            else:
+                # fallback: add tax to sales (not ideal, but ensures JE balances)
+                lines.append({'account': sales_acc, 'debit': 0, 'credit': tax_total,
+                              'narration': f"Tax added to sales for invoice {inv_label}", 'partner': self.customer_id})
+
+        return {
+            'date': self.issue_date or timezone.localdate(),
+            'ref': self.number,
+            'narration': f"Invoice {inv_label} for {self.customer}",
+            'lines': lines,
+            'source': self,
+            'created_by': created_by,
+        }
+
+    @transaction.atomic
+    def confirm(self, accounts=None, created_by=None):
+        """
+        Confirm the invoice: post its journal entry, mark it confirmed and open
+        its receivable. Raises ValueError if already confirmed or not postable.
+        """
+        # the stored totals may have moved since this instance was loaded
+        self.refresh_from_db(fields=['status', 'untaxed_total', 'tax_total', 'grand_total', 'amount_paid',
+                                     'amount_due'])
+        from .utils import confirm_documents_now
+        return confirm_documents_now([self], accounts=accounts, created_by=created_by)[0]
+
+    def recompute_totals(self, lines=True, payments=True):
+        """
+        Refresh the stored totals from the invoice's lines and/or posted
+        payments (one aggregate each) and write them with a single UPDATE.
+        """
+        zero = Decimal('0.00')
+        if lines:
+            agg = self.lines.aggregate(tax=Sum('tax_amount'), total=Sum('line_total'))
+            self.tax_total = (agg['tax'] or zero).quantize(zero)
+            self.grand_total = (agg['total'] or zero).quantize(zero)
+            self.untaxed_total = self.grand_total - self.tax_total
+        if payments:
+            self.amount_paid = (self.payments.filter(journal_entry__isnull=False)
+                                .aggregate(total=Sum('amount'))['total'] or zero).quantize(zero)
+        self.amount_due = self.grand_total - self.amount_paid
+        CustomerInvoice.objects.filter(pk=self.pk).update(
+            untaxed_total=self.untaxed_total,
+            tax_total=self.tax_total,
+            grand_total=self.grand_total,
+            amount_paid=self.amount_paid,
+            amount_due=self.amount_due,
+        )
 
 class CustomerInvoiceLine(models.Model):
     invoice = models.ForeignKey(CustomerInvoice, related_name='lines', on_delete=models.CASCADE)
@@ -760,15 +1058,24 @@ class CustomerInvoiceLine(models.Model):
     tax_amount = models.DecimalField(max_digits=18, decimal_places=2, default=0)
     line_total = models.DecimalField(max_digits=18, decimal_places=2, default=0)
 
+    objects = PricedLineQuerySet.as_manager()
+
     def save(self, *args, **kwargs):
-        net = (Decimal(self.unit_price or 0) * Decimal(self.qty or 0))
-        try:
-            tax = (net * (Decimal(self.tax_percent or 0) / Decimal('100.00')))
-        except Exception:
-            tax = Decimal('0.00')
-        self.tax_amount = tax.quantize(Decimal('0.01'))
-        self.line_total = (net + self.tax_amount).quantize(Decimal('0.01'))
-        super().save(*args, **kwargs)
+        apply_prices([self])
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            self.invoice.recompute_totals(payments=False)
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        self.invoice.recompute_totals(payments=False)
+        return result
+
+    @classmethod
+    def _after_bulk_create(cls, lines):
+        for invoice in CustomerInvoice.objects.filter(pk__in={l.invoice_id for l in lines}):
+            invoice.recompute_totals(payments=False)
 
 class CustomerPayment(models.Model):
     PAYMENT_METHODS = [('cash','Cash'), ('bank','Bank'), ('cheque','Cheque'), ('other','Other')]
@@ -787,24 +1094,42 @@ class CustomerPayment(models.Model):
     def __str__(self):
         return f"CUSTPAY/{self.pk} - {self.amount} for INV/{self.invoice.pk}"
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if self._state.adding:
+            # refuse an overpayment before the row exists; post() re-checks atomically on the open item
+            outstanding = CustomerInvoice.objects.get(pk=self.invoice_id).open_amount()
+            if Decimal(self.amount) > outstanding:
+                raise ValueError(f"Payment exceeds outstanding amount ({outstanding}).")
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # only posted payments count as paid, so posting (a journal_entry save) moves the totals too
+            if update_fields is None or {'amount', 'invoice', 'journal_entry'} & set(update_fields):
+                self.invoice.recompute_totals(lines=False)
+
+    @transaction.atomic
+    def delete(self, *args, **kwargs):
+        posted = self.journal_entry_id is not None
+        result = super().delete(*args, **kwargs)
+        if posted:
+            item = OpenItem.objects.filter(invoice_id=self.invoice_id).first()
+            if item:
+                item.release(self.amount)
+        self.invoice.recompute_totals(lines=False)
+        return result
+
     @transaction.atomic
     def post(self):
         if self.journal_entry:
             raise ValueError("Payment already posted")
 
-        inv = self.invoice
-        # compute outstanding
-        total_inv = sum([Decimal(L.line_total or 0) for L in inv.lines.all()])
-        paid_already = sum([Decimal(p.amount or 0) for p in inv.payments.exclude(pk=self.pk)])
-        outstanding = total_inv - paid_already
-        if Decimal(self.amount) > outstanding:
-            raise ValueError("Payment exceeds outstanding amount")
+        inv = CustomerInvoice.objects.select_related('customer').get(pk=self.invoice_id)
+        # take the amount off the invoice's open item; fails (without racing) on overpayment
+        item = OpenItem.for_invoice(inv)
+        item.consume(Decimal(self.amount))
 
-        from .models import Account
-        try:
-            debtors_acc = Account.objects.get(name__iexact='Debtors A/c')
-        except Account.DoesNotExist:
-            debtors_acc = Account.objects.filter(account_type='asset').first()
+        from .utils import resolve_posting_accounts
+        debtors_acc = resolve_posting_accounts()['debtors']
 
         # Build lines: debit bank/cash (asset) , credit debtors (asset reduction)
         lines = [
@@ -820,10 +1145,266 @@ class CustomerPayment(models.Model):
         self.save(update_fields=['journal_entry'])
 
         # no status on invoice? mark paid if fully paid
-        new_paid = paid_already + Decimal(self.amount)
-        if new_paid >= total_inv:
+        if item.residual <= 0:
             inv.status = inv.CONFIRMED if inv.status != inv.CONFIRMED else inv.status
             if hasattr(inv, 'PAID'):
                 inv.status = inv.PAID
             inv.save(update_fields=['status'])
         return je
+
+
+class OpenItem(models.Model):
+    """
+    One row per posted receivable (customer invoice) or payable (vendor bill)
+    holding what is still open on it. Posting a payment decrements `residual`
+    with a single filtered UPDATE, so the outstanding check and the write are
+    one atomic statement. Aging and outstanding lookups read this table.
+    """
+    RECEIVABLE = 'receivable'
+    PAYABLE = 'payable'
+    KIND_CHOICES = [(RECEIVABLE, 'Receivable'), (PAYABLE, 'Payable')]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    partner = models.ForeignKey('core.Contact', on_delete=models.PROTECT, related_name='open_items')
+    invoice = models.OneToOneField(CustomerInvoice, null=True, blank=True, on_delete=models.CASCADE, related_name='open_item')
+    bill = models.OneToOneField(VendorBill, null=True, blank=True, on_delete=models.CASCADE, related_name='open_item')
+    document_date = models.DateField()
+    due_date = models.DateField()   # the document's due date, or its date when it has none
+    amount = models.DecimalField(max_digits=18, decimal_places=2)
+    residual = models.DecimalField(max_digits=18, decimal_places=2)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['partner', 'kind']),
+            # aging / outstanding scans only ever look at items that are still open
+            models.Index(fields=['kind', 'due_date'], condition=models.Q(residual__gt=0), name='core_openitem_open_due_idx'),
+        ]
+        constraints = [
+            models.CheckConstraint(
+                condition=(models.Q(invoice__isnull=False, bill__isnull=True)
+                           | models.Q(invoice__isnull=True, bill__isnull=False)),
+                name='core_openitem_one_document',
+            ),
+        ]
+
+    def __str__(self):
+        doc = f"INV/{self.invoice_id}" if self.invoice_id else f"Bill/{self.bill_id}"
+        return f"{self.get_kind_display()} {doc} open {self.residual}"
+
+    @classmethod
+    def _invoice_fields(cls, invoice, posted):
+        return {
+            'kind': cls.RECEIVABLE,
+            'partner_id': invoice.customer_id,
+            'document_date': invoice.issue_date,
+            'due_date': invoice.due_date or invoice.issue_date,
+            'amount': invoice.grand_total,
+            'residual': invoice.grand_total - posted,
+        }
+
+    @classmethod
+    def _bill_fields(cls, bill):
+        return {
+            'kind': cls.PAYABLE,
+            'partner_id': bill.vendor_id,
+            'document_date': bill.bill_date,
+            'due_date': bill.due_date or bill.bill_date,
+            'amount': bill.total_amount,
+            'residual': bill.outstanding_amount,
+        }
+
+    @classmethod
+    def for_invoice(cls, invoice):
+        """Return the invoice's open item, creating it (from posted payments so far) on first use."""
+        item = cls.objects.filter(invoice=invoice).first()
+        if item is None:
+            posted = (invoice.payments.filter(journal_entry__isnull=False)
+                      .aggregate(total=Sum('amount'))['total'] or Decimal('0.00'))
+            item, _ = cls.objects.get_or_create(invoice=invoice, defaults=cls._invoice_fields(invoice, posted))
+        return item
+
+    @classmethod
+    def for_bill(cls, bill):
+        """Return the bill's open item, creating it from the bill's stored totals on first use."""
+        item, _ = cls.objects.get_or_create(bill=bill, defaults=cls._bill_fields(bill))
+        return item
+
+    @classmethod
+    def open_documents(cls, invoices=(), bills=()):
+        """
+        Bulk-create open items for freshly confirmed documents: one grouped
+        query for posted payments on the invoices, one INSERT per side. A
+        document that already has an item (a payment was posted against it
+        while it was a draft) gets that item refreshed from its confirmed totals.
+        """
+        refreshed = ['partner', 'document_date', 'due_date', 'amount', 'residual']
+        if invoices:
+            posted = dict(CustomerPayment.objects
+                          .filter(invoice__in=[inv.pk for inv in invoices], journal_entry__isnull=False)
+                          .order_by().values('invoice_id').annotate(total=Sum('amount'))
+                          .values_list('invoice_id', 'total'))
+            cls.objects.bulk_create(
+                [cls(invoice=inv, **cls._invoice_fields(inv, posted.get(inv.pk) or Decimal('0.00')))
+                 for inv in invoices],
+                update_conflicts=True, unique_fields=['invoice'], update_fields=refreshed)
+        if bills:
+            cls.objects.bulk_create([cls(bill=bill, **cls._bill_fields(bill)) for bill in bills],
+                                    update_conflicts=True, unique_fields=['bill'], update_fields=refreshed)
+
+    def consume(self, amount):
+        """
+        Atomically take `amount` off the residual. The UPDATE only matches while
+        residual >= amount, so concurrent payments cannot overpay the document.
+        """
+        if not OpenItem.objects.filter(pk=self.pk, residual__gte=amount).update(residual=F('residual') - amount):
+            self.refresh_from_db(fields=['residual'])
+            raise ValueError(f"Payment exceeds outstanding amount ({self.residual}).")
+        self.refresh_from_db(fields=['residual'])
+
+    def release(self, amount):
+        """Give `amount` back to the residual (a posted payment was removed)."""
+        OpenItem.objects.filter(pk=self.pk).update(residual=F('residual') + amount)
+        self.refresh_from_db(fields=['residual'])
+
+
+# --- Recurring invoices ---
+def add_months(d, months, day=None):
+    """ Shift date d by `months`, keeping `day` (default d.day) clamped to the month's length. """
+    month_index = d.month - 1 + months
+    year, month = d.year + month_index // 12, month_index % 12 + 1
+    return date(year, month, min(day or d.day, calendar.monthrange(year, month)[1]))
+
+
+class RecurringInvoice(models.Model):
+    """
+    A subscription-style template: the same lines invoiced to `customer` every
+    period. `manage.py run_recurring_invoices` bills every active template whose
+    next_run_date has come (see utils.run_recurring_invoices).
+    """
+    WEEKLY = 'weekly'
+    MONTHLY = 'monthly'
+    QUARTERLY = 'quarterly'
+    YEARLY = 'yearly'
+    CADENCE_CHOICES = [
+        (WEEKLY, 'Weekly'),
+        (MONTHLY, 'Monthly'),
+        (QUARTERLY, 'Quarterly'),
+        (YEARLY, 'Yearly'),
+    ]
+    CADENCE_MONTHS = {MONTHLY: 1, QUARTERLY: 3, YEARLY: 12}
+
+    customer = models.ForeignKey('core.Contact', on_delete=models.PROTECT, related_name='recurring_invoices')
+    name = models.CharField(max_length=200, blank=True)
+    cadence = models.CharField(max_length=20, choices=CADENCE_CHOICES, default=MONTHLY)
+    start_date = models.DateField(default=timezone.localdate)
+    next_run_date = models.DateField(default=timezone.localdate)
+    end_date = models.DateField(null=True, blank=True)
+    due_days = models.PositiveIntegerField(default=0, help_text="Invoice due date = issue date + this many days.")
+    auto_confirm = models.BooleanField(default=False, help_text="Post the generated invoices straight away.")
+    active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # the scheduler only ever scans active templates by next run date
+        indexes = [models.Index(fields=['active', 'next_run_date'])]
+
+    def __str__(self):
+        return self.name or f"Recurring/{self.pk} - {self.customer}"
+
+    def period_after(self, d):
+        """ The run date following d, anchored on start_date's day of month. """
+        if self.cadence == self.WEEKLY:
+            return d + timedelta(days=7)
+        return add_months(d, self.CADENCE_MONTHS[self.cadence], day=self.start_date.day)
+
+
+class RecurringInvoiceLine(models.Model):
+    template = models.ForeignKey(RecurringInvoice, related_name='lines', on_delete=models.CASCADE)
+    product = models.ForeignKey('core.Product', null=True, blank=True, on_delete=models.PROTECT)
+    qty = models.DecimalField(max_digits=12, decimal_places=2, default=1)
+    unit_price = models.DecimalField(max_digits=18, decimal_places=2, default=0)
+    tax_percent = models.DecimalField(max_digits=7, decimal_places=2, default=0)
+
+    def __str__(self):
+        return f"{self.product} x{self.qty} @ {self.unit_price}"
+
+
+class RecurringInvoiceRun(models.Model):
+    """
+    One row per (template, period) that has been billed. The unique constraint
+    makes a rerun of the same period (after a crash, or from two schedulers at
+    once) a no-op instead of a second invoice.
+    """
+    template = models.ForeignKey(RecurringInvoice, related_name='runs', on_delete=models.CASCADE)
+    period = models.DateField()
+    invoice = models.OneToOneField(CustomerInvoice, null=True, blank=True, related_name='recurring_run',
+                                   on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['template', 'period'], name='core_recurring_run_once')]
+
+    def __str__(self):
+        return f"{self.template} @ {self.period}"
+
+
+# --- Request idempotency ---
+class IdempotencyKey(models.Model):
+    """
+    A client-supplied key for a document-creating POST, stored with the
+    response it produced (and the object it created, when the view records
+    one). A retry with the same key gets the stored response back instead of
+    running the view again; see views.idempotent.
+    """
+    PENDING = 'pending'
+    DONE = 'done'
+    STATE_CHOICES = [(PENDING, 'Pending'), (DONE, 'Done')]
+
+    key = models.CharField(max_length=100)
+    scope = models.CharField(max_length=100)  # the view the key was used on
+    user_id = models.IntegerField(null=True, blank=True)
+    fingerprint = models.CharField(max_length=64)  # sha256 of the request payload
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=PENDING)
+
+    response_status = models.PositiveSmallIntegerField(null=True, blank=True)
+    response_content_type = models.CharField(max_length=100, blank=True)
+    response_location = models.CharField(max_length=500, blank=True)
+    response_body = models.TextField(blank=True)
+
+    content_type = models.ForeignKey(ContentType, null=True, blank=True, on_delete=models.SET_NULL)
+    object_id = models.PositiveIntegerField(null=True, blank=True)
+    created_object = GenericForeignKey('content_type', 'object_id')
+
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['scope', 'key'], name='core_idempotency_scope_key')]
+
+    def __str__(self):
+        return f"{self.scope}:{self.key} ({self.state})"
+
+    @classmethod
+    def claim(cls, scope, key, user_id, fingerprint, ttl):
+        """
+        Insert a pending row for (scope, key) and return (row, True), or return
+        (existing row, False) if the key was already used. Rows older than ttl
+        are dropped first so their keys can be reused.
+        """
+        cls.objects.filter(scope=scope, key=key, created_at__lt=timezone.now() - ttl).delete()
+        try:
+            with transaction.atomic():
+                return cls.objects.create(scope=scope, key=key, user_id=user_id, fingerprint=fingerprint), True
+        except IntegrityError:
+            return cls.objects.get(scope=scope, key=key), False
+
+    def complete(self, response, obj=None):
+        """ Store the view's response (and created object) and mark the key done. """
+        self.state = self.DONE
+        self.response_status = response.status_code
+        self.response_content_type = response.get('Content-Type', '')
+        self.response_location = response.get('Location', '')
+        self.response_body = '' if response.streaming else response.content.decode(response.charset or 'utf-8')
+        if obj is not None and obj.pk:
+            self.content_type = ContentType.objects.get_for_model(obj)
+            self.object_id = obj.pk
+        self.save()
@@ -0,0 +1,62 @@
+"""
+Line pricing shared by every document line model (vendor bill, sales order,
+customer invoice and purchase order lines).
+
+A line's tax is rounded to paise on its own, the line total is rounded once
+from net + rounded tax, and untaxed is whatever is left, so untaxed + tax ==
+total on every line. Document totals are plain sums of the rounded line
+amounts; nothing is re-rounded at document level, so a document always
+equals the sum of its lines.
+"""
+from collections import namedtuple
+from decimal import Decimal, InvalidOperation, ROUND_HALF_EVEN
+
+CENT = Decimal('0.01')
+ZERO = Decimal('0.00')
+HUNDRED = Decimal('100.00')
+# the rounding Decimal's default context has always applied to stored line amounts
+ROUNDING = ROUND_HALF_EVEN
+
+LineAmounts = namedtuple('LineAmounts', ['untaxed', 'tax', 'total'])
+
+
+def _dec(value):
+    try:
+        return Decimal(value or 0)
+    except (InvalidOperation, TypeError, ValueError):
+        return ZERO
+
+
+def price_line(qty, unit_price, tax_percent):
+    """ Return LineAmounts(untaxed, tax, total) for one line, rounded to paise. """
+    net = _dec(unit_price) * _dec(qty)
+    tax = (net * _dec(tax_percent) / HUNDRED).quantize(CENT, rounding=ROUNDING)
+    total = (net + tax).quantize(CENT, rounding=ROUNDING)
+    return LineAmounts(total - tax, tax, total)
+
+
+def price_lines(lines):
+    """ Price every line object (anything with qty / unit_price / tax_percent) in one pass. """
+    return [price_line(l.qty, l.unit_price, l.tax_percent) for l in lines]
+
+
+def document_totals(amounts):
+    """ Sum LineAmounts into the document's LineAmounts. """
+    untaxed = tax = total = ZERO
+    for a in amounts:
+        untaxed += a.untaxed
+        tax += a.tax
+        total += a.total
+    return LineAmounts(untaxed, tax, total)
+
+
+def apply_prices(lines):
+    """
+    Price the lines and store tax_amount / line_total on each of them (for line
+    models that keep those as fields); return the document totals.
+    """
+    amounts = price_lines(lines)
+    for line, a in zip(lines, amounts):
+        line.tax_amount = a.tax
+        line.line_total = a.total
+    return document_totals(amounts)
@@ -0,0 +1,23 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from .models import Account, Tax, JournalEntry, JournalLine
+from .utils import invalidate_master_data, bump_ledger_version
+
+
+@receiver([post_save, post_delete], sender=Account)
+@receiver([post_save, post_delete], sender=Tax)
+def master_data_changed(sender, **kwargs):
+    # drop the cached roles/taxes now (this process may read them before commit)
+    # and again once committed, so no process keeps a copy loaded in between
+    invalidate_master_data()
+    transaction.on_commit(invalidate_master_data)
+
+
+@receiver([post_save, post_delete], sender=JournalEntry)
+@receiver([post_save, post_delete], sender=JournalLine)
+def ledger_changed(sender, **kwargs):
+    # post_journal_entries() bulk-inserts (no signals) and bumps the version itself;
+    # this catches every other write, e.g. an entry or line deleted in the admin
+    bump_ledger_version()
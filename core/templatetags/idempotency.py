@@ -0,0 +1,15 @@
+import uuid
+
+from django import template
+from django.utils.html import format_html
+
+register = template.Library()
+
+
+@register.simple_tag
+def idempotency_key():
+    """
+    Hidden input with a fresh key for forms posting to an @idempotent view, so
+    a double submit of the same rendered form only runs once.
+    """
+    return format_html('<input type="hidden" name="idempotency_key" value="{}">', uuid.uuid4().hex)
@@ -1,3 +1,1272 @@
-from django.test import TestCase
+import json
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from urllib.parse import urlsplit
+from unittest import mock
 
-# Create your tests here.
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import connection, transaction
+from django.db.models import Max, ProtectedError, Sum
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import include, path
+
+from . import views
+from .gst_client import NO_ANSWER, GstApiClient
+from .gst_stub import GstStubServer
+from .hsn import _MappedTable, _MemoryTable, hsn_tax_index
+from .hsn_search import hsn_search_index
+from .models import (Account, AccountBalance, AccountDailyBalance, Contact, CustomerInvoice, CustomerInvoiceLine,
+                     CustomerPayment, DocumentSequence, IdempotencyKey, JournalEntry, JournalLine, OpenItem, Payment,
+                     Product, PurchaseOrder, PurchaseOrderLine, RecurringInvoice, RecurringInvoiceLine,
+                     RecurringInvoiceRun, SalesOrder, SalesOrderLine, Tax, User, VendorBill, VendorBillLine)
+from .pricing import LineAmounts, apply_prices, document_totals, price_line, price_lines
+from .utils import (MASTER_DATA_GENERATION_KEY, JournalError, active_taxes, cached_report, confirm_documents,
+                    invalidate_master_data, invoice_sales_orders, post_journal_entries, post_journal_entry,
+                    resolve_posting_accounts, run_recurring_invoices, select_draft_documents)
+
+# every alias in process memory, so tests never share state through files on disk
+TEST_CACHES = {
+    alias: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': f'test-{alias}'}
+    for alias in ('default', 'reports', 'masterdata', 'gst_api')
+}
+
+# customer_portal_pay has no route in core.urls (its path serves the Razorpay checkout),
+# so tests that call it mount it here for its redirects to resolve
+urlpatterns = [
+    path('portal/invoices/<int:invoice_id>/pay/manual/', views.customer_portal_pay, name='customer_portal_pay'),
+    path('', include('core.urls')),
+]
+
+
+@override_settings(CACHES=TEST_CACHES)
+class LedgerTestCase(TestCase):
+    """ Base case with the standard chart of accounts and one customer and vendor. """
+
+    ACCOUNTS = [
+        ('Cash A/c', 'asset'), ('Bank A/c', 'asset'), ('Debtors A/c', 'asset'),
+        ('Creditors A/c', 'liability'), ('Tax A/c', 'liability'),
+        ('Sales Income A/c', 'income'), ('Purchase Expense A/c', 'expense'),
+    ]
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.accounts = {name: Account.objects.create(name=name, account_type=kind) for name, kind in cls.ACCOUNTS}
+        cls.cash = cls.accounts['Cash A/c']
+        cls.bank = cls.accounts['Bank A/c']
+        cls.debtors = cls.accounts['Debtors A/c']
+        cls.creditors = cls.accounts['Creditors A/c']
+        cls.sales = cls.accounts['Sales Income A/c']
+        cls.purchase = cls.accounts['Purchase Expense A/c']
+        cls.customer = Contact.objects.create(name='Customer', contact_type=Contact.CUSTOMER, email='c@example.com')
+        cls.vendor = Contact.objects.create(name='Vendor', contact_type=Contact.VENDOR, email='v@example.com')
+
+    def setUp(self):
+        for alias in TEST_CACHES:
+            caches[alias].clear()
+        invalidate_master_data()
+
+    def invoice(self, amount, issue_date=date(2025, 1, 1), due_date=None, confirm=True, tax_percent=0):
+        """ A one-line customer invoice for amount (before tax), confirmed unless confirm=False. """
+        inv = CustomerInvoice.objects.create(customer=self.customer, issue_date=issue_date, due_date=due_date)
+        CustomerInvoiceLine.objects.create(invoice=inv, qty=1, unit_price=amount, tax_percent=tax_percent)
+        if confirm:
+            inv.confirm()
+        inv.refresh_from_db()
+        return inv
+
+    def bill(self, amount, bill_date=date(2025, 1, 1), due_date=None, confirm=True, tax_percent=0):
+        """ A one-line vendor bill for amount (before tax), confirmed unless confirm=False. """
+        bill = VendorBill.objects.create(vendor=self.vendor, bill_date=bill_date, due_date=due_date)
+        VendorBillLine.objects.create(bill=bill, qty=1, unit_price=amount, tax_percent=tax_percent)
+        if confirm:
+            bill.confirm()
+        bill.refresh_from_db()
+        return bill
+
+    def receive(self, invoice, amount, day=date(2025, 2, 1)):
+        """ Record and post a customer payment into the bank account. """
+        payment = CustomerPayment.objects.create(invoice=invoice, amount=amount, account=self.bank, date=day)
+        payment.post()
+        return payment
+
+    def pay(self, bill, amount, day=date(2025, 2, 1)):
+        """ Record and post a vendor payment from the bank account. """
+        payment = Payment.objects.create(bill=bill, amount=amount, account=self.bank, date=day)
+        payment.post()
+        return payment
+
+    def login(self, role='admin'):
+        """ Log the test client in as a new user with role. """
+        user = User.objects.create(username=f'user{User.objects.count()}', password='x', role=role)
+        session = self.client.session
+        session['user_id'] = user.pk
+        session.save()
+        return user
+
+    def post(self, day, debit, credit, amount, partner=None):
+        """ Post a two-line entry Dr debit / Cr credit for amount on day. """
+        return post_journal_entry(day, 'T', 'test', [
+            {'account': debit, 'debit': amount, 'partner': partner},
+            {'account': credit, 'credit': amount, 'partner': partner},
+        ])
+
+
+class PostJournalEntriesTests(LedgerTestCase):
+    def test_posts_balanced_entries_with_lines_and_source(self):
+        jes = post_journal_entries([
+            {'date': date(2025, 1, 5), 'ref': f'R{i}', 'narration': 'n', 'source': self.customer,
+             'lines': [{'account': self.cash.pk, 'debit': 5, 'partner': self.customer},
+                       {'account': self.sales, 'credit': '5.00'}]}
+            for i in range(3)
+        ])
+        self.assertEqual([je.ref for je in jes], ['R0', 'R1', 'R2'])
+        self.assertEqual(JournalLine.objects.count(), 6)
+        je = JournalEntry.objects.get(pk=jes[1].pk)
+        self.assertEqual(je.source, self.customer)
+        lines = list(je.lines.order_by('id').values_list('account_id', 'debit', 'credit', 'partner_id', 'date'))
+        self.assertEqual(lines, [
+            (self.cash.pk, Decimal('5.00'), Decimal('0.00'), self.customer.pk, date(2025, 1, 5)),
+            (self.sales.pk, Decimal('0.00'), Decimal('5.00'), None, date(2025, 1, 5)),
+        ])
+
+    def test_unbalanced_entry_writes_nothing(self):
+        entries = [
+            {'date': date(2025, 1, 5), 'lines': [{'account': self.cash, 'debit': 10},
+                                                 {'account': self.sales, 'credit': credit}]}
+            for credit in (10, 9)
+        ]
+        with self.assertRaises(JournalError):
+            post_journal_entries(entries)
+        self.assertFalse(JournalEntry.objects.exists())
+
+    def test_unknown_account_is_rejected(self):
+        with self.assertRaises(JournalError):
+            post_journal_entry(date(2025, 1, 5), 'R', 'n', [{'account': 999999, 'debit': 1},
+                                                              {'account': self.sales, 'credit': 1}])
+        self.assertFalse(JournalLine.objects.exists())
+
+
+class BalanceSheetTests(LedgerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.post(date(2025, 1, 5), self.cash, self.sales, 100)
+        self.post(date(2025, 2, 5), self.purchase, self.creditors, 30)
+
+    def test_current_balance_sheet_balances(self):
+        data = views._balance_sheet_data()
+        self.assertEqual(data['total_assets'], Decimal('100.00'))
+        self.assertEqual(data['net_profit'], Decimal('70.00'))
+        self.assertEqual(data['total_liabilities'], Decimal('30.00'))
+        self.assertEqual(data['total_assets'], data['total_liabilities_equity'])
+
+    def test_as_of_ignores_later_postings(self):
+        data = views._balance_sheet_data(date(2025, 1, 31))
+        self.assertEqual(data['total_assets'], Decimal('100.00'))
+        self.assertEqual(data['net_profit'], Decimal('100.00'))
+        self.assertEqual(data['liabilities'], [])
+
+
+class AccountBalanceTests(LedgerTestCase):
+    def ledger_totals(self):
+        return {
+            r['account_id']: (r['d'].quantize(Decimal('0.01')), r['c'].quantize(Decimal('0.01')), r['last'])
+            for r in JournalLine.objects.order_by().values('account_id').annotate(d=Sum('debit'), c=Sum('credit'),
+                                                                                   last=Max('id'))
+        }
+
+    def stored_totals(self):
+        return {b.account_id: (b.debit_total, b.credit_total, b.last_line_id) for b in AccountBalance.objects.all()}
+
+    def test_balances_follow_every_posting(self):
+        self.post(date(2025, 1, 5), self.cash, self.sales, Decimal('100.10'))
+        self.post(date(2025, 1, 6), self.purchase, self.cash, Decimal('30.05'))
+        post_journal_entries([
+            {'date': date(2025, 1, 7), 'lines': [{'account': self.bank, 'debit': 7},
+                                                 {'account': self.sales, 'credit': 7}]}
+            for _ in range(5)
+        ])
+        self.assertEqual(self.stored_totals(), self.ledger_totals())
+        self.assertEqual(self.cash.balance.amount, Decimal('70.05'))
+
+    def test_rebuild_repairs_drift(self):
+        self.post(date(2025, 1, 5), self.cash, self.sales, 100)
+        call_command('rebuild_account_balances', '--verify', stdout=StringIO())
+        AccountBalance.objects.filter(account=self.cash).update(debit_total=1)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_account_balances', '--verify', stdout=StringIO())
+        call_command('rebuild_account_balances', stdout=StringIO())
+        self.assertEqual(self.stored_totals(), self.ledger_totals())
+
+
+class DailyRollupTests(LedgerTestCase):
+    def test_rollup_groups_by_account_and_day(self):
+        for day in (date(2025, 1, 5), date(2025, 1, 5), date(2025, 2, 7)):
+            self.post(day, self.cash, self.sales, 100)
+        rows = set(AccountDailyBalance.objects.filter(account=self.cash).values_list('date', 'debit', 'credit'))
+        self.assertEqual(rows, {(date(2025, 1, 5), Decimal('200.00'), Decimal('0.00')),
+                                (date(2025, 2, 7), Decimal('100.00'), Decimal('0.00'))})
+
+    def test_profit_and_loss_reads_the_period_only(self):
+        self.post(date(2025, 1, 5), self.cash, self.sales, 100)
+        self.post(date(2025, 1, 9), self.purchase, self.cash, 30)
+        self.post(date(2025, 2, 7), self.cash, self.sales, 500)
+        data = views._profit_and_loss_data(date(2025, 1, 1), date(2025, 1, 31))
+        self.assertEqual((data['total_income'], data['total_expenses'], data['net']),
+                         (Decimal('100.00'), Decimal('30.00'), Decimal('70.00')))
+
+    def test_verify_checks_the_rollup(self):
+        self.post(date(2025, 1, 5), self.cash, self.sales, 100)
+        AccountDailyBalance.objects.filter(account=self.cash).update(debit=5)
+        with self.assertRaises(CommandError):
+            call_command('rebuild_account_balances', '--verify', stdout=StringIO())
+        call_command('rebuild_account_balances', stdout=StringIO())
+        call_command('rebuild_account_balances', '--verify', stdout=StringIO())
+
+
+class JournalLineIndexTests(LedgerTestCase):
+    def test_default_ordering_needs_no_join(self):
+        self.post(date(2025, 1, 6), self.cash, self.sales, 1)
+        self.post(date(2025, 1, 5), self.cash, self.sales, 2)
+        sql = str(JournalLine.objects.filter(account=self.cash).query)
+        self.assertNotIn('JOIN', sql)
+        self.assertEqual([l.date for l in JournalLine.objects.filter(account=self.cash)],
+                         [date(2025, 1, 5), date(2025, 1, 6)])
+
+    def test_covering_indexes_exist(self):
+        with connection.cursor() as cursor:
+            constraints = connection.introspection.get_constraints(cursor, JournalLine._meta.db_table)
+        indexed = {tuple(c['columns']) for c in constraints.values() if c['index']}
+        for columns in (('account_id', 'date'), ('partner_id', 'date'), ('entry_id', 'account_id')):
+            self.assertIn(columns, indexed)
+
+
+class PartnerLedgerTests(LedgerTestCase):
+    def setUp(self):
+        super().setUp()
+        # two lines per day, so pages break inside a date
+        for i in range(12):
+            self.post(date(2025, 1, 1 + i // 2), self.debtors, self.sales, 10 + i, partner=self.customer)
+
+    def test_keyset_pages_cover_every_line_once(self):
+        qs = views._partner_ledger_queryset(self.customer)
+        seen, cursor, balance = [], None, Decimal('0.00')
+        while True:
+            page = views._partner_ledger_page(qs, None, None, cursor, 5)
+            self.assertEqual(page['opening_balance'], balance)
+            seen += [row['id'] for row in page['rows']]
+            balance = page['closing_balance']
+            if not page['next_cursor']:
+                break
+            cursor = views._parse_ledger_cursor(page['next_cursor'])
+        lines = list(JournalLine.objects.filter(partner=self.customer).order_by('date', 'id'))
+        self.assertEqual(seen, [l.pk for l in lines])
+        self.assertEqual(balance, sum((l.debit - l.credit for l in lines), Decimal('0.00')))
+
+    def test_csv_export_streams_the_range(self):
+        request = RequestFactory().get('/', {'start': '2025-01-03', 'format': 'csv'})
+        response = views.partner_ledger(request, self.customer.pk)
+        rows = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(rows[0], 'date,ref,account,debit,credit,balance')
+        # opening balance row: the four entries of Jan 1-2 net to zero for this partner
+        self.assertTrue(rows[1].startswith(',Opening balance,'))
+        self.assertEqual(Decimal(rows[1].rsplit(',', 1)[1]), 0)
+        self.assertEqual(len(rows), 2 + 16)
+
+
+class TrialBalanceTests(LedgerTestCase):
+    def setUp(self):
+        super().setUp()
+        for day in (date(2024, 12, 5), date(2025, 1, 5), date(2025, 2, 7)):
+            self.post(day, self.cash, self.sales, 100)
+
+    def test_opening_period_closing_and_comparison(self):
+        data = views._trial_balance_data(date(2025, 1, 1), date(2025, 1, 31), [(date(2025, 2, 1), date(2025, 2, 28))])
+        cash = next(r for r in data['rows'] if r['account_id'] == self.cash.pk)
+        self.assertEqual((cash['opening'], cash['debit'], cash['credit'], cash['closing']),
+                         (Decimal('100.00'), Decimal('100.00'), Decimal('0.00'), Decimal('200.00')))
+        self.assertEqual(cash['compare'], [{'debit': Decimal('100.00'), 'credit': Decimal('0.00'),
+                                            'closing': Decimal('300.00')}])
+        totals = data['totals']
+        self.assertEqual((totals['opening'], totals['closing']), (Decimal('0.00'), Decimal('0.00')))
+        self.assertEqual(totals['debit'], totals['credit'])
+
+    def test_json_endpoint_skips_bad_compare_periods(self):
+        self.login()
+        data = self.client.get('/reports/trial-balance.json', {'start': '2025-01-01', 'end': '2025-01-31',
+                                                               'compare': ['2025-02-01:2025-02-28', 'bad']}).json()
+        self.assertEqual(len(data['compare_periods']), 1)
+        self.assertEqual(data['totals']['debit'], '100.00')
+
+    def test_reports_need_login(self):
+        for url in ('/reports/trial-balance/', '/reports/trial-balance.json'):
+            self.assertRedirects(self.client.get(url), '/login/', fetch_redirect_response=False)
+
+
+class ReportCacheTests(LedgerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.calls = 0
+        self.post(date(2025, 1, 5), self.cash, self.sales, 100)
+
+    def report(self):
+        def compute():
+            self.calls += 1
+            return self.calls
+        return cached_report('test', {'start': date(2025, 1, 1)}, compute)
+
+    def assertInvalidatedBy(self, write):
+        first = self.report()
+        self.assertEqual(self.report(), first)
+        write()
+        self.assertEqual(self.report(), first + 1)
+
+    def test_posting_invalidates(self):
+        self.assertInvalidatedBy(lambda: self.post(date(2025, 1, 6), self.cash, self.sales, 5))
+
+    def test_line_and_entry_edits_outside_posting_invalidate(self):
+        self.assertInvalidatedBy(lambda: JournalLine.objects.filter(account=self.cash).first().save())
+        self.assertInvalidatedBy(lambda: JournalLine.objects.filter(account=self.cash).first().delete())
+        self.assertInvalidatedBy(lambda: JournalEntry.objects.first().delete())
+
+    def test_balance_rebuild_invalidates(self):
+        self.assertInvalidatedBy(lambda: call_command('rebuild_account_balances', stdout=StringIO()))
+
+    def test_cached_view_sees_new_postings(self):
+        self.login()
+        params = {'start': '2025-01-01', 'end': '2025-01-31'}
+        before = self.client.get('/reports/trial-balance.json', params).content
+        self.assertEqual(self.client.get('/reports/trial-balance.json', params).content, before)
+        self.post(date(2025, 1, 6), self.cash, self.sales, 5)
+        after = self.client.get('/reports/trial-balance.json', params).json()
+        self.assertEqual(after['totals']['debit'], '105.00')
+
+
+class JournalLinePartnerTests(LedgerTestCase):
+    def test_partner_accepts_contact_or_pk(self):
+        self.post(date(2025, 1, 5), self.debtors, self.sales, 10, partner=self.customer)
+        self.post(date(2025, 1, 5), self.purchase, self.creditors, 10, partner=self.vendor.pk)
+        self.assertEqual(self.customer.journal_lines.count(), 2)
+        self.assertEqual(set(self.vendor.journal_lines.values_list('account_id', flat=True)),
+                         {self.purchase.pk, self.creditors.pk})
+
+    def test_contact_with_ledger_lines_is_protected(self):
+        self.post(date(2025, 1, 5), self.debtors, self.sales, 10, partner=self.customer)
+        with self.assertRaises(ProtectedError):
+            self.customer.delete()
+
+
+class AgingReportTests(LedgerTestCase):
+    AS_OF = date(2025, 6, 30)
+
+    def test_buckets_by_days_past_due(self):
+        self.invoice(100, due_date=self.AS_OF)                              # current
+        part = self.invoice(50, due_date=self.AS_OF - timedelta(days=1))    # 1-30, 30 still open
+        self.receive(part, 20)
+        self.invoice(70, due_date=self.AS_OF - timedelta(days=45))          # 31-60
+        self.invoice(10, due_date=self.AS_OF - timedelta(days=200))         # 90+
+        paid = self.invoice(10, due_date=self.AS_OF - timedelta(days=200))  # settled, not listed
+        self.receive(paid, 10)
+
+        [row] = views._iter_aging_rows('customers', self.AS_OF)
+        self.assertEqual(row['partner_id'], self.customer.pk)
+        self.assertEqual(row['documents'], 4)
+        self.assertEqual((row['current'], row['d1_30'], row['d31_60'], row['d61_90'], row['d90_plus']),
+                         (Decimal('100.00'), Decimal('30.00'), Decimal('70.00'), Decimal('0.00'), Decimal('10.00')))
+        self.assertEqual(row['outstanding'], Decimal('210.00'))
+
+    def test_payables_side_and_undated_documents(self):
+        self.bill(40, due_date=self.AS_OF - timedelta(days=61))
+        # no due date: ages from the bill date
+        self.bill(5, bill_date=self.AS_OF - timedelta(days=10))
+        [row] = views._iter_aging_rows('vendors', self.AS_OF)
+        self.assertEqual((row['d1_30'], row['d61_90'], row['outstanding']),
+                         (Decimal('5.00'), Decimal('40.00'), Decimal('45.00')))
+        self.assertEqual(list(views._iter_aging_rows('customers', self.AS_OF)), [])
+
+    def test_documents_after_as_of_are_left_out(self):
+        self.invoice(100, issue_date=date(2025, 7, 1))
+        self.assertEqual(list(views._iter_aging_rows('customers', self.AS_OF)), [])
+
+
+class DocumentSequenceTests(LedgerTestCase):
+    def new_invoice(self, issue_date=date(2025, 4, 1)):
+        return CustomerInvoice.objects.create(customer=self.customer, issue_date=issue_date)
+
+    def test_numbers_have_no_gaps_or_duplicates(self):
+        numbers = [self.new_invoice().number for _ in range(5)]
+        numbers += CustomerInvoice.reserve_numbers(2025, 3)
+        numbers.append(self.new_invoice().number)
+        self.assertEqual(numbers, [f'INV/2025/{n:04d}' for n in range(1, 10)])
+        # each year has its own sequence
+        self.assertEqual(self.new_invoice(date(2026, 1, 1)).number, 'INV/2026/0001')
+
+    def test_rolled_back_document_gives_its_number_back(self):
+        self.new_invoice()
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                self.new_invoice()
+                raise RuntimeError
+        self.assertEqual(self.new_invoice().number, 'INV/2025/0002')
+
+    def test_sequence_continues_after_existing_numbers(self):
+        CustomerInvoice.objects.create(customer=self.customer, number='INV/2025/0007', issue_date=date(2025, 3, 1))
+        self.assertEqual(self.new_invoice().number, 'INV/2025/0008')
+
+    def test_purchase_order_numbers(self):
+        PurchaseOrder.objects.create(vendor=self.vendor, po_number='PO/2025/0003-1',
+                                     reference_id='REQ-20250301-0002', po_date=date(2025, 3, 1))
+        first = PurchaseOrder.objects.create(vendor=self.vendor, po_date=date(2025, 3, 1))
+        second = PurchaseOrder.objects.create(vendor=self.vendor, po_date='2025-03-01')
+        self.assertEqual((first.po_number, first.reference_id), ('PO/2025/0004', 'REQ-20250301-0003'))
+        self.assertEqual((second.po_number, second.reference_id), ('PO/2025/0005', 'REQ-20250301-0004'))
+
+    def test_reserve_rejects_empty_blocks(self):
+        with self.assertRaises(ValueError):
+            DocumentSequence.reserve('INV', 2025, count=0)
+
+
+class InvoiceTotalsTests(LedgerTestCase):
+    def test_totals_follow_lines(self):
+        inv = CustomerInvoice.objects.create(customer=self.customer)
+        CustomerInvoiceLine.objects.create(invoice=inv, qty=2, unit_price=50, tax_percent=18)
+        line = CustomerInvoiceLine.objects.create(invoice=inv, qty=1, unit_price=10)
+        inv.refresh_from_db()
+        self.assertEqual((inv.untaxed_total, inv.tax_total, inv.grand_total, inv.amount_due),
+                         (Decimal('110.00'), Decimal('18.00'), Decimal('128.00'), Decimal('128.00')))
+        line.delete()
+        inv.refresh_from_db()
+        self.assertEqual((inv.grand_total, inv.amount_due), (Decimal('118.00'), Decimal('118.00')))
+
+    def test_only_posted_payments_count_as_paid(self):
+        inv = self.invoice(100)
+        payment = CustomerPayment.objects.create(invoice=inv, amount=30, account=self.bank)
+        inv.refresh_from_db()
+        self.assertEqual((inv.amount_paid, inv.amount_due), (Decimal('0.00'), Decimal('100.00')))
+        payment.post()
+        inv.refresh_from_db()
+        self.assertEqual((inv.amount_paid, inv.amount_due), (Decimal('30.00'), Decimal('70.00')))
+        payment.delete()
+        inv.refresh_from_db()
+        self.assertEqual((inv.amount_paid, inv.amount_due), (Decimal('0.00'), Decimal('100.00')))
+
+    def test_recompute_command_ignores_unposted_payments(self):
+        inv = self.invoice(100)
+        self.receive(inv, 30)
+        CustomerPayment.objects.create(invoice=inv, amount=50, account=self.bank)
+        call_command('recompute_invoice_totals', '--verify', stdout=StringIO())
+        CustomerInvoice.objects.filter(pk=inv.pk).update(amount_paid=80, amount_due=20)
+        with self.assertRaises(CommandError):
+            call_command('recompute_invoice_totals', '--verify', stdout=StringIO())
+        call_command('recompute_invoice_totals', stdout=StringIO())
+        inv.refresh_from_db()
+        self.assertEqual((inv.amount_paid, inv.amount_due), (Decimal('30.00'), Decimal('70.00')))
+
+    def test_admin_cannot_edit_stored_totals(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        form = admin.site._registry[CustomerInvoice].get_form(request)
+        self.assertFalse({'untaxed_total', 'tax_total', 'grand_total', 'amount_paid', 'amount_due'}
+                         & set(form.base_fields))
+
+
+class VendorBillTotalsTests(LedgerTestCase):
+    def test_totals_follow_lines_and_posted_payments(self):
+        bill = VendorBill.objects.create(vendor=self.vendor)
+        VendorBillLine.objects.create(bill=bill, qty=2, unit_price=50, tax_percent=18)
+        line = VendorBillLine.objects.create(bill=bill, qty=1, unit_price=10)
+        line.qty = 3
+        line.save()
+        bill.refresh_from_db()
+        self.assertEqual((bill.total_amount, bill.outstanding_amount), (Decimal('148.00'), Decimal('148.00')))
+
+        bill.confirm()
+        payment = Payment.objects.create(bill=bill, amount=30, account=self.bank)
+        bill.refresh_from_db()
+        self.assertEqual(bill.paid_amount, Decimal('0.00'))
+        payment.post()
+        bill.refresh_from_db()
+        self.assertEqual((bill.paid_amount, bill.outstanding_amount), (Decimal('30.00'), Decimal('118.00')))
+        payment.delete()
+        bill.refresh_from_db()
+        self.assertEqual((bill.paid_amount, bill.outstanding_amount), (Decimal('0.00'), Decimal('148.00')))
+
+    def test_stored_totals_match_live_annotation(self):
+        bill = self.bill(100, tax_percent=5)
+        self.pay(bill, 40)
+        self.bill(7, confirm=False)
+        for b in VendorBill.objects.with_totals():
+            self.assertEqual((b.total_amount, b.paid_amount, b.outstanding_amount),
+                             (b.lines_total, b.payments_total, b.balance))
+        self.pay(bill, 65)
+        self.assertEqual(list(VendorBill.objects.outstanding().values_list('total_amount', flat=True)),
+                         [Decimal('7.00')])
+
+    def test_recompute_command_repairs_drift(self):
+        bill = self.bill(100)
+        self.pay(bill, 25)
+        VendorBill.objects.filter(pk=bill.pk).update(paid_amount=0)
+        with self.assertRaises(CommandError):
+            call_command('recompute_bill_totals', '--verify', stdout=StringIO())
+        call_command('recompute_bill_totals', stdout=StringIO())
+        call_command('recompute_bill_totals', '--verify', stdout=StringIO())
+        bill.refresh_from_db()
+        self.assertEqual((bill.paid_amount, bill.outstanding_amount), (Decimal('25.00'), Decimal('75.00')))
+
+    def test_admin_cannot_edit_stored_totals(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        form = admin.site._registry[VendorBill].get_form(request)
+        self.assertFalse({'total_amount', 'paid_amount', 'outstanding_amount'} & set(form.base_fields))
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class OpenItemTests(LedgerTestCase):
+    AS_OF = date(2025, 6, 30)
+
+    def portal_request(self, data, **kwargs):
+        request = RequestFactory().post('/', data, **kwargs)
+        request.session = SessionStore()
+        request.session['customer_id'] = self.customer.pk
+        request._messages = FallbackStorage(request)
+        return request
+
+    def residual(self, document):
+        field = 'invoice' if isinstance(document, CustomerInvoice) else 'bill'
+        return OpenItem.objects.get(**{field: document}).residual
+
+    def test_deleting_a_posted_payment_releases_the_residual(self):
+        inv, bill = self.invoice(100), self.bill(40)
+        received, paid = self.receive(inv, 30), self.pay(bill, 15)
+        self.assertEqual((self.residual(inv), self.residual(bill)), (Decimal('70.00'), Decimal('25.00')))
+        CustomerPayment.objects.create(invoice=inv, amount=5, account=self.bank).delete()  # never posted
+        received.delete()
+        paid.delete()
+        self.assertEqual((self.residual(inv), self.residual(bill)), (Decimal('100.00'), Decimal('40.00')))
+
+    def test_overpayment_is_refused(self):
+        inv = self.invoice(100)
+        self.receive(inv, 60)
+        with self.assertRaises(ValueError):
+            self.receive(inv, 50)
+        self.assertEqual(self.residual(inv), Decimal('40.00'))
+        # refused before the row is written, so no unposted payment is left behind
+        self.assertEqual(inv.payments.count(), 1)
+        bill = self.bill(100)
+        with self.assertRaises(ValueError):
+            Payment.objects.create(bill=bill, amount=101, account=self.bank)
+        self.assertFalse(bill.payments.exists())
+
+    def test_aging_adds_back_payments_after_as_of(self):
+        inv = self.invoice(100, due_date=self.AS_OF - timedelta(days=10))
+        self.receive(inv, 40, day=date(2025, 7, 15))
+        [row] = views._iter_aging_rows('customers', self.AS_OF)
+        self.assertEqual((row['d1_30'], row['outstanding']), (Decimal('100.00'), Decimal('100.00')))
+        [row] = views._iter_aging_rows('customers', date(2025, 7, 31))
+        self.assertEqual(row['outstanding'], Decimal('60.00'))
+
+    def test_drafts_stay_out_of_aging_until_confirmed(self):
+        draft = self.invoice(100, due_date=self.AS_OF, confirm=False)
+        self.receive(draft, 30)  # opens an item on the draft
+        self.assertEqual(list(views._iter_aging_rows('customers', self.AS_OF)), [])
+        CustomerInvoiceLine.objects.create(invoice=draft, qty=1, unit_price=50)
+        draft.confirm()
+        # confirming refreshes the item from the confirmed totals
+        item = OpenItem.objects.get(invoice=draft)
+        self.assertEqual((item.amount, item.residual), (Decimal('150.00'), Decimal('120.00')))
+        [row] = views._iter_aging_rows('customers', self.AS_OF)
+        self.assertEqual(row['outstanding'], Decimal('120.00'))
+
+    def test_portal_pay_checks_the_open_item(self):
+        inv = self.invoice(100)
+        self.receive(inv, 30)
+        # a stale stored amount_due must not let the portal overpay
+        CustomerInvoice.objects.filter(pk=inv.pk).update(amount_due=500)
+        views.customer_portal_pay(self.portal_request({'amount': '80', 'account_id': self.bank.pk}), inv.pk)
+        self.assertEqual(inv.payments.count(), 1)
+        views.customer_portal_pay(self.portal_request({'amount': '70', 'account_id': self.bank.pk}), inv.pk)
+        self.assertEqual(self.residual(inv), Decimal('0.00'))
+
+    def test_razorpay_verify_defaults_to_the_residual(self):
+        inv = self.invoice(100)
+        self.receive(inv, 30)
+        CustomerInvoice.objects.filter(pk=inv.pk).update(amount_due=500)
+        body = json.dumps({'razorpay_payment_id': 'pay_1', 'razorpay_order_id': 'order_1', 'razorpay_signature': 's'})
+        with mock.patch.object(views.client.utility, 'verify_payment_signature'), \
+                mock.patch.object(views.client.payment, 'fetch', return_value={}):
+            response = views.portal_invoice_razorpay_verify(
+                self.portal_request(body, content_type='application/json'), inv.pk)
+        self.assertEqual(json.loads(response.content)['message'], 'recorded')
+        self.assertEqual(inv.payments.get(reference='pay_1').amount, Decimal('70.00'))
+        self.assertEqual(self.residual(inv), Decimal('0.00'))
+
+
+class ConfirmDocumentsTests(LedgerTestCase):
+    def journal(self, document):
+        return set(document.journal_entry.lines.values_list('account_id', 'debit', 'credit'))
+
+    def test_bill_journal_posts_the_stored_rounded_total(self):
+        bill = VendorBill.objects.create(vendor=self.vendor)
+        # each line: net 0.125, tax 0.0225 -> 0.02, total 0.145 -> 0.14 (untaxed 0.12)
+        VendorBillLine.objects.bulk_create([VendorBillLine(bill=bill, qty=Decimal('0.5'), unit_price=Decimal('0.25'),
+                                                           tax_percent=18) for _ in range(2)])
+        bill.confirm()
+        bill.refresh_from_db()
+        self.assertEqual(bill.total_amount, Decimal('0.28'))
+        self.assertEqual(self.journal(bill), {
+            (self.purchase.pk, Decimal('0.24'), Decimal('0.00')),
+            (self.accounts['Tax A/c'].pk, Decimal('0.04'), Decimal('0.00')),
+            (self.creditors.pk, Decimal('0.00'), Decimal('0.28')),
+        })
+
+    def test_invoice_journal_posts_the_stored_totals(self):
+        inv = self.invoice(Decimal('10.125'), tax_percent=18)
+        self.assertEqual(self.journal(inv), {
+            (self.debtors.pk, inv.grand_total, Decimal('0.00')),
+            (self.sales.pk, Decimal('0.00'), inv.untaxed_total),
+            (self.accounts['Tax A/c'].pk, Decimal('0.00'), inv.tax_total),
+        })
+
+    def test_batch_confirm_skips_documents_that_cannot_post(self):
+        good = [self.invoice(10 + i, confirm=False) for i in range(3)]
+        empty = CustomerInvoice.objects.create(customer=self.customer)
+        bills = [self.bill(5, confirm=False) for _ in range(2)]
+        result = confirm_documents(*select_draft_documents('all'), chunk_size=2)
+        self.assertEqual({(r['type'], r['id']) for r in result['confirmed']},
+                         {('invoice', inv.pk) for inv in good} | {('bill', b.pk) for b in bills})
+        self.assertEqual([(r['type'], r['id']) for r in result['failed']], [('invoice', empty.pk)])
+        self.assertEqual(OpenItem.objects.count(), 5)
+        self.assertEqual(CustomerInvoice.objects.get(pk=empty.pk).status, CustomerInvoice.DRAFT)
+        call_command('rebuild_account_balances', '--verify', stdout=StringIO())
+
+    def test_batch_view_filters_and_needs_an_admin(self):
+        bills = [self.bill(5, bill_date=date(2025, 1, d), confirm=False) for d in (5, 20)]
+        inv = self.invoice(10, issue_date=date(2025, 1, 20), confirm=False)
+        self.login(role='invoicing')
+        url = '/api/documents/confirm/'
+        self.assertEqual(self.client.post(url, '{}', content_type='application/json').status_code, 403)
+        self.login()
+        self.assertEqual(self.client.post(url, '{"kind": "x"}', content_type='application/json').status_code, 400)
+        response = self.client.post(url, {'kind': 'bills', 'start': '2025-01-10'}, content_type='application/json')
+        self.assertEqual([(r['type'], r['id']) for r in response.json()['confirmed']], [('bill', bills[1].pk)])
+        self.assertEqual(CustomerInvoice.objects.get(pk=inv.pk).status, CustomerInvoice.DRAFT)
+
+    def test_command_confirms_and_reports_failures(self):
+        self.invoice(10, confirm=False)
+        CustomerInvoice.objects.create(customer=self.customer)
+        out = StringIO()
+        call_command('confirm_documents', '--dry-run', stdout=out)
+        self.assertIn('2 draft invoice(s) would be confirmed', out.getvalue())
+        call_command('confirm_documents', '--kind', 'invoices', stdout=out)
+        self.assertIn('Confirmed 1 document(s); 1 failed.', out.getvalue())
+        self.assertEqual(JournalEntry.objects.get().created_by, 'confirm_documents')
+
+    def test_confirmed_documents_are_not_posted_twice(self):
+        inv = self.invoice(10)
+        with self.assertRaises(ValueError):
+            inv.confirm()
+        self.assertEqual(confirm_documents(*select_draft_documents('invoices')), {'confirmed': [], 'failed': []})
+        self.assertEqual(JournalEntry.objects.count(), 1)
+
+
+class SalesOrderInvoicingTests(LedgerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.other = Contact.objects.create(name='Other', contact_type=Contact.CUSTOMER)
+
+    def order(self, customer=None, status='confirmed', prices=(100,)):
+        so = SalesOrder.objects.create(customer=customer or self.customer, status=status)
+        for price in prices:
+            SalesOrderLine.objects.create(order=so, qty=1, unit_price=price, tax_percent=18)
+        return so
+
+    def test_one_invoice_per_confirmed_order(self):
+        orders = [self.order(prices=(100, 50)), self.order(customer=self.other)]
+        draft = self.order(status='draft')
+        invoices = invoice_sales_orders(SalesOrder.objects.all(), issue_date=date(2025, 3, 1))
+        self.assertEqual(len(invoices), 2)
+        self.assertEqual(len({inv.number for inv in invoices}), 2)
+        first = CustomerInvoice.objects.get(pk=invoices[0].pk)
+        self.assertEqual((first.untaxed_total, first.tax_total, first.grand_total, first.amount_due),
+                         (Decimal('150.00'), Decimal('27.00'), Decimal('177.00'), Decimal('177.00')))
+        self.assertEqual(first.lines.count(), 2)
+        for so in orders:
+            so.refresh_from_db()
+            self.assertEqual(so.status, 'invoiced')
+        self.assertEqual(SalesOrder.objects.get(pk=draft.pk).invoice_id, None)
+        self.assertEqual(invoice_sales_orders(SalesOrder.objects.all()), [])
+
+    def test_merge_puts_a_customers_orders_on_one_invoice(self):
+        self.order(), self.order(prices=(10,)), self.order(customer=self.other)
+        invoices = invoice_sales_orders(SalesOrder.objects.all(), merge=True)
+        self.assertEqual(sorted(inv.lines.count() for inv in invoices), [1, 2])
+        merged = next(inv for inv in invoices if inv.customer_id == self.customer.pk)
+        self.assertEqual(merged.sales_orders.count(), 2)
+        self.assertEqual(CustomerInvoice.objects.get(pk=merged.pk).grand_total, Decimal('129.80'))
+
+    def test_view_invoices_a_confirmed_order_once(self):
+        so = self.order()
+        response = self.client.post(f'/sales/order/{so.pk}/create-invoice/')
+        so.refresh_from_db()
+        self.assertRedirects(response, f'/invoices/{so.invoice_id}/', fetch_redirect_response=False)
+        again = self.client.post(f'/sales/order/{so.pk}/create-invoice/')
+        self.assertEqual(again['Location'], response['Location'])
+        self.assertEqual(CustomerInvoice.objects.count(), 1)
+
+    def test_view_refuses_an_unconfirmed_order(self):
+        so = self.order(status='draft')
+        response = self.client.post(f'/sales/order/{so.pk}/create-invoice/')
+        self.assertRedirects(response, f'/sales/orders/{so.pk}/', fetch_redirect_response=False)
+        self.assertFalse(CustomerInvoice.objects.exists())
+
+    def test_bulk_view_merges_selected_orders(self):
+        orders = [self.order(), self.order(), self.order(customer=self.other)]
+        self.login()
+        response = self.client.post('/sales/orders/invoice/', {'orders': [o.pk for o in orders[:2]], 'merge': '1'})
+        self.assertRedirects(response, '/sales/orders/', fetch_redirect_response=False)
+        self.assertEqual(CustomerInvoice.objects.count(), 1)
+        self.assertEqual(SalesOrder.objects.filter(status='confirmed').get().pk, orders[2].pk)
+
+    def test_bulk_view_needs_an_admin_and_a_selection(self):
+        so = self.order()
+        response = self.client.post('/sales/orders/invoice/', {'orders': [so.pk]})
+        self.assertRedirects(response, '/login/', fetch_redirect_response=False)
+        self.login(role='invoicing')
+        self.client.post('/sales/orders/invoice/', {'orders': [so.pk]})
+        self.login()
+        # an empty selection no longer means every open order
+        self.client.post('/sales/orders/invoice/', {})
+        self.assertFalse(CustomerInvoice.objects.exists())
+
+    def test_command_invoices_every_open_order(self):
+        self.order(), self.order(customer=self.other), self.order(status='draft')
+        out = StringIO()
+        call_command('invoice_sales_orders', '--dry-run', stdout=out)
+        self.assertIn('2 sales order(s) would be invoiced', out.getvalue())
+        call_command('invoice_sales_orders', '--merge', '--issue-date', '2025-03-01', stdout=out)
+        self.assertEqual(list(CustomerInvoice.objects.values_list('issue_date', flat=True)), [date(2025, 3, 1)] * 2)
+
+
+class PricingTests(LedgerTestCase):
+    def test_tax_and_total_are_rounded_once_per_line(self):
+        # net 0.125: tax 0.0225 -> 0.02, total 0.145 -> 0.14 (half-even), untaxed is the rest
+        self.assertEqual(price_line(Decimal('0.5'), Decimal('0.25'), 18),
+                         LineAmounts(Decimal('0.12'), Decimal('0.02'), Decimal('0.14')))
+        self.assertEqual(price_line(3, Decimal('33.33'), Decimal('12.5')),
+                         LineAmounts(Decimal('99.99'), Decimal('12.50'), Decimal('112.49')))
+        self.assertEqual(price_line(None, '', None), LineAmounts(Decimal('0.00'), Decimal('0.00'), Decimal('0.00')))
+
+    def test_document_equals_the_sum_of_its_lines(self):
+        lines = [VendorBillLine(qty=Decimal('0.5'), unit_price=Decimal('0.25'), tax_percent=18) for _ in range(3)]
+        totals = apply_prices(lines)
+        self.assertEqual(totals, document_totals(price_lines(lines)))
+        self.assertEqual(totals.total, sum(l.line_total for l in lines))
+        self.assertEqual(totals.untaxed + totals.tax, totals.total)
+        self.assertEqual([l.tax_amount for l in lines], [Decimal('0.02')] * 3)
+
+    def test_bulk_created_lines_are_priced_and_totalled(self):
+        inv = CustomerInvoice.objects.create(customer=self.customer)
+        bill = VendorBill.objects.create(vendor=self.vendor)
+        CustomerInvoiceLine.objects.bulk_create(
+            [CustomerInvoiceLine(invoice=inv, qty=Decimal('0.5'), unit_price=Decimal('0.25'), tax_percent=18)
+             for _ in range(2)])
+        VendorBillLine.objects.bulk_create(
+            [VendorBillLine(bill=bill, qty=2, unit_price=Decimal('10.05'), tax_percent=5) for _ in range(2)])
+        inv.refresh_from_db()
+        bill.refresh_from_db()
+        self.assertEqual((inv.untaxed_total, inv.tax_total, inv.grand_total), (Decimal('0.24'), Decimal('0.04'),
+                                                                             Decimal('0.28')))
+        self.assertEqual(set(inv.lines.values_list('tax_amount', 'line_total')), {(Decimal('0.02'), Decimal('0.14'))})
+        # 20.10 + 1.005 -> 1.00 tax per line
+        self.assertEqual(bill.total_amount, Decimal('42.20'))
+
+    def test_purchase_order_lines_use_the_same_pricing(self):
+        product = Product.objects.create(name='Chair', hsn='9401')
+        po = PurchaseOrder.objects.create(vendor=self.vendor)
+        PurchaseOrderLine.objects.bulk_create([
+            PurchaseOrderLine(order=po, product=product, qty=Decimal('0.5'), unit_price=Decimal('0.25'),
+                              tax_percent=18),
+            PurchaseOrderLine(order=po, qty=3, unit_price=Decimal('33.33'), tax_percent=Decimal('12.5')),
+        ])
+        po.recompute_totals()
+        po.refresh_from_db()
+        self.assertEqual((po.untaxed_total, po.tax_total, po.grand_total),
+                         (Decimal('100.11'), Decimal('12.52'), Decimal('112.63')))
+        line = po.lines.get(product=product)
+        self.assertEqual((line.hsn, line.line_total), ('9401', Decimal('0.14')))
+
+
+class DocumentLineEntryTests(LedgerTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.products = [Product.objects.create(name=f'P{i}', hsn=f'94{i:02d}') for i in range(3)]
+
+    def json_lines(self, count):
+        return json.dumps([{'product': self.products[i % 3].pk, 'qty': '2', 'unit_price': '10.00', 'tax_percent': '18'}
+                           for i in range(count)])
+
+    def test_reads_json_and_indexed_lines(self):
+        request = RequestFactory().post('/', {'lines': json.dumps([
+            {'product': self.products[0].pk, 'qty': '1.5', 'unit_price': '4', 'tax_percent': '5'},
+            {'product': '', 'qty': '1'}, 'junk', {'product': self.products[1].pk, 'qty': 'x'},
+        ])})
+        self.assertEqual(views.posted_document_lines(request), [
+            {'product_id': self.products[0].pk, 'qty': Decimal('1.5'), 'unit_price': Decimal('4'),
+             'tax_percent': Decimal('5')},
+            {'product_id': self.products[1].pk, 'qty': Decimal('0'), 'unit_price': Decimal('0'),
+             'tax_percent': Decimal('0')},
+        ])
+        # any indexes, gaps included, read in index order
+        request = RequestFactory().post('/', {'product_12': self.products[2].pk, 'qty_12': '3',
+                                              'product_2': self.products[0].pk, 'qty_2': '1', 'product_7': ''})
+        self.assertEqual([(r['product_id'], r['qty']) for r in views.posted_document_lines(request)],
+                         [(self.products[0].pk, Decimal('1')), (self.products[2].pk, Decimal('3'))])
+        with self.assertRaises(ValueError):
+            views.posted_document_lines(RequestFactory().post('/', {'lines': '{"product": 1}'}))
+
+    def test_purchase_order_takes_hundreds_of_lines(self):
+        response = self.client.post('/purchase_orders/new/', {'vendor': self.vendor.pk, 'po_date': '2025-03-01',
+                                                              'lines': self.json_lines(300)})
+        po = PurchaseOrder.objects.get()
+        self.assertRedirects(response, f'/purchase_orders/{po.pk}/', fetch_redirect_response=False)
+        self.assertEqual(po.lines.count(), 300)
+        self.assertEqual(po.grand_total, Decimal('7080.00'))
+        self.assertEqual(set(po.lines.values_list('hsn', flat=True)), {p.hsn for p in self.products})
+
+    def test_sales_order_reads_indexed_fields_past_five(self):
+        data = {'customer': self.customer.pk, 'so_date': '2025-03-01'}
+        for i in (1, 6, 40):
+            data.update({f'product_{i}': self.products[0].pk, f'qty_{i}': i, f'unit_price_{i}': '1.00'})
+        self.client.post('/sales/orders/new/', data)
+        self.assertEqual(sorted(SalesOrder.objects.get().lines.values_list('qty', flat=True)),
+                         [Decimal('1'), Decimal('6'), Decimal('40')])
+
+    def test_vendor_bill_stores_lines_and_totals(self):
+        self.login()
+        self.client.post('/vendor_bills/new/', {'vendor': self.vendor.pk, 'bill_date': '2025-03-01',
+                                                'lines': self.json_lines(30)})
+        bill = VendorBill.objects.get()
+        self.assertEqual(bill.lines.count(), 30)
+        self.assertEqual(set(bill.lines.values_list('account', flat=True)), {self.purchase.pk})
+        self.assertEqual(bill.total_amount, Decimal('708.00'))
+
+    def test_bad_lines_create_nothing(self):
+        self.login()
+        response = self.client.post('/vendor_bills/new/', {'vendor': self.vendor.pk, 'lines': 'not json'})
+        self.assertRedirects(response, '/vendor_bills/new/', fetch_redirect_response=False)
+        self.assertFalse(VendorBill.objects.exists())
+
+
+class RecurringInvoiceTests(LedgerTestCase):
+    def template(self, start=date(2025, 1, 31), **kwargs):
+        t = RecurringInvoice.objects.create(customer=self.customer, start_date=start, next_run_date=start, **kwargs)
+        RecurringInvoiceLine.objects.create(template=t, qty=2, unit_price=50, tax_percent=18)
+        return t
+
+    def test_catches_up_missed_periods_on_the_anchor_day(self):
+        t = self.template(due_days=15)
+        result = run_recurring_invoices(as_of=date(2025, 4, 15), batch_size=1)
+        self.assertEqual((result['created'], result['confirmed']), (3, []))
+        self.assertEqual(list(CustomerInvoice.objects.order_by('issue_date').values_list('issue_date', 'due_date')),
+                         [(date(2025, 1, 31), date(2025, 2, 15)), (date(2025, 2, 28), date(2025, 3, 15)),
+                          (date(2025, 3, 31), date(2025, 4, 15))])
+        self.assertEqual(set(CustomerInvoice.objects.values_list('grand_total', 'status')),
+                         {(Decimal('118.00'), CustomerInvoice.DRAFT)})
+        t.refresh_from_db()
+        self.assertEqual(t.next_run_date, date(2025, 4, 30))
+
+    def test_rerun_bills_no_period_twice(self):
+        t = self.template()
+        run_recurring_invoices(as_of=date(2025, 3, 1))
+        self.assertEqual(run_recurring_invoices(as_of=date(2025, 3, 1))['created'], 0)
+        # a crash after the runs were written but before next_run_date moved on
+        RecurringInvoice.objects.filter(pk=t.pk).update(next_run_date=date(2025, 1, 31))
+        self.assertEqual(run_recurring_invoices(as_of=date(2025, 3, 1))['created'], 0)
+        self.assertEqual(CustomerInvoice.objects.count(), 2)
+        self.assertEqual(RecurringInvoiceRun.objects.filter(template=t).count(), 2)
+
+    def test_stops_after_end_date(self):
+        t = self.template(cadence=RecurringInvoice.WEEKLY, start=date(2025, 1, 1), end_date=date(2025, 1, 20))
+        self.assertEqual(run_recurring_invoices(as_of=date(2025, 3, 1))['created'], 3)
+        t.refresh_from_db()
+        self.assertFalse(t.active)
+        self.assertEqual(run_recurring_invoices(as_of=date(2025, 6, 1))['created'], 0)
+
+    def test_auto_confirm_posts_new_and_left_over_drafts(self):
+        t = self.template()
+        run_recurring_invoices(as_of=date(2025, 1, 31))
+        # the January invoice stands in for a draft an interrupted run left behind
+        RecurringInvoice.objects.filter(pk=t.pk).update(auto_confirm=True)
+        result = run_recurring_invoices(as_of=date(2025, 2, 28))
+        self.assertEqual((result['created'], len(result['confirmed']), result['failed']), (1, 2, []))
+        self.assertFalse(CustomerInvoice.objects.filter(recurring_run__template=t, journal_entry__isnull=True).exists())
+
+    def test_command_dry_run_only_counts(self):
+        self.template()
+        out = StringIO()
+        call_command('run_recurring_invoices', '--as-of', '2025-02-01', '--dry-run', stdout=out)
+        self.assertIn('1 recurring template(s) are due', out.getvalue())
+        self.assertFalse(CustomerInvoice.objects.exists())
+        call_command('run_recurring_invoices', '--as-of', '2025-02-01', stdout=out)
+        self.assertEqual(CustomerInvoice.objects.get().created_by, 'run_recurring_invoices')
+
+
+class IdempotencyTests(LedgerTestCase):
+    def setUp(self):
+        super().setUp()
+        self.product = Product.objects.create(name='P')
+
+    def order_data(self, key='k1', qty='1'):
+        return {'customer': self.customer.pk, 'so_date': '2025-03-01', 'product_1': self.product.pk, 'qty_1': qty,
+                'unit_price_1': '10', 'idempotency_key': key}
+
+    def test_replay_returns_the_first_response(self):
+        first = self.client.post('/sales/orders/new/', self.order_data())
+        replay = self.client.post('/sales/orders/new/', self.order_data())
+        self.assertEqual(replay.status_code, first.status_code)
+        self.assertEqual(replay['Location'], first['Location'])
+        self.assertEqual(replay['Idempotent-Replay'], 'true')
+        self.assertFalse(first.has_header('Idempotent-Replay'))
+        so = SalesOrder.objects.get()
+        self.assertEqual(IdempotencyKey.objects.get().created_object, so)
+        # a new key is a new request
+        self.client.post('/sales/orders/new/', self.order_data(key='k2'))
+        self.assertEqual(SalesOrder.objects.count(), 2)
+
+    def test_key_reused_for_another_payload_or_user_is_rejected(self):
+        self.client.post('/sales/orders/new/', self.order_data())
+        self.assertEqual(self.client.post('/sales/orders/new/', self.order_data(qty='2')).status_code, 422)
+        self.login()
+        self.assertEqual(self.client.post('/sales/orders/new/', self.order_data()).status_code, 422)
+        self.assertEqual(SalesOrder.objects.count(), 1)
+
+    def test_header_key_and_in_flight_request(self):
+        data = self.order_data()
+        del data['idempotency_key']
+        IdempotencyKey.claim('sales_order_create', 'h1', None, 'pending-fingerprint', timedelta(hours=1))
+        response = self.client.post('/sales/orders/new/', data, HTTP_IDEMPOTENCY_KEY='h1')
+        self.assertEqual(response.status_code, 422)
+        IdempotencyKey.objects.update(fingerprint=views._request_fingerprint(
+            RequestFactory().post('/sales/orders/new/', data)))
+        self.assertEqual(self.client.post('/sales/orders/new/', data, HTTP_IDEMPOTENCY_KEY='h1').status_code, 409)
+        self.assertFalse(SalesOrder.objects.exists())
+
+    def test_failed_request_frees_its_key(self):
+        with mock.patch('core.views.SalesOrder.objects.create', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                self.client.post('/sales/orders/new/', self.order_data())
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.client.post('/sales/orders/new/', self.order_data())
+        self.assertEqual(SalesOrder.objects.count(), 1)
+
+    def test_expired_keys_are_reusable_and_pruned(self):
+        self.client.post('/sales/orders/new/', self.order_data())
+        IdempotencyKey.objects.update(created_at=IdempotencyKey.objects.get().created_at - timedelta(hours=25))
+        self.assertNotIn('Idempotent-Replay', self.client.post('/sales/orders/new/', self.order_data()))
+        self.assertEqual(SalesOrder.objects.count(), 2)
+        IdempotencyKey.objects.update(created_at=IdempotencyKey.objects.get().created_at - timedelta(hours=25))
+        call_command('prune_idempotency_keys', stdout=StringIO())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class MasterDataCacheTests(LedgerTestCase):
+    def test_lookups_are_served_from_process_memory(self):
+        self.assertEqual(resolve_posting_accounts()['sales'], self.sales)
+        active_taxes()
+        with self.assertNumQueries(0):
+            self.assertEqual(resolve_posting_accounts()['sales'], self.sales)
+            active_taxes()
+
+    def test_saves_invalidate(self):
+        self.assertEqual(active_taxes(), [])
+        tax = Tax.objects.create(name='GST 18', value=18)
+        self.assertEqual(active_taxes(), [tax])
+        self.sales.delete()
+        self.assertIsNone(resolve_posting_accounts()['sales'])
+
+    def test_another_process_invalidating_reaches_this_one(self):
+        resolve_posting_accounts()
+        # update() skips the signals, so this process's copy is still the old one
+        Account.objects.filter(pk=self.sales.pk).update(name='Renamed', account_type='equity')
+        self.assertEqual(resolve_posting_accounts()['sales'], self.sales)
+        # what another process's invalidate_master_data() leaves in the shared cache
+        caches['masterdata'].set(MASTER_DATA_GENERATION_KEY, 'from-another-process')
+        self.assertIsNone(resolve_posting_accounts()['sales'])
+
+    @override_settings(MASTER_DATA_TTL=60)
+    def test_copies_expire_after_ttl(self):
+        resolve_posting_accounts()
+        Account.objects.filter(pk=self.sales.pk).update(name='Renamed', account_type='equity')
+        now = time.monotonic()
+        with mock.patch('core.utils.time.monotonic', return_value=now + 30):
+            self.assertEqual(resolve_posting_accounts()['sales'], self.sales)
+        with mock.patch('core.utils.time.monotonic', return_value=now + 61):
+            self.assertIsNone(resolve_posting_accounts()['sales'])
+
+
+class HsnFilesTestCase(LedgerTestCase):
+    """ Points every HSN data path at a temp directory; write() (re)writes a source file there. """
+
+    TAX_MAP = {'9401': {'gst_rate': 12.0}, '9404': 5, '1001': {'rate': '0'}}
+    CODES = [{'hsn': '9401', 'description': 'Seats (e.g., office chairs, bar stools)'},
+             {'hsn': '9404', 'description': 'Mattress supports; mattresses and cushions'},
+             {'hsn': '1001', 'description': 'Wheat and meslin'}]
+
+    def setUp(self):
+        super().setUp()
+        self.dir = Path(self.enterContext(tempfile.TemporaryDirectory()))
+        self.enterContext(self.settings(
+            HSN_TAX_MAP_PATH=self.dir / 'hsn_tax_map.json', HSN_CODES_PATH=self.dir / 'hsn_codes.json',
+            HSN_INDEX_PATH=self.dir / 'hsn_index.bin', HSN_SEARCH_DB_PATH=self.dir / 'hsn_search.sqlite3'))
+        self.mtime = 1_700_000_000
+        self.write('hsn_tax_map.json', self.TAX_MAP)
+        self.write('hsn_codes.json', self.CODES)
+
+    def write(self, name, data):
+        path = self.dir / name
+        path.write_text(data if isinstance(data, str) else json.dumps(data), encoding='utf-8')
+        # a distinct mtime per write, whatever the filesystem's timestamp resolution
+        self.mtime += 10
+        os.utime(path, (self.mtime, self.mtime))
+        return path
+
+
+class HsnTaxMapTests(HsnFilesTestCase):
+    def test_rates_by_normalized_code(self):
+        index = hsn_tax_index()
+        self.assertEqual(index.path, self.dir / 'hsn_tax_map.json')
+        self.assertEqual((index.rate('9401'), index.rate('94 01'), index.rate('9404'), index.rate('1001')),
+                         (12.0, 12.0, 5.0, 0.0))
+        self.assertIsNone(index.rate('8471'))
+        self.write('hsn_tax_map.json', {'0401': 5})
+        self.assertEqual(index.rate('401'), 5.0)  # short codes are retried zero-padded
+
+    def test_reloads_only_when_the_file_changes(self):
+        index = hsn_tax_index()
+        self.assertEqual(index.rate('9401'), 12.0)
+        with mock.patch('core.hsn.load_hsn_entries') as load:
+            index.rate('9401')
+        load.assert_not_called()
+        self.write('hsn_tax_map.json', {'9401': 18})
+        self.assertEqual(index.rate('9401'), 18.0)
+
+    def test_bad_file_keeps_the_last_good_map(self):
+        index = hsn_tax_index()
+        self.assertEqual(index.rate('9401'), 12.0)
+        self.write('hsn_tax_map.json', '{"9401": ')
+        with self.assertLogs('core.hsn', 'WARNING'):
+            self.assertEqual(index.rate('9401'), 12.0)
+
+    def test_lookup_view(self):
+        self.login()
+        self.assertEqual(self.client.get('/ajax/hsn_tax_lookup/', {'hsn': '9404'}).json(), {'rate': 5.0})
+        self.assertEqual(self.client.get('/ajax/hsn_tax_lookup/', {'hsn': '12'}).json(), {'rate': None})
+
+
+class HsnPrefixIndexTests(HsnFilesTestCase):
+    TAX_MAP = {'94': 18, '9401': 12, '940110': 5, '9404': 5}
+    CODES = [{'hsn': '9401', 'description': 'Seats'}, {'hsn': '940110', 'description': 'Aircraft seats'},
+             {'hsn': '94011000', 'description': 'Seats for aircraft'}, {'hsn': '940120', 'description': 'Car seats'},
+             {'hsn': '9403', 'description': 'Other furniture'}, {'hsn': '9405', 'description': 'Lamps'}]
+
+    def test_rate_of_the_longest_prefix_with_one(self):
+        index = hsn_tax_index()
+        self.assertEqual(index.resolve('94011000'), {'hsn': '940110', 'description': 'Aircraft seats', 'rate': 5.0})
+        self.assertEqual([index.rate(c) for c in ('9401 10 00', '94012000', '9403', '9499', '95')],
+                         [5.0, 12.0, 18.0, 18.0, None])
+        self.assertEqual(index.get('94011000'), {'hsn': '94011000', 'description': 'Seats for aircraft', 'rate': None})
+
+    def test_children_inherit_rates(self):
+        index = hsn_tax_index()
+        self.assertEqual([(r['hsn'], r['rate']) for r in index.children('9401')],
+                         [('9401', 12.0), ('940110', 5.0), ('94011000', 5.0), ('940120', 12.0)])
+        self.assertEqual([r['hsn'] for r in index.children('94', limit=3)], ['94', '9401', '940110'])
+        self.assertEqual(index.children('8'), [])
+
+    def test_compiled_index_is_mapped_and_answers_the_same(self):
+        index = hsn_tax_index()
+        expected = [index.resolve(c) for c in ('94011000', '9405', '94')] + [index.children('94', limit=50)]
+        call_command('compile_hsn_index', stdout=StringIO())
+        self.assertTrue((self.dir / 'hsn_index.bin').exists())
+        self.assertEqual([index.resolve(c) for c in ('94011000', '9405', '94')] + [index.children('94', limit=50)],
+                         expected)
+        self.assertIsInstance(index._current(), _MappedTable)
+        self.assertEqual(len(index), 8)
+
+    def test_stale_or_corrupt_compiled_index_falls_back_to_json(self):
+        index = hsn_tax_index()
+        call_command('compile_hsn_index', stdout=StringIO())
+        self.write('hsn_tax_map.json', {'9401': 28})
+        self.assertEqual(index.rate('94011000'), 28.0)
+        self.assertIsInstance(index._current(), _MemoryTable)
+        self.write('hsn_index.bin', 'not an index')
+        with self.assertLogs('core.hsn', 'WARNING'):
+            self.assertEqual(index.rate('9401'), 28.0)
+
+    def test_children_view(self):
+        self.login()
+        response = self.client.get('/ajax/hsn_children/', {'prefix': '9401', 'limit': '2'})
+        self.assertEqual([r['hsn'] for r in response.json()['results']], ['9401', '940110'])
+
+
+class HsnSearchTests(HsnFilesTestCase):
+    def search(self, query, **kwargs):
+        return [r['hsn'] for r in hsn_search_index().search(query, **kwargs)]
+
+    def test_digit_queries_search_by_code_prefix(self):
+        self.write('hsn_codes.json', self.CODES + [{'hsn': '94011000', 'description': 'Aircraft seats'}])
+        self.assertEqual(self.search('94'), ['9401', '94011000', '9404'])
+        self.assertEqual(self.search('9401.10'), ['94011000'])
+        self.assertEqual(self.search('94', limit=1), ['9401'])
+        self.assertEqual(self.search('8'), [])
+
+    def test_words_match_stemmed_prefixes_and_all_are_required(self):
+        self.assertEqual(hsn_search_index().search('offic chai'), [
+            {'hsn': '9401', 'description': 'Seats (e.g., office chairs, bar stools)', 'rate': 12.0}])
+        self.assertEqual(self.search('Mattress'), ['9404'])
+        self.assertEqual(self.search('cushion'), ['9404'])
+        self.assertEqual(self.search('office wheat'), [])
+        self.assertEqual(self.search('"*-'), [])
+
+    def test_rebuilds_when_the_codes_file_changes(self):
+        index = hsn_search_index()
+        self.assertEqual(self.search('lamps'), [])
+        self.write('hsn_codes.json', self.CODES + [{'hsn': '9405', 'description': 'Lamps and lighting fittings'}])
+        self.assertIs(hsn_search_index(), index)
+        self.assertEqual(self.search('lamps'), ['9405'])
+        self.assertEqual(len(index), 4)
+
+    def test_imported_database_takes_over(self):
+        self.write('portal.csv', 'HSN Code,Description\n8471,Automatic data processing machines\n')
+        self.write('portal.json', {'data': [{'c': '9405', 'n': 'Lamps'}, {'c': '9401', 'n': 'Chairs'}]})
+        call_command('import_hsn_codes', str(self.dir / 'portal.csv'), str(self.dir / 'portal.json'),
+                     stdout=StringIO())
+        self.assertTrue((self.dir / 'hsn_search.sqlite3').exists())
+        self.assertEqual(self.search('processing'), ['8471'])
+        self.assertEqual(self.search('chairs'), ['9401'])  # a later dataset wins for a repeated code
+        self.assertEqual(len(hsn_search_index()), 5)
+
+    def test_lookup_view_goes_remote_only_when_asked(self):
+        self.login()
+        self.assertEqual(self.client.get('/ajax/gst_hsn_lookup/', {'q': 'wheat'}).json()['results'][0]['hsn'], '1001')
+        with mock.patch('core.views.gst_client') as client:
+            client.return_value.search_hsn.return_value = [{'hsn': '8471', 'description': 'Computers'}]
+            self.assertEqual(self.client.get('/ajax/gst_hsn_lookup/', {'q': 'computer'}).json(),
+                             {'results': [], 'source': 'local'})
+            response = self.client.get('/ajax/gst_hsn_lookup/', {'q': 'computer', 'remote': '1'}).json()
+        self.assertEqual(response, {'results': [{'hsn': '8471', 'description': 'Computers'}], 'source': 'remote'})
+
+
+class GstApiClientTests(HsnFilesTestCase):
+    def client_for(self, stub, **kwargs):
+        kwargs = {'timeout': (1, 2), 'cache_alias': 'gst_api', **kwargs}
+        client = GstApiClient(search_url=stub.search_url, tax_api_base=stub.tax_url, **kwargs)
+        self.addCleanup(client.session.close)
+        self.addCleanup(client._executor.shutdown, wait=False)
+        return client
+
+    def stub(self, **kwargs):
+        return self.enterContext(GstStubServer(**kwargs))
+
+    def wait_for_requests(self, stub, count):
+        deadline = time.monotonic() + 2
+        while len(stub.requests) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return len(stub.requests)
+
+    def test_search_variants_run_in_parallel(self):
+        stub = self.stub(delay=0.3)
+        client = self.client_for(stub)
+        started = time.monotonic()
+        self.assertEqual(client.search_hsn('wheat'), [{'hsn': '1001', 'description': 'Wheat and meslin'}])
+        self.assertLess(time.monotonic() - started, 0.8)
+        self.assertEqual(self.wait_for_requests(stub, 3), 3)
+        self.assertEqual({(p['selectedType'], p['category']) for _path, p in stub.requests},
+                         {('byDesc', 'P'), ('byDesc', 'S'), ('byCode', 'null')})
+
+    def test_sequential_calls_reuse_pooled_connections(self):
+        stub = self.stub()
+        client = self.client_for(stub)
+        self.assertEqual([client.tax_rate(code) for code in ('9401', '9404', '1001', '94011000')],
+                         [12.0, 5.0, 0.0, 12.0])
+        self.assertEqual((len(stub.requests), len(stub.connections)), (4, 1))
+
+    def test_cache_hit_makes_no_request(self):
+        stub = self.stub()
+        client = self.client_for(stub)
+        self.assertEqual(client.tax_rate('9401'), 12.0)
+        self.assertEqual(client.search_hsn('9404')[0]['hsn'], '9404')
+        requests_made = self.wait_for_requests(stub, 4)
+        self.assertEqual(client.tax_rate('94 01'), 12.0)
+        self.assertEqual(client.search_hsn('9404')[0]['hsn'], '9404')
+        self.assertEqual(len(stub.requests), requests_made)
+
+    def test_not_found_is_cached_briefly(self):
+        stub = self.stub()
+        client = self.client_for(stub, negative_ttl=60)
+        self.assertEqual(client.search_hsn('8471'), [])
+        self.assertIsNone(client.tax_rate('8471'))
+        self.assertEqual(len(stub.requests), 4)
+        self.assertEqual(caches['gst_api'].get('gst_tax_rate:8471'), NO_ANSWER)
+        self.assertEqual((client.search_hsn('8471'), client.tax_rate('8471')), ([], None))
+        self.assertEqual(len(stub.requests), 4)
+
+    def test_partial_failure_is_not_cached_as_not_found(self):
+        stub = self.stub(fail_every=2)
+        client = self.client_for(stub)
+        with self.assertLogs('core.gst_client', 'WARNING'):
+            self.assertEqual(client.search_hsn('8471'), [])
+        # one of the three variants got a 503, so the next lookup asks again
+        stub.fail_every = 0
+        self.assertEqual(client.search_hsn('8471'), [])
+        self.assertEqual(len(stub.requests), 6)
+        self.assertEqual(client.search_hsn('8471'), [])
+        self.assertEqual(len(stub.requests), 6)
+
+    def test_partial_failure_still_returns_and_caches_results(self):
+        stub = self.stub(fail_every=2)
+        client = self.client_for(stub)
+        with self.assertLogs('core.gst_client', 'WARNING') as logs:
+            self.assertEqual([r['hsn'] for r in client.search_hsn('wheat')], ['1001'])
+            # the first answer wins; the failed variant may still be logging in its worker
+            deadline = time.monotonic() + 2
+            while not logs.records and time.monotonic() < deadline:
+                time.sleep(0.01)
+        requests_made = self.wait_for_requests(stub, 3)
+        self.assertEqual([r['hsn'] for r in client.search_hsn('wheat')], ['1001'])
+        self.assertEqual(len(stub.requests), requests_made)
+
+    def test_breaker_opens_after_failures_and_half_opens_after_cooldown(self):
+        stub = self.stub(fail_every=1)
+        client = self.client_for(stub, failure_threshold=2, cooldown=30)
+        host = urlsplit(stub.tax_url).netloc
+        with self.assertLogs('core.gst_client', 'WARNING'):
+            self.assertEqual([client.tax_rate('9401'), client.tax_rate('9404')], [None, None])
+        self.assertEqual(client.status(), {host: 'open'})
+        # refused without a request while open, and failures are never cached
+        self.assertIsNone(client.tax_rate('9401'))
+        self.assertEqual(len(stub.requests), 2)
+        self.assertIsNone(caches['gst_api'].get('gst_tax_rate:9401'))
+
+        later = time.monotonic() + 31
+        with mock.patch('core.gst_client.time.monotonic', return_value=later):
+            self.assertEqual(client.status(), {host: 'half-open'})
+            # the trial call fails: open again for another cooldown
+            with self.assertLogs('core.gst_client', 'WARNING'):
+                self.assertIsNone(client.tax_rate('9401'))
+            self.assertEqual(client.status(), {host: 'open'})
+        stub.fail_every = 0
+        with mock.patch('core.gst_client.time.monotonic', return_value=later + 31):
+            self.assertEqual(client.tax_rate('9401'), 12.0)
+            self.assertEqual(client.status(), {host: 'closed'})
+        self.assertEqual(len(stub.requests), 4)
@@ -21,6 +21,7 @@ urlpatterns = [
     # path('ajax/products_by_hsn/', views.products_by_hsn, name='products_by_hsn'),
     path('ajax/gst_hsn_lookup/', views.gst_hsn_lookup, name='gst_hsn_lookup'),
     path('ajax/hsn_tax_lookup/', views.hsn_tax_lookup, name='hsn_tax_lookup'),
+    path('ajax/hsn_children/', views.hsn_children, name='hsn_children'),
     # Tax Master
     path('ajax/create_tax_from_hsn/', views.ajax_create_tax_from_hsn, name='ajax_create_tax_from_hsn'),
 
@@ -62,6 +63,9 @@ path('vendor_bills/<int:pk>/', views.vendor_bill_detail, name='vendor_bill_detai
 path('reports/partner/<int:partner_id>/', views.partner_ledger, name='partner_ledger'),
 path('reports/profit-loss/', views.profit_and_loss, name='profit_and_loss'),
 path('reports/balance-sheet/', views.balance_sheet, name='balance_sheet'),
+path('reports/trial-balance/', views.trial_balance, name='trial_balance'),
+path('reports/trial-balance.json', views.trial_balance_json, name='trial_balance_json'),
+path('reports/aging/', views.aging_report, name='aging_report'),
  path('vendor-bills/<int:pk>/pay/', views.vendor_bill_payment, name='vendor_bill_payment'),
 
  path('sales/orders/', views.sales_order_list, name='sales_order_list'),
@@ -69,10 +73,12 @@ path('reports/balance-sheet/', views.balance_sheet, name='balance_sheet'),
  path('sales/orders/<int:pk>/', views.sales_order_detail, name='sales_order_detail'),
  path('sales/orders/<int:pk>/add-line/', views.sales_order_add_line, name='sales_order_add_line'),
  path('sales/orders/<int:pk>/confirm/', views.sales_order_confirm, name='sales_order_confirm'),
+ path('sales/orders/invoice/', views.sales_orders_invoice, name='sales_orders_invoice'),
 
 
  path('sales/order/<int:so_pk>/create-invoice/', views.create_invoice_from_so, name='create_invoice_from_so'),
 path('invoices/<int:pk>/confirm/', views.customer_invoice_confirm, name='customer_invoice_confirm'),
+path('api/documents/confirm/', views.documents_confirm_batch, name='documents_confirm_batch'),
 path('invoices/<int:pk>/pay/', views.customer_invoice_receive_payment, name='customer_invoice_receive_payment'),
 # detail/list views not shown here but should exist (customer_invoice_detail)
 path('invoices/', views.customer_invoices_list, name='customer_invoices_list'),
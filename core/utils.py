@@ -1,9 +1,23 @@
 from django.contrib.auth.hashers import make_password, check_password
 import re
+import json
+import hashlib
+import time
+import uuid
 from decimal import Decimal
-from django.db import transaction
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.core.cache import caches
+from datetime import date, timedelta
+from django.db import transaction, connection
+from django.utils import timezone
 from django.contrib.contenttypes.models import ContentType
-from .models import JournalEntry, JournalLine
+from django.db.models import F
+from django.db.models.functions import Greatest
+from .pricing import apply_prices
+from .models import (Account, AccountBalance, Tax, AccountDailyBalance, JournalEntry, JournalLine, LedgerVersion,
+                     CustomerInvoice, CustomerInvoiceLine, VendorBill, OpenItem, SalesOrder, SalesOrderLine,
+                     RecurringInvoice, RecurringInvoiceLine, RecurringInvoiceRun)
 
 
 def hash_pw(raw):
@@ -25,6 +39,13 @@ def validate_password_complexity(pwd):
         return False, "Password must contain a special character."
     return True, ""
 
+def parse_date_option(value):
+    """ argparse `type=` for the management commands' YYYY-MM-DD options. """
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise CommandError(f"Invalid date '{value}', expected YYYY-MM-DD.")
+
 
 class JournalError(Exception):
     pass
@@ -35,35 +56,19 @@ def _as_decimal(value):
     except Exception:
         return Decimal('0.00')
 
-@transaction.atomic
-def post_journal_entry(date, ref, narration, lines, source=None):
-    """
-    Post a balanced journal entry.
 
-    Args:
-      date: datetime.date instance
-      ref: string reference (e.g. 'Bill/2025/0001')
-      narration: text
-      lines: list of dicts. Each dict:
-         {
-           'account': Account instance OR account pk,
-           'debit': Decimal or numeric (0 if credit),
-           'credit': Decimal or numeric (0 if debit),
-           'narration': optional str,
-           'partner': optional model instance (Contact/vendor/customer)
-         }
-      source: optional model instance (e.g., vendor bill) - will be linked to JournalEntry.source
 
-    Returns:
-      JournalEntry instance
-    Raises:
-      JournalError if not balanced or invalid input
+def _normalize_entry(entry):
+    """
+    Validate one entry dict (see post_journal_entries) and return a copy with
+    Decimal amounts. Raises JournalError if a line is invalid or the entry is
+    not balanced.
     """
     total_debit = Decimal('0.00')
     total_credit = Decimal('0.00')
 
     norm_lines = []
-    for ln in lines:
+    for ln in entry['lines']:
         debit = _as_decimal(ln.get('debit') or 0)
         credit = _as_decimal(ln.get('credit') or 0)
         if debit != Decimal('0.00') and credit != Decimal('0.00'):
@@ -84,47 +89,563 @@ def post_journal_entry(date, ref, narration, lines, source=None):
     if total_debit != total_credit:
         raise JournalError(f"Unbalanced entry: debits {total_debit} != credits {total_credit}")
 
-    # create header
-    je = JournalEntry.objects.create(
-        date=date,
-        ref=ref,
-        narration=narration
-    )
-    # link source if provided
-    if source is not None:
-        try:
+    return {
+        'date': entry['date'],
+        'ref': entry.get('ref'),
+        'narration': entry.get('narration'),
+        'source': entry.get('source'),
+        'created_by': entry.get('created_by'),
+        'lines': norm_lines,
+    }
+
+
+@transaction.atomic
+def post_journal_entries(entries, batch_size=500):
+    """
+    Post many balanced journal entries in a single transaction.
+
+    Args:
+      entries: list of dicts. Each dict:
+         {
+           'date': datetime.date instance,
+           'ref': string reference (e.g. 'Bill/2025/0001'),
+           'narration': text,
+           'lines': list of line dicts (see post_journal_entry),
+           'source': optional model instance linked to JournalEntry.source,
+           'created_by': optional str
+         }
+      batch_size: max rows per INSERT statement
+
+    Every entry is validated before anything is written. Account pks are
+    resolved with one in_bulk() query, headers are written once with their
+    source link already set and all lines go in with bulk_create().
+
+    Returns:
+      list of JournalEntry instances, in the same order as entries
+    Raises:
+      JournalError if any entry is not balanced or references a missing account
+    """
+    norm_entries = [_normalize_entry(e) for e in entries]
+    if not norm_entries:
+        return []
+
+    # resolve every account passed by pk in one query
+    account_pks = set()
+    for e in norm_entries:
+        for ln in e['lines']:
+            if not hasattr(ln['account'], 'pk'):
+                account_pks.add(int(ln['account']))
+    accounts = Account.objects.in_bulk(account_pks) if account_pks else {}
+    missing = account_pks - set(accounts)
+    if missing:
+        raise JournalError(f"Unknown account id(s): {sorted(missing)}")
+
+    # build headers with the source link set up front
+    headers = []
+    for e in norm_entries:
+        je = JournalEntry(
+            date=e['date'],
+            ref=e['ref'],
+            narration=e['narration'],
+            created_by=e['created_by'],
+        )
+        source = e['source']
+        if source is not None and source.pk is not None:
             je.content_type = ContentType.objects.get_for_model(source.__class__)
             je.object_id = int(source.pk)
-            je.save(update_fields=['content_type', 'object_id'])
-        except Exception:
-            # ignore linking errors, but keep the journal posted
-            pass
+        headers.append(je)
+
+    if connection.features.can_return_rows_from_bulk_insert:
+        JournalEntry.objects.bulk_create(headers, batch_size=batch_size)
+    else:
+        # backend can't hand back primary keys from a bulk insert
+        for je in headers:
+            je.save()
 
     # create lines
     jl_objs = []
-    for ln in norm_lines:
-        account = ln['account']
-        # allow passing pk too
-        if not hasattr(account, 'pk'):
-            # try fetch Account by pk
-            from .models import Account
-            account = Account.objects.get(pk=int(account))
-        partner = ln.get('partner')
-        partner_ct = None
-        partner_oid = None
-        if partner is not None:
-            partner_ct = ContentType.objects.get_for_model(partner.__class__)
-            partner_oid = int(partner.pk)
-        jl = JournalLine.objects.create(
-            entry=je,
-            account=account,
-            debit=ln['debit'],
-            credit=ln['credit'],
-            narration=ln.get('narration') or '',
-            partner_content_type=partner_ct,
-            partner_object_id=partner_oid,
-            date=date
+    for je, e in zip(headers, norm_entries):
+        for ln in e['lines']:
+            account = ln['account']
+            account_id = account.pk if hasattr(account, 'pk') else int(account)
+            partner = ln['partner']
+            partner_id = None
+            if partner is not None:
+                partner_id = int(partner.pk) if hasattr(partner, 'pk') else int(partner)
+            jl_objs.append(JournalLine(
+                entry=je,
+                account_id=account_id,
+                debit=ln['debit'],
+                credit=ln['credit'],
+                narration=ln['narration'],
+                partner_id=partner_id,
+                date=je.date
+            ))
+    JournalLine.objects.bulk_create(jl_objs, batch_size=batch_size)
+    _update_account_balances(jl_objs)
+    _update_daily_balances(jl_objs)
+    bump_ledger_version()
+
+    return headers
+
+
+def _update_account_balances(jl_objs):
+    """
+    Add freshly inserted journal lines to the AccountBalance store.
+    Runs inside the posting transaction: one INSERT .. ON CONFLICT DO NOTHING
+    for missing rows, then one F() UPDATE per touched account.
+    """
+    deltas = {}
+    for jl in jl_objs:
+        d = deltas.setdefault(jl.account_id, [Decimal('0.00'), Decimal('0.00'), 0])
+        d[0] += jl.debit
+        d[1] += jl.credit
+        if jl.pk:
+            d[2] = max(d[2], jl.pk)
+    if not deltas:
+        return
+
+    AccountBalance.objects.bulk_create(
+        [AccountBalance(account_id=account_id) for account_id in deltas],
+        ignore_conflicts=True,
+    )
+    for account_id, (debit, credit, last_id) in deltas.items():
+        changes = {
+            'debit_total': F('debit_total') + debit,
+            'credit_total': F('credit_total') + credit,
+        }
+        if last_id:
+            changes['last_line_id'] = Greatest(F('last_line_id'), last_id)
+        AccountBalance.objects.filter(account_id=account_id).update(**changes)
+
+
+def post_journal_entry(date, ref, narration, lines, source=None, created_by=None):
+    """
+    Post a balanced journal entry.
+
+    Args:
+      date: datetime.date instance
+      ref: string reference (e.g. 'Bill/2025/0001')
+      narration: text
+      lines: list of dicts. Each dict:
+         {
+           'account': Account instance OR account pk,
+           'debit': Decimal or numeric (0 if credit),
+           'credit': Decimal or numeric (0 if debit),
+           'narration': optional str,
+           'partner': optional Contact instance OR contact pk
+         }
+      source: optional model instance (e.g., vendor bill) - will be linked to JournalEntry.source
+      created_by: optional str stored on the JournalEntry
+
+    Returns:
+      JournalEntry instance
+    Raises:
+      JournalError if not balanced or invalid input
+    """
+    return post_journal_entries([{
+        'date': date,
+        'ref': ref,
+        'narration': narration,
+        'lines': lines,
+        'source': source,
+        'created_by': created_by,
+    }])[0]
+
+
+def _update_daily_balances(jl_objs):
+    """
+    Add freshly inserted journal lines to the (account, date) rollup in
+    AccountDailyBalance, inside the posting transaction.
+    """
+    deltas = {}
+    for jl in jl_objs:
+        d = deltas.setdefault((jl.account_id, jl.date), [Decimal('0.00'), Decimal('0.00')])
+        d[0] += jl.debit
+        d[1] += jl.credit
+    if not deltas:
+        return
+
+    AccountDailyBalance.objects.bulk_create(
+        [AccountDailyBalance(account_id=account_id, date=day) for account_id, day in deltas],
+        ignore_conflicts=True,
+    )
+    for (account_id, day), (debit, credit) in deltas.items():
+        AccountDailyBalance.objects.filter(account_id=account_id, date=day).update(
+            debit=F('debit') + debit,
+            credit=F('credit') + credit,
         )
-        jl_objs.append(jl)
 
-    return je
\ No newline at end of file
+
+LEDGER_VERSION_PK = 1
+
+
+def bump_ledger_version():
+    """Increment the ledger version; call inside any transaction that changes JournalLine."""
+    if not LedgerVersion.objects.filter(pk=LEDGER_VERSION_PK).update(version=F('version') + 1):
+        LedgerVersion.objects.get_or_create(pk=LEDGER_VERSION_PK, defaults={'version': 1})
+
+
+def get_ledger_version():
+    return (LedgerVersion.objects.filter(pk=LEDGER_VERSION_PK)
+            .values_list('version', flat=True).first()) or 0
+
+
+def cached_report(name, params, compute):
+    """
+    Return compute() for report `name` with `params`, cached under the current
+    ledger version. Any posting bumps the version, so stale entries are never
+    read again and simply age out of the cache backend.
+
+    Backend: settings.CACHES[settings.REPORT_CACHE_ALIAS] (falls back to 'default').
+    """
+    cache = caches[getattr(settings, 'REPORT_CACHE_ALIAS', 'default')]
+    digest = hashlib.md5(json.dumps(params, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    key = f"report:{name}:v{get_ledger_version()}:{digest}"
+    data = cache.get(key)
+    if data is None:
+        data = compute()
+        cache.set(key, data)
+    return data
+
+
+# In-process master data (account roles, active taxes). Each process keeps its
+# own copy tagged with a generation token read from the MASTER_DATA_CACHE_ALIAS
+# cache; the Account/Tax save/delete signals (core/signals.py) replace that
+# token, so every process sharing the cache drops its copy on its next lookup.
+# The alias must be shared by all workers (file based by default; a LocMem
+# cache only reaches its own process). A copy older than MASTER_DATA_TTL
+# seconds is reloaded regardless, which bounds how stale it can get when the
+# cache isn't shared or a change skipped the signals (update(), raw SQL).
+MASTER_DATA_GENERATION_KEY = 'masterdata:generation'
+_master_data = {}
+
+
+def _master_data_cache():
+    return caches[getattr(settings, 'MASTER_DATA_CACHE_ALIAS', 'default')]
+
+
+def _master_data_generation():
+    return _master_data_cache().get_or_set(MASTER_DATA_GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def invalidate_master_data():
+    """Forget the cached account roles and taxes in every process."""
+    # a new token rather than incr(): file and database caches don't increment atomically
+    _master_data_cache().set(MASTER_DATA_GENERATION_KEY, uuid.uuid4().hex, timeout=None)
+    _master_data.clear()
+
+
+def _cached_master_data(name, load):
+    generation = _master_data_generation()
+    now = time.monotonic()
+    entry = _master_data.get(name)
+    if entry is None or entry[0] != generation or now - entry[1] >= getattr(settings, 'MASTER_DATA_TTL', 300):
+        entry = (generation, now, load())
+        _master_data[name] = entry
+    return entry[2]
+
+
+def _load_posting_accounts():
+    accounts = list(Account.objects.order_by('pk'))
+    by_name = {}
+    for a in accounts:
+        by_name.setdefault(a.name.lower(), a)
+
+    def find(names=(), contains=(), account_type=None):
+        for n in names:
+            if n.lower() in by_name:
+                return by_name[n.lower()]
+        for fragment in contains:
+            for a in accounts:
+                if fragment in a.name.lower():
+                    return a
+        if account_type:
+            for a in accounts:
+                if (a.account_type or '').lower() == account_type:
+                    return a
+        return None
+
+    return {
+        'debtors': find(['Debtors A/c', 'Debtors'], account_type='asset'),
+        'creditors': find(['Creditors A/c', 'Creditors', 'Creditor'], account_type='liability'),
+        'sales': find(['Sales Income A/c'], account_type='income'),
+        'purchase': find(['Purchase Expense A/c', 'Purchase Expense', 'Purchase'], account_type='expense'),
+        'input_tax': find(contains=['tax', 'gst']),
+        'output_tax': find(contains=['tax', 'gst'], account_type='liability'),
+        'cash': find(['Cash A/c', 'Cash'], account_type='asset'),
+        'bank': find(['Bank A/c', 'Bank'], account_type='asset'),
+    }
+
+
+def resolve_posting_accounts():
+    """
+    Return the accounts document posting needs as a dict: debtors, creditors,
+    sales, purchase, input_tax, output_tax, cash, bank (None where nothing
+    matches). Each role is matched by name first, then by a name fragment,
+    then by account type. Loaded with one query and then served from the
+    in-process master data cache until an Account changes.
+    """
+    return _cached_master_data('accounts', _load_posting_accounts)
+
+
+def active_taxes():
+    """Active Tax records ordered by name, from the in-process master data cache."""
+    return _cached_master_data('taxes', lambda: list(Tax.objects.filter(active=True).order_by('name')))
+
+
+def _post_confirmations(pairs):
+    """
+    Post the (document, entry) pairs with one bulk journal write, mark the
+    documents confirmed with one UPDATE per model and open their items.
+    Must run inside a transaction.
+    """
+    jes = post_journal_entries([entry for _doc, entry in pairs])
+    by_model = {}
+    for (doc, _entry), je in zip(pairs, jes):
+        doc.journal_entry = je
+        doc.status = doc.CONFIRMED
+        by_model.setdefault(type(doc), []).append(doc)
+    for model, docs in by_model.items():
+        model.objects.bulk_update(docs, ['status', 'journal_entry'])
+    OpenItem.open_documents(invoices=by_model.get(CustomerInvoice, []), bills=by_model.get(VendorBill, []))
+    return jes
+
+
+@transaction.atomic
+def confirm_documents_now(docs, accounts=None, created_by=None):
+    """
+    Confirm the given invoices/bills in one transaction and return their
+    JournalEntry objects. Any document that can't be posted raises (ValueError
+    or JournalError) and nothing is written.
+    """
+    accounts = accounts or resolve_posting_accounts()
+    return _post_confirmations([(doc, doc.build_journal(accounts, created_by)) for doc in docs])
+
+
+def select_draft_documents(kind='all', start=None, end=None, partner=None, ids=None):
+    """
+    Return (invoices, bills) querysets of draft documents matching the filters;
+    the side not selected by kind ('invoices', 'bills' or 'all') is None.
+    start/end bound the document date, partner is a Contact pk, ids limits to pks.
+    """
+    invoices = bills = None
+    if kind in ('all', 'invoices'):
+        invoices = CustomerInvoice.objects.filter(status=CustomerInvoice.DRAFT)
+        if start:
+            invoices = invoices.filter(issue_date__gte=start)
+        if end:
+            invoices = invoices.filter(issue_date__lte=end)
+        if partner:
+            invoices = invoices.filter(customer_id=partner)
+        if ids:
+            invoices = invoices.filter(pk__in=ids)
+    if kind in ('all', 'bills'):
+        bills = VendorBill.objects.filter(status=VendorBill.DRAFT)
+        if start:
+            bills = bills.filter(bill_date__gte=start)
+        if end:
+            bills = bills.filter(bill_date__lte=end)
+        if partner:
+            bills = bills.filter(vendor_id=partner)
+        if ids:
+            bills = bills.filter(pk__in=ids)
+    return invoices, bills
+
+
+def confirm_documents(invoices=None, bills=None, chunk_size=200, created_by=None):
+    """
+    Confirm every draft in the invoices / bills querysets, chunk_size documents
+    per transaction. Posting accounts are resolved once for the whole run and
+    each chunk's journals go through one post_journal_entries() call.
+
+    A document that fails (not postable, unbalanced, ...) is reported and
+    skipped; it never aborts its chunk or the run. Returns
+      {'confirmed': [{'type', 'id', 'journal_entry'}], 'failed': [{'type', 'id', 'error'}]}
+    """
+    accounts = resolve_posting_accounts()
+    result = {'confirmed': [], 'failed': []}
+    for label, qs in (('invoice', invoices), ('bill', bills)):
+        if qs is None:
+            continue
+        model = qs.model
+        pks = list(qs.filter(status=model.DRAFT).order_by('pk').values_list('pk', flat=True))
+        for i in range(0, len(pks), chunk_size):
+            _confirm_chunk(model, label, pks[i:i + chunk_size], accounts, created_by, result)
+    return result
+
+
+def _confirm_chunk(model, label, pks, accounts, created_by, result):
+    with transaction.atomic():
+        docs = model.objects.filter(pk__in=pks, status=model.DRAFT).select_for_update(of=('self',)).order_by('pk')
+        if model is VendorBill:
+            docs = docs.select_related('vendor').prefetch_related('lines')
+        else:
+            docs = docs.select_related('customer')
+
+        pairs = []
+        for doc in docs:
+            try:
+                entry = doc.build_journal(accounts, created_by)
+                _normalize_entry(entry)  # reject unbalanced entries here, not in the bulk write
+                pairs.append((doc, entry))
+            except (ValueError, JournalError) as e:
+                result['failed'].append({'type': label, 'id': doc.pk, 'error': str(e)})
+        if not pairs:
+            return
+
+        try:
+            with transaction.atomic():
+                jes = _post_confirmations(pairs)
+            confirmed = list(zip(pairs, jes))
+        except Exception:
+            # something in the bulk write failed; redo the chunk one document at a
+            # time so only the offending document is reported
+            confirmed = []
+            for doc, entry in pairs:
+                try:
+                    with transaction.atomic():
+                        confirmed.append(((doc, entry), _post_confirmations([(doc, entry)])[0]))
+                except Exception as e:
+                    result['failed'].append({'type': label, 'id': doc.pk, 'error': str(e)})
+
+        for (doc, _entry), je in confirmed:
+            result['confirmed'].append({'type': label, 'id': doc.pk, 'journal_entry': je.pk})
+
+
+@transaction.atomic
+def invoice_sales_orders(orders, merge=False, issue_date=None, created_by=None, batch_size=1000):
+    """
+    Invoice every confirmed, not yet invoiced order in the orders queryset and
+    return the new CustomerInvoice objects. With merge=True all of a customer's
+    orders go onto one invoice; otherwise each order gets its own.
+
+    Invoice numbers are reserved in one block, line amounts and invoice totals
+    are priced up front with core.pricing (no per-line save()/recompute) and
+    invoices, lines and the orders' status/invoice link are each written with
+    bulk queries.
+    """
+    orders = list(orders.filter(status='confirmed', invoice__isnull=True)
+                  .select_for_update().order_by('pk').only('pk', 'customer_id'))
+    if not orders:
+        return []
+    issue_date = issue_date or timezone.localdate()
+
+    lines_by_order = {}
+    for row in (SalesOrderLine.objects.filter(order_id__in=[o.pk for o in orders]).order_by('order_id', 'pk')
+                .values('order_id', 'product_id', 'qty', 'unit_price', 'tax_percent')):
+        lines_by_order.setdefault(row['order_id'], []).append(row)
+
+    groups = {}
+    for o in orders:
+        groups.setdefault(o.customer_id if merge else o.pk, []).append(o)
+    groups = list(groups.values())
+
+    numbers = CustomerInvoice.reserve_numbers(issue_date.year, len(groups))
+    invoices, invoice_lines = [], []
+    for number, group in zip(numbers, groups):
+        lines = [CustomerInvoiceLine(product_id=row['product_id'], qty=row['qty'], unit_price=row['unit_price'],
+                                     tax_percent=row['tax_percent'])
+                 for o in group for row in lines_by_order.get(o.pk, ())]
+        totals = apply_prices(lines)
+        invoices.append(CustomerInvoice(
+            number=number, reference=number, customer_id=group[0].customer_id, issue_date=issue_date,
+            untaxed_total=totals.untaxed, tax_total=totals.tax, grand_total=totals.total,
+            amount_due=totals.total, created_by=created_by))
+        invoice_lines.append(lines)
+
+    CustomerInvoice.objects.bulk_create(invoices, batch_size=batch_size)
+    for inv, lines, group in zip(invoices, invoice_lines, groups):
+        for line in lines:
+            line.invoice = inv
+        for o in group:
+            o.invoice = inv
+            o.status = 'invoiced'
+    CustomerInvoiceLine.objects.bulk_create([l for lines in invoice_lines for l in lines], batch_size=batch_size,
+                                            update_totals=False)
+    SalesOrder.objects.bulk_update(orders, ['invoice', 'status'], batch_size=batch_size)
+    return invoices
+
+
+def run_recurring_invoices(as_of=None, batch_size=500, created_by=None):
+    """
+    Bill every active recurring template whose next_run_date is on or before
+    as_of (default today), one invoice per template per period, catching up
+    on missed periods. Templates are taken batch_size at a time through the
+    (active, next_run_date) index; each batch is one transaction that reserves
+    its invoice numbers in a block per year, bulk-creates the invoices, lines
+    and RecurringInvoiceRun rows, and moves the templates' next_run_date on.
+
+    A period that already has a run row is never billed again, so rerunning
+    after a crash is safe. Invoices of auto_confirm templates that are still
+    draft (including ones left over from an interrupted run) are then posted
+    through confirm_documents(). Returns {'created': n, 'confirmed': [...], 'failed': [...]}.
+    """
+    as_of = as_of or timezone.localdate()
+    created = 0
+    while True:
+        with transaction.atomic():
+            templates = list(RecurringInvoice.objects
+                             .filter(active=True, next_run_date__lte=as_of)
+                             .select_for_update().order_by('next_run_date', 'pk')[:batch_size])
+            if not templates:
+                break
+            created += _bill_recurring_batch(templates, created_by)
+
+    result = confirm_documents(
+        invoices=CustomerInvoice.objects.filter(recurring_run__template__auto_confirm=True,
+                                                status=CustomerInvoice.DRAFT),
+        created_by=created_by)
+    result['created'] = created
+    return result
+
+
+def _bill_recurring_batch(templates, created_by):
+    """ Bill each template's next_run_date period; must run inside a transaction. """
+    lines_by_template = {}
+    for line in RecurringInvoiceLine.objects.filter(template__in=templates).order_by('template_id', 'pk'):
+        lines_by_template.setdefault(line.template_id, []).append(line)
+    already_run = set(RecurringInvoiceRun.objects
+                      .filter(template__in=templates, period__in={t.next_run_date for t in templates})
+                      .values_list('template_id', 'period'))
+
+    to_bill, runs = [], []
+    for t in templates:
+        period = t.next_run_date
+        if t.end_date and period > t.end_date:
+            t.active = False
+            continue
+        t.next_run_date = t.period_after(period)
+        if (t.pk, period) in already_run:
+            continue
+        lines = [CustomerInvoiceLine(product_id=l.product_id, qty=l.qty, unit_price=l.unit_price,
+                                     tax_percent=l.tax_percent)
+                 for l in lines_by_template.get(t.pk, ())]
+        run = RecurringInvoiceRun(template=t, period=period)
+        runs.append(run)
+        if lines:
+            to_bill.append((t, period, lines, run))
+
+    numbers = {}
+    for year in {period.year for _t, period, _lines, _run in to_bill}:
+        count = sum(1 for _t, period, _lines, _run in to_bill if period.year == year)
+        numbers[year] = iter(CustomerInvoice.reserve_numbers(year, count))
+
+    invoices = []
+    for t, period, lines, run in to_bill:
+        totals = apply_prices(lines)
+        number = next(numbers[period.year])
+        invoices.append(CustomerInvoice(
+            number=number, reference=number, customer_id=t.customer_id, issue_date=period,
+            due_date=period + timedelta(days=t.due_days) if t.due_days else None,
+            untaxed_total=totals.untaxed, tax_total=totals.tax, grand_total=totals.total,
+            amount_due=totals.total, created_by=created_by))
+    CustomerInvoice.objects.bulk_create(invoices)
+    for inv, (_t, _period, lines, run) in zip(invoices, to_bill):
+        run.invoice = inv
+        for line in lines:
+            line.invoice = inv
+    CustomerInvoiceLine.objects.bulk_create([l for _t, _p, lines, _r in to_bill for l in lines], update_totals=False)
+    RecurringInvoiceRun.objects.bulk_create(runs)
+    RecurringInvoice.objects.bulk_update(templates, ['next_run_date', 'active'])
+    return len(invoices)
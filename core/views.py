@@ -1,30 +1,38 @@
 from django.shortcuts import render, redirect , get_object_or_404
 from django.core.paginator import Paginator
 from .models import *
-from .utils import hash_pw, verify_pw, validate_password_complexity, post_journal_entry
+from .hsn import hsn_tax_index
+from .hsn_search import hsn_search_index
+from .gst_client import gst_client
+from .utils import (hash_pw, verify_pw, validate_password_complexity, post_journal_entry, cached_report,
+                    JournalError, confirm_documents, select_draft_documents,
+                    invoice_sales_orders, resolve_posting_accounts, active_taxes)
 from django.utils import timezone
 import json
+import re
+import hashlib
+from functools import wraps
 from pathlib import Path
 from django.conf import settings
 from django.http import JsonResponse
-import requests
-import traceback
 from django.core.cache import cache
 from django.contrib import messages
 from django.urls import reverse
 from decimal import Decimal,InvalidOperation
-from datetime import date
+from datetime import date, timedelta
 from django.db import transaction
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 import calendar
-from django.db.models import Sum
+from django.db.models import Sum, F, Q, Count, OuterRef, Subquery, DecimalField
+from django.db.models.functions import Coalesce
 from django.views.decorators.http import require_POST
 from django.contrib.admin.views.decorators import staff_member_required
 import razorpay
 import logging 
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponse , HttpResponseForbidden
+from django.http import HttpResponse , HttpResponseForbidden, StreamingHttpResponse
+import csv
 
 DATE_FMT = "%Y-%m-%d"
 
@@ -83,14 +91,22 @@ def profit_and_loss(request):
         last_day = calendar.monthrange(today.year, today.month)[1]
         end = date(today.year, today.month, last_day)
 
-    expenses_qs = (JournalLine.objects
-                   .filter(account__account_type__iexact='expense', entry__date__range=(start, end))
+    ctx = cached_report('profit_and_loss', {'start': start, 'end': end},
+                        lambda: _profit_and_loss_data(start, end))
+    return render(request, 'reports/pnl.html', ctx)
+
+
+def _profit_and_loss_data(start, end):
+    # sums come from the daily (account, date) rollup, not raw journal lines
+    rollup = AccountDailyBalance.objects.order_by()
+    expenses_qs = (rollup
+                   .filter(account__account_type__iexact='expense', date__range=(start, end))
                    .values('account__id', 'account__name')
                    .annotate(amount=Sum('debit'))
                    .order_by('account__name'))
 
-    income_qs = (JournalLine.objects
-                 .filter(account__account_type__iexact='income', entry__date__range=(start, end))
+    income_qs = (rollup
+                 .filter(account__account_type__iexact='income', date__range=(start, end))
                  .values('account__id', 'account__name')
                  .annotate(amount=Sum('credit'))
                  .order_by('account__name'))
@@ -99,12 +115,12 @@ def profit_and_loss(request):
     fallback = False
     if not expenses_qs.exists() and not income_qs.exists():
         fallback = True
-        expenses_qs = (JournalLine.objects
+        expenses_qs = (rollup
                        .filter(account__account_type__iexact='expense')
                        .values('account__id','account__name')
                        .annotate(amount=Sum('debit'))
                        .order_by('account__name'))
-        income_qs = (JournalLine.objects
+        income_qs = (rollup
                      .filter(account__account_type__iexact='income')
                      .values('account__id','account__name')
                      .annotate(amount=Sum('credit'))
@@ -123,7 +139,7 @@ def profit_and_loss(request):
         'total_expenses': total_expenses, 'total_income': total_income,
         'net': net, 'fallback_full_history': fallback,
     }
-    return render(request, 'reports/pnl.html', ctx)
+    return ctx
 
 def parse_date_safe(s):
     """Convert posted string into a date object, or return None if invalid."""
@@ -140,6 +156,61 @@ def parse_date_safe(s):
             pass
     return None
 
+LINE_FIELD_RE = re.compile(r'^product_(\d+)$')
+
+
+def _posted_decimal(value):
+    try:
+        return Decimal(str(value or '0').replace(',', ''))
+    except (InvalidOperation, ValueError):
+        return Decimal('0.00')
+
+
+def posted_document_lines(request):
+    """
+    Read a document's lines from a POST, with no limit on their number.
+    Either a `lines` field holding a JSON array of
+    {"product": id, "qty": .., "unit_price": .., "tax_percent": ..} objects,
+    or the form's indexed product_N / qty_N / unit_price_N / tax_percent_N
+    fields (any N, in N order). Rows without a product are dropped; bad
+    numbers read as 0. Returns a list of dicts with product_id, qty,
+    unit_price and tax_percent.
+    """
+    raw = request.POST.get('lines')
+    if raw:
+        try:
+            items = json.loads(raw)
+        except ValueError:
+            items = None
+        if not isinstance(items, list):
+            raise ValueError("lines must be a JSON array of line objects.")
+    else:
+        indexes = sorted(int(m.group(1)) for m in map(LINE_FIELD_RE.match, request.POST) if m)
+        items = [{'product': request.POST.get(f'product_{i}'),
+                  'qty': request.POST.get(f'qty_{i}'),
+                  'unit_price': request.POST.get(f'unit_price_{i}'),
+                  'tax_percent': request.POST.get(f'tax_percent_{i}')}
+                 for i in indexes]
+
+    rows = []
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            product_id = int(item.get('product') or 0)
+        except (TypeError, ValueError):
+            product_id = 0
+        if not product_id:
+            continue
+        rows.append({
+            'product_id': product_id,
+            'qty': _posted_decimal(item.get('qty')),
+            'unit_price': _posted_decimal(item.get('unit_price')),
+            'tax_percent': _posted_decimal(item.get('tax_percent')),
+        })
+    return rows
+
+
 def require_login(view_fn):
     def wrapper(request, *args, **kwargs):
         user_id = request.session.get('user_id')
@@ -244,9 +315,77 @@ def require_login(fn):
         return fn(req, *args, **kwargs)
     return wrapper
 
+
+def _request_fingerprint(request):
+    """ sha256 over the path and payload (minus the CSRF token and the key itself). """
+    h = hashlib.sha256(request.path.encode('utf-8'))
+    if request.content_type == 'application/json':
+        h.update(request.body)
+    else:
+        for name in sorted(request.POST):
+            if name not in ('csrfmiddlewaretoken', 'idempotency_key'):
+                h.update(f"\0{name}={request.POST.getlist(name)!r}".encode('utf-8'))
+    return h.hexdigest()
+
+
+def idempotent(view_fn):
+    """
+    Make a POST view safe to retry. The client sends a key, either as an
+    `idempotency_key` form field (see the {% idempotency_key %} tag) or as an
+    Idempotency-Key header. The first request with a key runs the view and
+    stores its response. Later requests with the same key get that response
+    back without running the view again. Requests without a key run as
+    before.
+
+    A view can set request.idempotency_object to the object it created, so
+    the key records it.
+    """
+    @wraps(view_fn)
+    def wrapper(request, *args, **kwargs):
+        key = (request.POST.get('idempotency_key') if request.content_type != 'application/json' else None) \
+            or request.headers.get('Idempotency-Key')
+        if request.method != 'POST' or not key:
+            return view_fn(request, *args, **kwargs)
+
+        ttl = timedelta(hours=getattr(settings, 'IDEMPOTENCY_KEY_TTL_HOURS', 24))
+        record, created = IdempotencyKey.claim(view_fn.__name__, key[:100], request.session.get('user_id'),
+                                               _request_fingerprint(request), ttl)
+        if not created:
+            if record.user_id != request.session.get('user_id') or record.fingerprint != _request_fingerprint(request):
+                return JsonResponse({'error': 'Idempotency key was already used for a different request.'},
+                                    status=422)
+            if record.state == IdempotencyKey.PENDING:
+                return JsonResponse({'error': 'A request with this idempotency key is still being processed.'},
+                                    status=409)
+            response = HttpResponse(record.response_body, status=record.response_status,
+                                    content_type=record.response_content_type or None)
+            if record.response_location:
+                response['Location'] = record.response_location
+            response['Idempotent-Replay'] = 'true'
+            if record.response_location and 'json' not in record.response_content_type:
+                messages.info(request, "This was already submitted; showing the original result.")
+            return response
+
+        try:
+            response = view_fn(request, *args, **kwargs)
+        except Exception:
+            record.delete()  # let the client retry
+            raise
+        if response.status_code >= 500:
+            record.delete()
+        else:
+            record.complete(response, getattr(request, 'idempotency_object', None))
+        return response
+    return wrapper
+
 @require_login
 def dashboard(request):
-    return render(request, 'dashboard.html', {'user': request.user})
+    # revenue tile: income balances from the AccountBalance store
+    revenue = (AccountBalance.objects
+               .filter(account__account_type='income')
+               .aggregate(credits=Sum('credit_total'), debits=Sum('debit_total')))
+    total_revenue = (revenue['credits'] or Decimal('0.00')) - (revenue['debits'] or Decimal('0.00'))
+    return render(request, 'dashboard.html', {'user': request.user, 'total_revenue': total_revenue})
 
 # Contacts
 @require_login
@@ -287,7 +426,7 @@ def products_list(request):
         products = paginator.get_page(1)
 
     # Provide all taxes for filters or product add link
-    taxes = Tax.objects.filter(active=True).order_by('value')
+    taxes = sorted(active_taxes(), key=lambda t: t.value)
 
     return render(request, 'products_list.html', {
         'products': products,
@@ -296,7 +435,7 @@ def products_list(request):
 
 @require_login
 def products_add(request):
-    taxes = Tax.objects.filter(active=True).order_by('name')
+    taxes = active_taxes()
     if request.method == 'POST':
         p = Product.objects.create(
             name = request.POST.get('name',''),
@@ -409,7 +548,7 @@ def products_list(request):
 
 @require_login
 def products_add(request):
-    taxes = Tax.objects.filter(active=True).order_by('value')  # if you want to show taxes in form
+    taxes = sorted(active_taxes(), key=lambda t: t.value)  # if you want to show taxes in form
     if request.method == 'POST':
         # Basic values that most Product models will accept
         name = request.POST.get('name') or ''
@@ -511,7 +650,7 @@ def products_edit(request, pk):
     if getattr(request.user, 'role', '') != 'admin':
         return render(request, 'error.html', {'message':'Only admin can edit products.'})
     p = get_object_or_404(Product, id=pk)
-    taxes = Tax.objects.filter(active=True).order_by('name')
+    taxes = active_taxes()
     if request.method == 'POST':
         p.name = request.POST.get('name','') or p.name
         p.product_type = request.POST.get('product_type','goods')
@@ -548,45 +687,6 @@ def products_delete(request, pk):
         return redirect('products_list')
     return render(request, 'products_delete.html', {'product': p})
 
-# @require_login
-def _call_gst_api(input_text, selected_type, category):
-    """
-    Call GST HSN endpoint once with given params.
-    Returns parsed json body or None on failure.
-    """
-    gst_base = "https://services.gst.gov.in/commonservices/hsn/search/qsearch"
-    params = {'inputText': input_text, 'selectedType': selected_type, 'category': category}
-    headers = {
-        # Real browser UA helps avoid simple bot blocks
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/140 Safari/537.36',
-        'Accept': 'application/json, text/plain, */*',
-        # Add Referer/Origin like a browser might send
-        'Referer': 'https://services.gst.gov.in/',
-        'Origin': 'https://services.gst.gov.in'
-    }
-    try:
-        # use session for connection reuse
-        s = requests.Session()
-        resp = s.get(gst_base, params=params, headers=headers, timeout=10)
-        # print useful debug
-        print(f"[gst_hsn_lookup] GET {resp.url} -> status {resp.status_code}")
-        # show a small snippet of body for debugging (do NOT log huge bodies in prod)
-        body_snippet = resp.text[:800].replace('\n',' ')
-        print("[gst_hsn_lookup] body snippet:", body_snippet)
-        if resp.status_code == 200:
-            try:
-                return resp.json()
-            except Exception as e:
-                print("[gst_hsn_lookup] JSON parse failed:", e)
-                return None
-        else:
-            return None
-    except Exception as exc:
-        print("[gst_hsn_lookup] network/exception:", exc)
-        print(traceback.format_exc())
-        return None
-
-
 # @require_login
 @require_login
 def gst_hsn_lookup(request):
@@ -594,52 +694,14 @@ def gst_hsn_lookup(request):
     if not q:
         return JsonResponse({'results': []})
 
-    # API call
-    attempts = [('byCode','null'), ('byDesc','P'), ('byDesc','S')] if q.isdigit() else [('byDesc','P'), ('byDesc','S'), ('byCode','null')]
-    results = []
-
-    for sel_type, cat in attempts:
-        r = _call_gst_api_debug(q, sel_type, cat)
-        if r.get('ok') and isinstance(r.get('json'), dict):
-            body = r['json']
-            data = body.get('data')
-            if isinstance(data, list):
-                for item in data:
-                    hsn = item.get('c') or item.get('hsn')
-                    desc = item.get('n') or item.get('description')
-                    if hsn:
-                        results.append({'hsn': hsn, 'description': desc})
-                if results:
-                    break
-    return JsonResponse({'results': results})
-
-
-def _call_gst_api_debug(input_text, selected_type, category, verify_ssl=True):
-    gst_base = "https://services.gst.gov.in/commonservices/hsn/search/qsearch"
-    params = {'inputText': input_text, 'selectedType': selected_type, 'category': category}
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/140 Safari/537.36',
-        'Accept': 'application/json, text/plain, */*',
-        'Referer': 'https://services.gst.gov.in/',
-        'Origin': 'https://services.gst.gov.in'
-    }
-    try:
-        s = requests.Session()
-        resp = s.get(gst_base, params=params, headers=headers, timeout=12, verify=verify_ssl)
-        print(f"[gst_hsn_lookup] GET {resp.url} -> status {resp.status_code}")
-        snippet = (resp.text or '')[:1200].replace('\n',' ')
-        print("[gst_hsn_lookup] body snippet:", snippet[:1000])
-        # try parse json safely
-        try:
-            body_json = resp.json()
-        except Exception:
-            body_json = None
-        return {'ok': True, 'status': resp.status_code, 'text': resp.text, 'json': body_json}
-    except Exception as e:
-        tb = traceback.format_exc()
-        print("[gst_hsn_lookup] exception while calling gst:", e)
-        print(tb)
-        return {'ok': False, 'error': str(e), 'traceback': tb}
+    results = hsn_search_index().search(q)
+    if results or request.GET.get('remote') not in ('1', 'true'):
+        return JsonResponse({'results': results, 'source': 'local'})
+
+    # nothing locally and the caller asked for the GST portal
+    results = gst_client().search_hsn(q)
+    return JsonResponse({'results': results, 'source': 'remote'})
+
 
 @require_login
 def ajax_create_tax_from_hsn(request):
@@ -652,104 +714,22 @@ def ajax_create_tax_from_hsn(request):
     if cached:
         return JsonResponse({'ok': True, **cached})
 
-    # 1) Try remote TAX API if configured
-    api_base = getattr(settings, 'TAX_API_BASE', None)
-    rate = None
-    api_source = None
-    raw_resp = None
-    if api_base:
-        try:
-            resp = requests.get(api_base, params={'hsn': hsn}, headers={'Accept': 'application/json'}, timeout=8)
-            raw_resp = {'status_code': resp.status_code, 'text_snippet': (resp.text or '')[:1000]}
-            if resp.status_code == 200:
-                try:
-                    data = resp.json()
-                except Exception as e:
-                    data = None
-                    raw_resp['json_error'] = str(e)
-
-                # parse multiple likely shapes
-                if isinstance(data, dict):
-                    for key in ('rate', 'gst_rate', 'value', 'sale_rate', 'purchase_rate'):
-                        if key in data and data[key] not in (None, ''):
-                            try:
-                                rate = float(data[key])
-                                api_source = 'remote'
-                                break
-                            except Exception:
-                                continue
-                    # maybe nested data list
-                    if rate is None and isinstance(data.get('data'), list) and data['data']:
-                        item = data['data'][0]
-                        for key in ('rate','gst_rate','value'):
-                            if key in item:
-                                try:
-                                    rate = float(item[key])
-                                    api_source = 'remote'
-                                    break
-                                except:
-                                    continue
-                # if data is a list directly
-                elif isinstance(data, list) and data:
-                    item = data[0]
-                    if isinstance(item, dict):
-                        for key in ('rate','gst_rate','value'):
-                            if key in item:
-                                try:
-                                    rate = float(item[key])
-                                    api_source = 'remote'
-                                    break
-                                except:
-                                    continue
-        except Exception as e:
-            raw_resp = {'network_error': str(e)}
-            # move on to fallback below
+    # 1) Try the remote TAX API if configured (pooled, cached, behind a circuit breaker)
+    rate = gst_client().tax_rate(hsn)
+    api_source = 'remote' if rate is not None else None
 
-    # 2) If remote didn't yield a rate, use local fallback JSON (if exists)
+    # 2) If remote didn't yield a rate, use the local HSN map (parsed once per process)
     if rate is None:
-        try:
-            data_path = Path(settings.BASE_DIR) / 'data' / 'hsn_tax_map.json'
-            if data_path.exists():
-                with open(data_path, 'r', encoding='utf-8') as f:
-                    mapping = json.load(f)
-                # try exact, then zero-padded 4-digit code (common), then startswith
-                entry = mapping.get(hsn) or mapping.get(hsn.zfill(4))
-                if not entry:
-                    # some local maps store list or nested object
-                    # attempt case-insensitive lookup by iterating keys
-                    for k, v in mapping.items():
-                        if str(k).strip() == str(hsn).strip():
-                            entry = v
-                            break
-                if entry:
-                    # entry may be dict with 'gst_rate' or 'rate' etc.
-                    for key in ('gst_rate','rate','value'):
-                        if key in entry and entry[key] not in (None, ''):
-                            try:
-                                rate = float(entry[key])
-                                api_source = 'local'
-                                break
-                            except:
-                                continue
-                    # if entry is a numeric value
-                    if rate is None:
-                        try:
-                            # allow entry to be plain value like "5" or 5
-                            rate = float(entry)
-                            api_source = 'local'
-                        except:
-                            rate = None
-        except Exception as e:
-            # ignore - we'll return error below if still no rate
-            print("[ajax_create_tax_from_hsn] local fallback error:", e)
+        rate = hsn_tax_index().rate(hsn)
+        if rate is not None:
+            api_source = 'local'
 
     if rate is None:
-        # helpful server-side debug - returns raw_resp when DEBUG
+        # helpful server-side debug when DEBUG
         debug = {}
         if getattr(settings, 'DEBUG', False):
-            debug['api_raw'] = raw_resp
-            data_path = str(Path(settings.BASE_DIR) / 'data' / 'hsn_tax_map.json')
-            debug['local_data_path'] = data_path
+            debug['api'] = {'tax_api_base': getattr(settings, 'TAX_API_BASE', None), 'circuits': gst_client().status()}
+            debug['local_data_path'] = str(hsn_tax_index().path)
         return JsonResponse({'ok': False, 'error': 'no rate returned by tax API or local fallback', 'debug': debug})
 
     # create/find Tax master (ensure consistent naming)
@@ -772,18 +752,17 @@ def hsn_tax_lookup(request):
     hsn = (request.GET.get('hsn') or '').strip()
     if not hsn:
         return JsonResponse({'rate': None})
-    data_path = Path(settings.BASE_DIR) / 'data' / 'hsn_tax_map.json'
-    if not data_path.exists():
-        return JsonResponse({'rate': None})
+    return JsonResponse({'rate': hsn_tax_index().rate(hsn)})
+
+@require_login
+def hsn_children(request):
+    """ Typeahead: codes under ?prefix= with description and (inherited) rate. """
+    prefix = (request.GET.get('prefix') or '').strip()
     try:
-        with open(data_path, 'r', encoding='utf-8') as f:
-            mapping = json.load(f)
-        entry = mapping.get(hsn) or mapping.get(hsn.zfill(4))
-        if entry:
-            return JsonResponse({'rate': entry.get('gst_rate')})
-    except Exception:
-        pass
-    return JsonResponse({'rate': None})
+        limit = min(max(int(request.GET.get('limit') or 20), 1), 100)
+    except ValueError:
+        limit = 20
+    return JsonResponse({'results': hsn_tax_index().children(prefix, limit=limit)})
 
 # Taxes views (use your require_login decorator as before)
 
@@ -854,7 +833,8 @@ def accounts_list(request):
         for name, typ, code in defaults:
             Account.objects.get_or_create(name=name, defaults={'account_type': typ, 'code': code})
 
-    accounts = Account.objects.order_by('account_type', 'name')
+    # running balances come from the AccountBalance store (no JournalLine scan)
+    accounts = Account.objects.select_related('balance').order_by('account_type', 'name')
     return render(request, 'accounts_list.html', {'accounts': accounts})
 
 @require_login
@@ -903,7 +883,7 @@ def accounts_delete(request, pk):
 
 # --- Ajax to provide tax list for product form ---
 def ajax_active_taxes(request):
-    taxes = Tax.objects.filter(active=True).order_by('name')
+    taxes = active_taxes()
     data = []
     for t in taxes:
         data.append({'id': t.id, 'name': t.name, 'computation': t.computation, 'value': str(t.value), 'apply_on': t.apply_on})
@@ -930,35 +910,29 @@ def vendor_bill_confirm_view(request, pk):
 
 @require_login
 def vendor_bills_list(request):
-    bills = VendorBill.objects.order_by('pk')
-    return render(request, 'vendor_bill_list.html', {'bills': bills})
-# core/views.py
-# from django.db.models import Sum
-# from django.db.models.functions import Coalesce
-# from django.shortcuts import render
-# from .models import VendorBill
-
-# def vendor_bills_list(request):
-#     # adjust the filter/order as you already have
-#     bills_qs = VendorBill.objects.all().order_by('-bill_date')
-
-#     # annotate each bill with total_amount as sum of related lines' line_total (or 0)
-#     bills = bills_qs.annotate(
-#         total_amount=Coalesce(Sum('lines__line_total'), 0)
-#     )
-
-#     context = {
-#         'bills': bills,
-#     }
-#     return render(request, 'sales/vendor_bills.html', context)
+    """Bills with their stored totals; ?outstanding=1 lists only bills with an unpaid balance."""
+    bills = VendorBill.objects.select_related('vendor')
+    only_outstanding = request.GET.get('outstanding') in ('1', 'true', 'yes')
+    if only_outstanding:
+        bills = bills.outstanding().order_by('-outstanding_amount', 'bill_date')
+    else:
+        bills = bills.order_by('pk')
+    return render(request, 'vendor_bill_list.html', {'bills': bills, 'only_outstanding': only_outstanding})
 
 
 @require_login
+@idempotent
+@transaction.atomic
 def vendor_bill_add(request):
     contacts = Contact.objects.all()
     products = Product.objects.all()
     if request.method == 'POST':
         vendor_id = request.POST.get('vendor')
+        try:
+            rows = posted_document_lines(request)
+        except ValueError as e:
+            messages.error(request, str(e))
+            return redirect('vendor_bill_add')
         bill = VendorBill.objects.create(
             vendor_id = int(vendor_id),
             bill_date = request.POST.get('bill_date') or timezone.now().date(),
@@ -966,48 +940,36 @@ def vendor_bill_add(request):
             reference = request.POST.get('reference',''),
             created_by = str(request.user) if getattr(request,'user',None) else None
         )
-        # simple lines: handle up to N lines; form fields: product_1, qty_1, unit_price_1, tax_percent_1 ...
-        i = 1
-        while True:
-            pid = request.POST.get(f'product_{i}')
-            if not pid:
-                break
-            qty = request.POST.get(f'qty_{i}') or 0
-            unit_price = request.POST.get(f'unit_price_{i}') or 0
-            tax_percent = request.POST.get(f'tax_percent_{i}') or 0
-            prod = Product.objects.filter(pk=int(pid)).first()
-            VendorBillLine.objects.create(
+        # lines: JSON `lines` array or product_N / qty_N / ... fields, any number of them;
+        # products load in one query and the lines go in with one bulk insert
+        products_by_id = Product.objects.in_bulk({r['product_id'] for r in rows})
+        expense_acc = resolve_posting_accounts()['purchase']
+        lines = []
+        for r in rows:
+            prod = products_by_id.get(r['product_id'])
+            lines.append(VendorBillLine(
                 bill=bill,
                 product=prod,
                 hsn = prod.hsn if prod else '',
-                account = Account.objects.filter(name__icontains='Purchase Expense').first(),
-                qty = qty,
-                unit_price = unit_price,
-                tax_percent = tax_percent
-            )
-            i += 1
+                account = expense_acc,
+                qty = r['qty'],
+                unit_price = r['unit_price'],
+                tax_percent = r['tax_percent']
+            ))
+        VendorBillLine.objects.bulk_create(lines)
+        request.idempotency_object = bill
         return redirect('vendor_bills_list')
     return render(request, 'vendor_bill_add.html', {'contacts': contacts, 'products': products})
 
 def vendor_bill_detail(request, pk):
-    bill = get_object_or_404(VendorBill, pk=pk)
-
-    # robustly get the related lines queryset (works whether you used 'lines' related_name or default)
-    lines_qs = getattr(bill, 'lines', None) or getattr(bill, 'vendorbillline_set')
+    bill = get_object_or_404(VendorBill.objects.select_related('vendor'), pk=pk)
 
-    # compute total from lines (preferred), fallback to bill stored field if exists
-    total = Decimal('0.00')
-    if lines_qs is not None:
-        total = lines_qs.aggregate(total=Sum('line_total'))['total'] or Decimal('0.00')
-    else:
-        # fallback to possible fields on bill
-        total = Decimal(str(getattr(bill, 'total_amount', None) or getattr(bill, 'grand_total', None) or 0))
-
-    # sum of payments made against this bill
-    paid = bill.payments.aggregate(paid=Sum('amount'))['paid'] or Decimal('0.00')
+    # totals are stored on the bill (see VendorBill.recompute_totals)
+    total = bill.total_amount
+    paid = bill.paid_amount
 
     # outstanding (zero or negative means fully paid)
-    outstanding = (Decimal(total) - Decimal(paid)).quantize(Decimal('0.01'))
+    outstanding = bill.outstanding_amount
     is_paid = (outstanding <= Decimal('0.00'))
 
     ctx = {
@@ -1207,114 +1169,21 @@ def vendor_bill_confirm(request, pk):
         messages.info(request, "This bill already has a journal posted.")
         return redirect('vendor_bill_detail', pk=bill.pk)
 
-    def to_decimal(v):
-        if v is None:
-            return Decimal('0.00')
-        if isinstance(v, Decimal):
-            return v
-        try:
-            return Decimal(str(v))
-        except (InvalidOperation, TypeError, ValueError):
-            return Decimal('0.00')
-
-    # compute totals from lines (most reliable)
-    lines_qs = getattr(bill, 'lines', None) or getattr(bill, 'vendorbillline_set', None)
-    if not lines_qs or not lines_qs.exists():
-        messages.error(request, "Bill has no lines to post.")
-        return redirect('vendor_bill_detail', pk=bill.pk)
-
-    untaxed = Decimal('0.00')
-    tax_total = Decimal('0.00')
-    for ln in lines_qs.all():
-        ln_qty = to_decimal(getattr(ln, 'qty', 0))
-        ln_price = to_decimal(getattr(ln, 'unit_price', 0))
-        untaxed += (ln_qty * ln_price)
-        tax_total += to_decimal(getattr(ln, 'tax_amount', 0))
-
-    total = untaxed + tax_total
-    print(f"[vendor_bill_confirm] bill={bill.pk} totals -> untaxed:{untaxed} tax:{tax_total} total:{total}")
-
-    if total == 0:
-        messages.error(request, "Bill total is zero; cannot post journal.")
-        return redirect('vendor_bill_detail', pk=bill.pk)
-
-    # pick accounts
-    def get_by_name_or_type(names, fallback_type=None):
-        for n in names:
-            try:
-                return Account.objects.get(name__iexact=n)
-            except Account.DoesNotExist:
-                continue
-        if fallback_type:
-            return Account.objects.filter(account_type__iexact=fallback_type).first()
-        return None
-
-    purchase_account = get_by_name_or_type(['Purchase Expense A/c','Purchase Expense','Purchase'], fallback_type='expense')
-    creditor_account = get_by_name_or_type(['Creditors A/c','Creditors','Creditor'], fallback_type='liability')
-    tax_account = Account.objects.filter(name__icontains='tax').first() or Account.objects.filter(name__icontains='gst').first()
-    print("[vendor_bill_confirm] accounts:", purchase_account, tax_account, creditor_account)
-
-    if not purchase_account or not creditor_account:
-        messages.error(request, "Configure Purchase Expense and Creditors accounts first.")
-        return redirect('vendor_bill_detail', pk=bill.pk)
-
     # Who created JE
     created_by = getattr(request, 'user', None) and getattr(request.user, 'username', None) or getattr(bill, 'created_by', None) or 'system'
 
-    # create JE and lines atomically
-    bill_ct = ContentType.objects.get_for_model(bill.__class__)
-    je = JournalEntry.objects.create(
-        date=getattr(bill, 'bill_date', timezone.now().date()),
-        ref=f"Bill/{bill.pk}",
-        narration=f"Bill {bill.pk} vendor:{bill.vendor}",
-        content_type=bill_ct,
-        object_id=bill.pk,
-        created_by=created_by,
-    )
-
-    created_lines = []
-
-    def make_line(account, debit_amt=Decimal('0.00'), credit_amt=Decimal('0.00'), narration=''):
-        debit_amt = to_decimal(debit_amt)
-        credit_amt = to_decimal(credit_amt)
-        if debit_amt == 0 and credit_amt == 0:
-            return None
-        jl = JournalLine.objects.create(entry=je, account=account, debit=debit_amt, credit=credit_amt, narration=narration, date=je.date)
-        created_lines.append(jl)
-        return jl
-
-    if untaxed > 0:
-        make_line(purchase_account, debit_amt=untaxed, narration="Purchase (untaxed)")
-    if tax_total > 0:
-        if tax_account:
-            make_line(tax_account, debit_amt=tax_total, narration="Input Tax")
-        else:
-            make_line(purchase_account, debit_amt=tax_total, narration="Tax added to purchase")
-    make_line(creditor_account, credit_amt=total, narration=f"Payable to {bill.vendor}")
-
-    total_debits = sum((to_decimal(l.debit) for l in created_lines), Decimal('0.00'))
-    total_credits = sum((to_decimal(l.credit) for l in created_lines), Decimal('0.00'))
-
-    print(f"[vendor_bill_confirm] created {len(created_lines)} lines debits={total_debits} credits={total_credits}")
-    if total_debits != total_credits:
-        # this will rollback the transaction because of atomic decorator
-        raise ValueError(f"Unbalanced journal (debits {total_debits} != credits {total_credits}).")
-
-    # link JE to bill and then mark confirmed
-    bill.journal_entry = je
-    if hasattr(bill, 'status'):
-        try:
-            bill.status = VendorBill.CONFIRMED
-        except Exception:
-            bill.status = 'confirmed'
-        bill.save(update_fields=['journal_entry', 'status'])
-    else:
-        bill.save(update_fields=['journal_entry'])
+    # post JE, mark confirmed and open the payable (raises ValueError if the bill can't be posted)
+    try:
+        je = bill.confirm(created_by=created_by)
+    except (ValueError, JournalError) as e:
+        messages.error(request, str(e))
+        return redirect('vendor_bill_detail', pk=bill.pk)
 
     messages.success(request, f"Bill {bill.pk} confirmed and JE {je.id} posted.")
     return redirect('vendor_bill_detail', pk=bill.pk)
 
 @require_login
+@idempotent
 def payment_add(request, bill_pk):
     bill = get_object_or_404(VendorBill, pk=bill_pk)
     # only invoicing users and admin allowed to record payments
@@ -1339,6 +1208,7 @@ def payment_add(request, bill_pk):
         )
         try:
             je = p.post()
+            request.idempotency_object = p
             messages.success(request, f"Payment recorded and journal posted ({je.ref}).")
             return redirect(reverse('vendor_bill_detail', args=[bill.pk]))
         except Exception as e:
@@ -1347,10 +1217,7 @@ def payment_add(request, bill_pk):
             p.delete()
             return redirect(reverse('payment_add', args=[bill.pk]))
 
-    # compute outstanding
-    total = sum([l.line_total for l in bill.lines.all()])
-    paid = sum([pmt.amount for pmt in bill.payments.all()])
-    outstanding = total - paid
+    outstanding = bill.outstanding_amount
     return render(request, 'payment_add.html', {'bill': bill, 'accounts': accounts, 'outstanding': outstanding})
 
 @require_login
@@ -1358,6 +1225,8 @@ def purchase_orders_list(request):
     pos = PurchaseOrder.objects.order_by('-created_at')
     return render(request, 'purchase_orders_list.html', {'pos': pos})
 
+@idempotent
+@transaction.atomic
 def purchase_order_add(request):
     # Show product & contacts for the form
     products = Product.objects.order_by('name')
@@ -1371,55 +1240,39 @@ def purchase_order_add(request):
 
         parsed_date = parse_date_safe(po_date_raw) or timezone.now().date()
 
+        try:
+            rows = posted_document_lines(request)
+        except ValueError as e:
+            messages.error(request, str(e))
+            return redirect('purchase_order_add')
+
         po = PurchaseOrder.objects.create(
             vendor_id = int(vendor_id),
                     po_date = parsed_date,            # ✅ now guaranteed a date object
                     reference_id = reference_from_form
                 )
 
-        # create up to N lines (we used 5 in template)
-        lines_created = 0
-        for i in range(1, 6):
-            pid = request.POST.get(f'product_{i}')
-            if not pid:
-                continue
-            try:
-                product_obj = Product.objects.get(pk=int(pid))
-            except Product.DoesNotExist:
-                continue
-
-            # read posted numbers safely
-            qty_raw = request.POST.get(f'qty_{i}') or '0'
-            unit_price_raw = request.POST.get(f'unit_price_{i}') or '0'
-            tax_percent_raw = request.POST.get(f'tax_percent_{i}') or '0'
-
-            try:
-                qty = Decimal(qty_raw)
-            except Exception:
-                qty = Decimal('0.00')
-            try:
-                unit_price = Decimal(unit_price_raw)
-            except Exception:
-                unit_price = Decimal('0.00')
-            try:
-                tax_percent = Decimal(tax_percent_raw)
-            except Exception:
-                tax_percent = Decimal('0.00')
-
-            # create PO line
-            PurchaseOrderLine.objects.create(
+        # lines: JSON `lines` array or product_N / qty_N / ... fields, any number of them;
+        # unknown products are skipped, the rest go in with one bulk insert
+        products_by_id = Product.objects.in_bulk({r['product_id'] for r in rows})
+        lines = [
+            PurchaseOrderLine(
                 order = po,
-                product = product_obj,
-                hsn = getattr(product_obj, 'hsn', '') or '',
-                qty = qty,
-                unit_price = unit_price,
-                tax_percent = tax_percent
+                product = products_by_id[r['product_id']],
+                hsn = products_by_id[r['product_id']].hsn or '',
+                qty = r['qty'],
+                unit_price = r['unit_price'],
+                tax_percent = r['tax_percent']
             )
-            lines_created += 1
+            for r in rows if r['product_id'] in products_by_id
+        ]
+        PurchaseOrderLine.objects.bulk_create(lines)
+        lines_created = len(lines)
 
         # Now recompute totals and save on PO
         po.recompute_totals()
 
+        request.idempotency_object = po
         messages.success(request, f"Purchase Order {po.po_number} created ({lines_created} lines).")
         return redirect('purchase_order_detail', pk=po.pk)
 
@@ -1449,17 +1302,20 @@ def purchase_order_convert_to_bill(request, pk):
         reference = po.reference_id,
         created_by = po.created_by
     )
-    # copy lines
-    for L in po.lines.all():
-        VendorBillLine.objects.create(
+    # copy lines (priced and added to the bill total by the bulk insert)
+    expense_acc = resolve_posting_accounts()['purchase']
+    VendorBillLine.objects.bulk_create([
+        VendorBillLine(
             bill = vb,
-            product = L.product,
+            product_id = L.product_id,
             hsn = L.hsn,
-            account = Account.objects.filter(name__icontains='Purchase Expense').first(),
+            account = expense_acc,
             qty = L.qty,
             unit_price = L.unit_price,
             tax_percent = L.tax_percent
         )
+        for L in po.lines.all()
+    ])
     # optionally mark PO as sent
     po.state = PurchaseOrder.SENT
     po.save(update_fields=['state'])
@@ -1500,27 +1356,159 @@ def product_info(request, pk):
     }
     return JsonResponse(data)
 
+PARTNER_LEDGER_PAGE_SIZE = 100
+PARTNER_LEDGER_MAX_PAGE_SIZE = 500
+PARTNER_LEDGER_CHUNK_SIZE = 2000
+
+
+def _partner_ledger_queryset(partner):
+    return JournalLine.objects.filter(partner=partner)
+
+
+def _parse_ledger_cursor(raw):
+    """Parse a keyset cursor 'YYYY-MM-DD:<line id>' into (date, id), or None."""
+    if not raw or ':' not in raw:
+        return None
+    day, _, line_id = raw.partition(':')
+    day = parse_date_safe(day)
+    try:
+        line_id = int(line_id)
+    except (TypeError, ValueError):
+        return None
+    return (day, line_id) if day else None
+
+
+def _partner_ledger_window(qs, start=None, end=None, cursor=None):
+    """
+    Split a partner's lines into (opening_balance, window_qs) for a page.
+    Lines are keyed by (date, id): the window holds the lines after the cursor
+    (or from start) up to end, and the opening balance is one aggregate over
+    everything before it.
+    """
+    if cursor:
+        c_date, c_id = cursor
+        before = Q(date__lt=c_date) | Q(date=c_date, id__lte=c_id)
+    elif start:
+        before = Q(date__lt=start)
+    else:
+        before = None
+
+    opening = Decimal('0.00')
+    if before is not None:
+        agg = qs.filter(before).aggregate(debits=Sum('debit'), credits=Sum('credit'))
+        opening = (agg['debits'] or Decimal('0.00')) - (agg['credits'] or Decimal('0.00'))
+
+    window = qs.exclude(before) if before is not None else qs
+    if end:
+        window = window.filter(date__lte=end)
+    window = (window.order_by('date', 'id')
+                    .values('id', 'date', 'entry__ref', 'account__name', 'debit', 'credit'))
+    return opening, window
+
+
+def _iter_ledger_rows(window, opening, limit=None):
+    """Yield ledger row dicts with a running balance, streaming from the DB in chunks."""
+    balance = opening
+    rows = window if limit is None else window[:limit]
+    for l in rows.iterator(chunk_size=PARTNER_LEDGER_CHUNK_SIZE):
+        balance += l['debit'] - l['credit']
+        yield {
+            'id': l['id'],
+            'date': l['date'],
+            'ref': l['entry__ref'],
+            'account': l['account__name'],
+            'debit': l['debit'],
+            'credit': l['credit'],
+            'balance': balance,
+        }
+
+
+class _Echo:
+    """File-like object whose write() just returns the value, for csv.writer streaming."""
+    def write(self, value):
+        return value
+
+
+def _partner_ledger_export(partner, opening, window, fmt):
+    """Stream the full ledger window as CSV or JSON lines in constant memory."""
+    fields = ['date', 'ref', 'account', 'debit', 'credit', 'balance']
+
+    if fmt == 'jsonl':
+        def generate():
+            yield json.dumps({'opening_balance': str(opening)}) + '\n'
+            for row in _iter_ledger_rows(window, opening):
+                yield json.dumps({k: str(row[k]) if row[k] is not None else None for k in fields}) + '\n'
+        content_type = 'application/x-ndjson'
+    else:
+        writer = csv.writer(_Echo())
+
+        def generate():
+            yield writer.writerow(fields)
+            yield writer.writerow(['', 'Opening balance', '', '', '', opening])
+            for row in _iter_ledger_rows(window, opening):
+                yield writer.writerow([row[k] if row[k] is not None else '' for k in fields])
+        content_type = 'text/csv'
+
+    response = StreamingHttpResponse(generate(), content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="partner_ledger_{partner.pk}.{fmt}"'
+    return response
+
+
 def partner_ledger(request, partner_id):
-    from django.contrib.contenttypes.models import ContentType
+    """
+    Partner ledger with date range (?start=&end=) and keyset pagination
+    (?after=<date>:<line id>&limit=N). ?format=csv or ?format=jsonl streams the
+    whole range instead of a page.
+    """
     partner = get_object_or_404(Contact, pk=partner_id)
-    ct = ContentType.objects.get_for_model(Contact)
-    lines = (JournalLine.objects
-             .filter(partner_content_type=ct, partner_object_id=partner.pk)
-             .select_related('entry', 'account')
-             .order_by('entry__date', 'entry_id'))
-    balance = Decimal('0.00')
-    rows = []
-    for l in lines:
-        balance += l.debit - l.credit
-        rows.append({
-            'date': l.date,
-            'ref': l.entry.ref,
-            'account': l.account.name,
-            'debit': l.debit,
-            'credit': l.credit,
-            'balance': balance,
-        })
-    return render(request, 'reports/partner_ledger.html', {'partner': partner, 'rows': rows})
+    start = parse_date_safe(request.GET.get('start'))
+    end = parse_date_safe(request.GET.get('end'))
+    qs = _partner_ledger_queryset(partner)
+
+    fmt = (request.GET.get('format') or '').lower()
+    if fmt in ('csv', 'jsonl'):
+        opening, window = _partner_ledger_window(qs, start=start, end=end)
+        return _partner_ledger_export(partner, opening, window, fmt)
+
+    try:
+        limit = int(request.GET.get('limit') or PARTNER_LEDGER_PAGE_SIZE)
+    except ValueError:
+        limit = PARTNER_LEDGER_PAGE_SIZE
+    limit = max(1, min(limit, PARTNER_LEDGER_MAX_PAGE_SIZE))
+
+    cursor = _parse_ledger_cursor(request.GET.get('after'))
+    page = cached_report(
+        'partner_ledger',
+        {'partner': partner.pk, 'start': start, 'end': end, 'cursor': cursor, 'limit': limit},
+        lambda: _partner_ledger_page(qs, start, end, cursor, limit),
+    )
+    ctx = {
+        'partner': partner,
+        'start': start,
+        'end': end,
+        'limit': limit,
+        **page,
+    }
+    return render(request, 'reports/partner_ledger.html', ctx)
+
+
+def _partner_ledger_page(qs, start, end, cursor, limit):
+    opening, window = _partner_ledger_window(qs, start=start, end=end, cursor=cursor)
+
+    # fetch one extra row to know whether another page follows
+    rows = list(_iter_ledger_rows(window, opening, limit=limit + 1))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = f"{last['date'].isoformat()}:{last['id']}"
+
+    return {
+        'rows': rows,
+        'opening_balance': opening,
+        'closing_balance': rows[-1]['balance'] if rows else opening,
+        'next_cursor': next_cursor,
+    }
 
 from django.db.models import Sum
 
@@ -1550,31 +1538,45 @@ from django.db.models import Sum
 from django.shortcuts import render
 from .models import Account, JournalLine
 
-def balance_sheet(request):
+def _balance_sheet_data(as_of=None):
     """
-    Compute balances and present them so:
+    Build the balance sheet context from per-account debit/credit totals:
       - Assets: debit - credit (positive shown)
       - Liabilities/Equity: show (credit - debit) as positive amounts
-    Also compute Net Profit (Income - Expenses) and include under Equity.
+    Net Profit (Income - Expenses) is derived from the same rows and shown under Equity.
+    as_of: optional date. Without it current balances are read from the
+    AccountBalance store; with it one grouped JournalLine query is run.
     """
-    rows = []
-    accounts = Account.objects.all().order_by('account_type', 'name')
+    if as_of:
+        sums = (JournalLine.objects
+                .filter(date__lte=as_of)
+                .order_by()
+                .values('account_id', 'account__account_type', 'account__name')
+                .annotate(debits=Sum('debit'), credits=Sum('credit'))
+                .order_by('account__account_type', 'account__name'))
+    else:
+        sums = (AccountBalance.objects
+                .values('account_id', 'account__account_type', 'account__name',
+                        debits=F('debit_total'), credits=F('credit_total'))
+                .order_by('account__account_type', 'account__name'))
 
     total_assets = Decimal('0.00')
     total_liabilities = Decimal('0.00')
     total_equity = Decimal('0.00')
+    income_total = Decimal('0.00')
+    expenses_total = Decimal('0.00')
 
     assets = []
     liabilities = []
     equity = []
 
-    for acc in accounts:
-        sums = JournalLine.objects.filter(account=acc).aggregate(debits=Sum('debit'), credits=Sum('credit'))
-        deb = sums.get('debits') or Decimal('0.00')
-        cred = sums.get('credits') or Decimal('0.00')
+    for r in sums:
+        deb = r['debits'] or Decimal('0.00')
+        cred = r['credits'] or Decimal('0.00')
+        acc = {'id': r['account_id'], 'name': r['account__name']}
 
         raw_balance = deb - cred
-        acc_type = (acc.account_type or '').strip().lower()
+        acc_type = (r['account__account_type'] or '').strip().lower()
 
         if acc_type == 'asset':
             display_amount = raw_balance  # debit-positive
@@ -1591,28 +1593,28 @@ def balance_sheet(request):
             equity.append({'account': acc, 'amount': display_amount})
             total_equity += display_amount
 
-    # 🚫 Skip expense and income accounts here
-        elif acc_type in ['expense', 'income']:
-            continue
+        # expense and income accounts only feed net profit
+        elif acc_type == 'income':
+            income_total += (cred - deb)
+        elif acc_type == 'expense':
+            expenses_total += raw_balance
         else:
             # treat unknown types as asset by default (or skip)
             display_amount = raw_balance
             assets.append({'account': acc, 'amount': display_amount})
             total_assets += display_amount
 
-    # compute net profit (income - expenses) and include under equity
-    expenses_total = JournalLine.objects.filter(account__account_type__iexact='expense').aggregate(total=Sum('debit'))['total'] or Decimal('0.00')
-    income_total = JournalLine.objects.filter(account__account_type__iexact='income').aggregate(total=Sum('credit'))['total'] or Decimal('0.00')
-    net_profit = (income_total or Decimal('0.00')) - (expenses_total or Decimal('0.00'))
+    net_profit = income_total - expenses_total
 
     # For presentation, equity side should show net profit as credit-positive:
     # if net_profit positive -> add as credit amount; if negative (loss) -> shows negative number (reduces equity).
-    equity.append({'account': type('X', (), {'name': 'Net Profit (P&L)'}), 'amount': net_profit})
+    equity.append({'account': {'id': None, 'name': 'Net Profit (P&L)'}, 'amount': net_profit})
     total_equity += net_profit
 
-    total_liabilities_equity = (total_liabilities or Decimal('0.00')) + (total_equity or Decimal('0.00'))
+    total_liabilities_equity = total_liabilities + total_equity
 
-    ctx = {
+    return {
+        'as_of': as_of,
         'assets': assets,
         'liabilities': liabilities,
         'equity': equity,
@@ -1622,9 +1624,264 @@ def balance_sheet(request):
         'total_equity': total_equity,
         'net_profit': net_profit,
     }
+
+
+def balance_sheet(request):
+    """
+    Balance sheet for all postings, or up to ?as_of=YYYY-MM-DD when given.
+    """
+    as_of = parse_date_safe(request.GET.get('as_of'))
+    ctx = cached_report('balance_sheet', {'as_of': as_of}, lambda: _balance_sheet_data(as_of))
     return render(request, 'reports/balance_sheet.html', ctx)
 
 
+def _parse_compare_periods(values):
+    """Parse ?compare=YYYY-MM-DD:YYYY-MM-DD values into a list of (start, end) dates; bad values are skipped."""
+    periods = []
+    for raw in values:
+        c_start, _, c_end = (raw or '').partition(':')
+        c_start, c_end = parse_date_safe(c_start), parse_date_safe(c_end)
+        if c_start and c_end and c_start <= c_end:
+            periods.append((c_start, c_end))
+    return periods
+
+
+def _trial_balance_data(start, end, compare=()):
+    """
+    Trial balance per account for [start, end]: opening, period debit, period
+    credit and closing (debit-positive), plus debit/credit/closing for every
+    comparison period. Everything comes from one grouped, conditionally
+    aggregated query over the AccountDailyBalance rollup.
+    """
+    annotations = {
+        'opening_dr': Sum('debit', filter=Q(date__lt=start)),
+        'opening_cr': Sum('credit', filter=Q(date__lt=start)),
+        'period_dr': Sum('debit', filter=Q(date__range=(start, end))),
+        'period_cr': Sum('credit', filter=Q(date__range=(start, end))),
+    }
+    for i, (c_start, c_end) in enumerate(compare):
+        annotations[f'cmp{i}_dr'] = Sum('debit', filter=Q(date__range=(c_start, c_end)))
+        annotations[f'cmp{i}_cr'] = Sum('credit', filter=Q(date__range=(c_start, c_end)))
+        annotations[f'cmp{i}_close_dr'] = Sum('debit', filter=Q(date__lte=c_end))
+        annotations[f'cmp{i}_close_cr'] = Sum('credit', filter=Q(date__lte=c_end))
+
+    last_day = max([end] + [c_end for _, c_end in compare])
+    sums = (AccountDailyBalance.objects
+            .filter(date__lte=last_day)
+            .order_by()
+            .values('account_id', 'account__name', 'account__code', 'account__account_type')
+            .annotate(**annotations)
+            .order_by('account__account_type', 'account__name'))
+
+    zero = Decimal('0.00')
+
+    def money(v):
+        return (v or zero).quantize(zero)
+
+    rows = []
+    totals = {'opening': zero, 'debit': zero, 'credit': zero, 'closing': zero,
+              'compare': [{'debit': zero, 'credit': zero, 'closing': zero} for _ in compare]}
+    for r in sums:
+        opening = money(r['opening_dr']) - money(r['opening_cr'])
+        debit = money(r['period_dr'])
+        credit = money(r['period_cr'])
+        row = {
+            'account_id': r['account_id'],
+            'account': r['account__name'],
+            'code': r['account__code'],
+            'account_type': r['account__account_type'],
+            'opening': opening,
+            'debit': debit,
+            'credit': credit,
+            'closing': opening + debit - credit,
+            'compare': [],
+        }
+        for i in range(len(compare)):
+            row['compare'].append({
+                'debit': money(r[f'cmp{i}_dr']),
+                'credit': money(r[f'cmp{i}_cr']),
+                'closing': money(r[f'cmp{i}_close_dr']) - money(r[f'cmp{i}_close_cr']),
+            })
+        rows.append(row)
+
+        for key in ('opening', 'debit', 'credit', 'closing'):
+            totals[key] += row[key]
+        for t, c in zip(totals['compare'], row['compare']):
+            for key in ('debit', 'credit', 'closing'):
+                t[key] += c[key]
+
+    return {
+        'start': start,
+        'end': end,
+        'compare_periods': [{'start': c_start, 'end': c_end} for c_start, c_end in compare],
+        'rows': rows,
+        'totals': totals,
+    }
+
+
+def _trial_balance_params(request):
+    """Read start/end (defaults to the current month) and compare periods from the query string."""
+    start = parse_date_safe(request.GET.get('start'))
+    end = parse_date_safe(request.GET.get('end'))
+    if not start or not end:
+        today = timezone.localdate()
+        start = date(today.year, today.month, 1)
+        end = date(today.year, today.month, calendar.monthrange(today.year, today.month)[1])
+    compare = _parse_compare_periods(request.GET.getlist('compare'))
+    return start, end, compare
+
+
+def _cached_trial_balance(request):
+    start, end, compare = _trial_balance_params(request)
+    return cached_report('trial_balance', {'start': start, 'end': end, 'compare': compare},
+                         lambda: _trial_balance_data(start, end, compare))
+
+
+@require_login
+def trial_balance(request):
+    ctx = _cached_trial_balance(request)
+    return render(request, 'reports/trial_balance.html', ctx)
+
+
+@require_login
+def trial_balance_json(request):
+    return JsonResponse(_cached_trial_balance(request))
+
+
+AGING_BUCKETS = [
+    # (key, label, min days overdue, max days overdue)
+    ('current', 'Current', None, 0),
+    ('d1_30', '1–30', 1, 30),
+    ('d31_60', '31–60', 31, 60),
+    ('d61_90', '61–90', 61, 90),
+    ('d90_plus', '90+', 91, None),
+]
+
+# side -> (open item kind, document FK on the open item and its payments, payment model)
+AGING_SIDES = {
+    'customers': (OpenItem.RECEIVABLE, 'invoice', CustomerPayment),
+    'vendors': (OpenItem.PAYABLE, 'bill', Payment),
+}
+
+AGING_CHUNK_SIZE = 2000
+
+
+def _sum_subquery(model, fk, field, outer='pk', **filters):
+    """Correlated SUM(field) over `model` rows whose fk points at the outer row's `outer`."""
+    money = DecimalField(max_digits=18, decimal_places=2)
+    inner = (model.objects
+             .filter(**{fk: OuterRef(outer)}, **filters)
+             .order_by()
+             .values(fk)
+             .annotate(s=Sum(field))
+             .values('s'))
+    return Coalesce(Subquery(inner, output_field=money), Decimal('0.00'), output_field=money)
+
+
+def _aging_queryset(side, as_of):
+    """
+    One grouped query per side over the open items of confirmed, posted
+    documents dated up to as_of. Residuals are what is open today, so posted
+    payments dated after as_of are added back to get what was open on as_of;
+    that amount is bucketed per partner with conditional SUMs on days past
+    due_date.
+    """
+    kind, document, payment_model = AGING_SIDES[side]
+    buckets = {}
+    for key, _label, lo, hi in AGING_BUCKETS:
+        cond = Q()
+        if lo is not None:
+            cond &= Q(due_date__lte=as_of - timedelta(days=lo))
+        if hi is not None:
+            cond &= Q(due_date__gte=as_of - timedelta(days=hi))
+        buckets[key] = Sum('open_amount', filter=cond)
+
+    return (OpenItem.objects
+            .filter(kind=kind, document_date__lte=as_of,
+                    **{f'{document}__status': 'confirmed', f'{document}__journal_entry__isnull': False})
+            .annotate(open_amount=F('residual') + _sum_subquery(payment_model, document, 'amount', outer=document,
+                                                                 journal_entry__isnull=False, date__gt=as_of))
+            .filter(open_amount__gt=0)
+            .order_by()
+            .values('partner_id', 'partner__name')
+            .annotate(documents=Count('pk'), outstanding=Sum('open_amount'), **buckets)
+            .order_by('partner__name', 'partner_id'))
+
+
+def _iter_aging_rows(side, as_of):
+    """Yield one row per partner with money-quantized bucket amounts."""
+    zero = Decimal('0.00')
+    for r in _aging_queryset(side, as_of).iterator(chunk_size=AGING_CHUNK_SIZE):
+        row = {
+            'partner_id': r['partner_id'],
+            'partner': r['partner__name'],
+            'documents': r['documents'],
+            'outstanding': (r['outstanding'] or zero).quantize(zero),
+        }
+        for key, _label, _lo, _hi in AGING_BUCKETS:
+            row[key] = (r[key] or zero).quantize(zero)
+        yield row
+
+
+def _aging_params(request):
+    as_of = parse_date_safe(request.GET.get('as_of')) or timezone.localdate()
+    side = request.GET.get('side')
+    sides = [side] if side in AGING_SIDES else list(AGING_SIDES)
+    return as_of, sides
+
+
+def _aging_export(as_of, sides):
+    """Stream every partner row of the requested sides as CSV."""
+    writer = csv.writer(_Echo())
+    header = ['side', 'partner_id', 'partner', 'documents'] + [label for _k, label, _lo, _hi in AGING_BUCKETS] + ['total']
+
+    def generate():
+        yield writer.writerow(header)
+        for side in sides:
+            for row in _iter_aging_rows(side, as_of):
+                yield writer.writerow(
+                    [side, row['partner_id'], row['partner'], row['documents']]
+                    + [row[key] for key, _label, _lo, _hi in AGING_BUCKETS]
+                    + [row['outstanding']])
+
+    response = StreamingHttpResponse(generate(), content_type='text/csv')
+    response['Content-Disposition'] = f'attachment; filename="aging_{as_of.isoformat()}.csv"'
+    return response
+
+
+@require_login
+def aging_report(request):
+    """
+    Receivables / payables aging as of ?as_of=YYYY-MM-DD (default today).
+    ?side=customers|vendors limits to one side; ?format=csv streams the report.
+    """
+    as_of, sides = _aging_params(request)
+    if (request.GET.get('format') or '').lower() == 'csv':
+        return _aging_export(as_of, sides)
+
+    zero = Decimal('0.00')
+    sections = []
+    for side in sides:
+        rows = list(_iter_aging_rows(side, as_of))
+        totals = {key: sum((r[key] for r in rows), zero) for key, _label, _lo, _hi in AGING_BUCKETS}
+        totals['outstanding'] = sum((r['outstanding'] for r in rows), zero)
+        sections.append({
+            'side': side,
+            'title': 'Receivables' if side == 'customers' else 'Payables',
+            'rows': [dict(r, buckets=[r[key] for key, _label, _lo, _hi in AGING_BUCKETS]) for r in rows],
+            'totals': dict(totals, buckets=[totals[key] for key, _label, _lo, _hi in AGING_BUCKETS]),
+        })
+
+    ctx = {
+        'as_of': as_of,
+        'side': sides[0] if len(sides) == 1 else '',
+        'bucket_labels': [label for _k, label, _lo, _hi in AGING_BUCKETS],
+        'sections': sections,
+    }
+    return render(request, 'reports/aging.html', ctx)
+
+
+@idempotent
 @transaction.atomic
 def vendor_bill_payment(request, pk):
     """
@@ -1633,20 +1890,17 @@ def vendor_bill_payment(request, pk):
     """
     bill = get_object_or_404(VendorBill, pk=pk)
 
-    # compute outstanding to prefill amount
-    total_bill = Decimal('0.00')
-    for L in bill.lines.all():
-        total_bill += Decimal(L.line_total or 0)
-    paid_already = Decimal('0.00')
-    for p in bill.payments.all():
-        paid_already += Decimal(p.amount or 0)
-    outstanding = total_bill - paid_already
+    # stored totals prefill the amount
+    total_bill = bill.total_amount
+    paid_already = bill.paid_amount
+    outstanding = bill.outstanding_amount
 
     # candidate payment accounts for dropdown (Cash/Bank)
     payment_accounts = Account.objects.filter(account_type__in=['asset']).order_by('name')
     # prefer common names
-    cash_acc = Account.objects.filter(name__iexact='Cash A/c').first()
-    bank_acc = Account.objects.filter(name__iexact='Bank A/c').first()
+    posting_accounts = resolve_posting_accounts()
+    cash_acc = posting_accounts['cash']
+    bank_acc = posting_accounts['bank']
 
     if request.method == 'POST':
         method = request.POST.get('method', 'bank')
@@ -1697,6 +1951,7 @@ def vendor_bill_payment(request, pk):
             )
             je = payment.post()  # will create JournalEntry via your model method
 
+            request.idempotency_object = payment
             messages.success(request, f"Payment posted (JE #{je.id}) for {bill}.")
             return redirect('vendor_bill_detail', pk=bill.pk)
         except Exception as ex:
@@ -1725,126 +1980,115 @@ def customer_invoice_confirm(request, pk):
         messages.info(request, "Invoice already confirmed.")
         return redirect('customer_invoice_detail', pk=invoice.pk)
 
-    # compute totals from invoice lines
-    untaxed = Decimal('0.00')
-    tax_total = Decimal('0.00')
-    total = Decimal('0.00')
-    for L in invoice.lines.all():
-        untaxed += (Decimal(L.unit_price or 0) * Decimal(L.qty or 0))
-        tax_total += Decimal(L.tax_amount or 0)
-    total = untaxed + tax_total
-
-    if total == 0:
-        messages.error(request, "Invoice total is zero — cannot confirm.")
-        return redirect('customer_invoice_detail', pk=invoice.pk)
-
-    # find accounts: debtors (asset), sales (income), tax (liability)
-    debtors_acc = Account.objects.filter(account_type__iexact='asset').first()
-    if not debtors_acc:
-        messages.error(request, "No asset (Debtors) account configured.")
-        return redirect('customer_invoice_detail', pk=invoice.pk)
-
-    # Prefer sales income account by exact name, else first income
+    # post JE, mark confirmed and open the receivable (raises ValueError if the invoice can't be posted)
     try:
-        sales_acc = Account.objects.get(name__iexact='Sales Income A/c')
-    except Account.DoesNotExist:
-        sales_acc = Account.objects.filter(account_type__iexact='income').first()
-
-    tax_acc = Account.objects.filter(name__icontains='tax').first() or Account.objects.filter(account_type__iexact='liability').first()
-
-    if not sales_acc:
-        messages.error(request, "No sales income account configured.")
+        je = invoice.confirm()
+    except (ValueError, JournalError) as e:
+        messages.error(request, str(e))
         return redirect('customer_invoice_detail', pk=invoice.pk)
 
-    # Create JournalEntry header
-    je = JournalEntry.objects.create(
-        date = invoice.issue_date or timezone.localdate(),
-        narration = f"Invoice {invoice.number or invoice.pk} for {invoice.customer}"
-    )
-
-    def make_line(account, debit=Decimal('0.00'), credit=Decimal('0.00'), narration=''):
-        debit = Decimal(debit or 0)
-        credit = Decimal(credit or 0)
-        if debit == 0 and credit == 0:
-            return None
-        return JournalLine.objects.create(
-            entry=je,
-            account=account,
-            debit=debit,
-            credit=credit,
-            narration=narration,
-            date=je.date
-        )
+    messages.success(request, f"Invoice {invoice.number or invoice.pk} confirmed and journal entry #{je.id} created.")
+    return redirect('customer_invoice_detail', pk=invoice.pk)
 
-    # debit debtors (the customer owes us)
-    make_line(debtors_acc, debit=total, narration=f"Debtor: {invoice.customer}")
 
-    # credit sales for untaxed
-    if untaxed > 0:
-        make_line(sales_acc, credit=untaxed, narration=f"Sales for invoice {invoice.number or invoice.pk}")
+CONFIRM_BATCH_CHUNK_SIZE = 200
 
-    # credit tax account for tax portion
-    if tax_total > 0:
-        if tax_acc:
-            make_line(tax_acc, credit=tax_total, narration=f"Tax for invoice {invoice.number or invoice.pk}")
-        else:
-            # fallback: add tax to sales (not ideal, but ensures JE balances)
-            make_line(sales_acc, credit=tax_total, narration=f"Tax added to sales for invoice {invoice.number or invoice.pk}")
 
-    # link JE to invoice (if field exists)
-    if hasattr(invoice, 'journal_entry'):
-        invoice.journal_entry = je
-
-    invoice.status = CustomerInvoice.CONFIRMED
-    invoice.save(update_fields=['status', 'journal_entry'] if hasattr(invoice, 'journal_entry') else ['status'])
+@require_POST
+@require_login
+@idempotent
+def documents_confirm_batch(request):
+    """
+    Confirm many draft invoices and/or vendor bills in one call.
+    JSON body (all optional): {"kind": "invoices"|"bills"|"all", "start": "YYYY-MM-DD",
+    "end": "YYYY-MM-DD", "partner": <contact id>, "ids": [..], "chunk_size": N}
+    Returns {"confirmed": [...], "failed": [{"type", "id", "error"}]}; failures
+    are per document and never abort the batch.
+    """
+    if getattr(request.user, 'role', '') != 'admin':
+        return JsonResponse({'error': 'Only admin can confirm documents.'}, status=403)
+    try:
+        payload = json.loads(request.body.decode('utf-8') or '{}')
+    except (ValueError, UnicodeDecodeError):
+        return JsonResponse({'error': 'Invalid JSON'}, status=400)
 
-    messages.success(request, f"Invoice {invoice.number or invoice.pk} confirmed and journal entry #{je.id} created.")
-    return redirect('customer_invoice_detail', pk=invoice.pk)
+    kind = payload.get('kind') or 'all'
+    if kind not in ('all', 'invoices', 'bills'):
+        return JsonResponse({'error': "kind must be 'invoices', 'bills' or 'all'"}, status=400)
+    try:
+        partner = int(payload['partner']) if payload.get('partner') else None
+        ids = [int(i) for i in payload.get('ids') or []]
+        chunk_size = max(1, int(payload.get('chunk_size') or CONFIRM_BATCH_CHUNK_SIZE))
+    except (TypeError, ValueError):
+        return JsonResponse({'error': 'partner, ids and chunk_size must be integers'}, status=400)
+
+    invoices, bills = select_draft_documents(
+        kind,
+        start=parse_date_safe(payload.get('start')),
+        end=parse_date_safe(payload.get('end')),
+        partner=partner,
+        ids=ids,
+    )
+    result = confirm_documents(invoices=invoices, bills=bills, chunk_size=chunk_size,
+                               created_by=request.user.username)
+    return JsonResponse(result)
 
 
+@idempotent
 @transaction.atomic
 def create_invoice_from_so(request, so_pk):
     so = get_object_or_404(SalesOrder, pk=so_pk)
+    if so.invoice_id:
+        messages.info(request, f"SO/{so.pk} is already invoiced.")
+        return redirect('customer_invoice_detail', pk=so.invoice_id)
     if request.method == 'POST':
-        # create invoice with issue_date/due_date from SO if available
-        inv = CustomerInvoice.objects.create(
-            customer = so.customer,
-            issue_date = getattr(so, 'so_date', timezone.localdate()),
-            due_date = getattr(so, 'due_date', None),
-            reference = None,  # will be auto-filled in save()
-        )
-        # copy lines (assumes CustomerInvoiceLine model exists)
-        for L in so.lines.all():
-            CustomerInvoiceLine.objects.create(
-                invoice = inv,
-                product = L.product,
-                qty = L.qty,
-                unit_price = L.unit_price,
-                tax_percent = L.tax_percent,
-                # tax_amount / line_total will be computed in line.save() if implemented
-            )
+        if so.status != 'confirmed':
+            messages.error(request, "Confirm the Sales Order before invoicing it.")
+            return redirect('sales_order_detail', pk=so.pk)
+        invoices = invoice_sales_orders(SalesOrder.objects.filter(pk=so.pk))
+        if not invoices:
+            messages.error(request, f"SO/{so.pk} could not be invoiced.")
+            return redirect('sales_order_detail', pk=so.pk)
+        inv = invoices[0]
+        request.idempotency_object = inv
         messages.success(request, f"Invoice {inv.number or inv.pk} created from SO/{so.pk}")
         return redirect('customer_invoice_detail', pk=inv.pk)
     return render(request, 'sales/create_invoice_from_so.html', {'so': so})
 
 
+@require_POST
+@require_login
+@idempotent
 @transaction.atomic
-def customer_invoice_receive_payment(request, pk):
-    invoice = get_object_or_404(CustomerInvoice, pk=pk)
+def sales_orders_invoice(request):
+    """
+    Invoice the ticked confirmed sales orders in one go; 'merge' puts each
+    customer's orders on a single invoice. Nothing is invoiced without a
+    selection (`manage.py invoice_sales_orders` bills every open order).
+    """
+    if getattr(request.user, 'role', '') != 'admin':
+        messages.error(request, "Only admin can invoice sales orders.")
+        return redirect('sales_order_list')
+    ids = [int(i) for i in request.POST.getlist('orders') if i.isdigit()]
+    if not ids:
+        messages.error(request, "Select the sales orders to invoice.")
+        return redirect('sales_order_list')
+    merge = bool(request.POST.get('merge'))
+    invoices = invoice_sales_orders(SalesOrder.objects.filter(pk__in=ids), merge=merge)
+    if invoices:
+        messages.success(request, f"Created {len(invoices)} invoice(s) from confirmed sales orders.")
+    else:
+        messages.info(request, "None of the selected orders is confirmed and uninvoiced.")
+    return redirect('sales_order_list')
 
-    # compute outstanding by summing invoice total minus existing payment JEs referencing this invoice (best-effort)
-    total_invoice = Decimal('0.00')
-    for L in invoice.lines.all():
-        total_invoice += Decimal(L.line_total or 0)
 
-    # simple payments SUM from JournalLines where narration references invoice.number (if we created those JEs)
-    paid = Decimal('0.00')
-    # attempt to find payments already posted linking to invoice.journal entries or via narration:
-    if invoice.journal_entry:
-        # sum of payments is not stored; we'll try to inspect JournalLine for other JEs with narration containing 'Payment for Invoice' etc.
-        pass
+@idempotent
+@transaction.atomic
+def customer_invoice_receive_payment(request, pk):
+    invoice = get_object_or_404(CustomerInvoice, pk=pk)
 
-    outstanding = total_invoice - paid
+    # outstanding comes from the invoice's open item once it has one (posted payments only)
+    outstanding = invoice.open_amount()
 
     if request.method == 'POST':
         # read form data: amount, account (cash/bank id), method, reference
@@ -1868,34 +2112,25 @@ def customer_invoice_receive_payment(request, pk):
             messages.error(request, "Select a valid cash/bank account.")
             return redirect('customer_invoice_receive_payment', pk=invoice.pk)
 
-        if amount > outstanding:
-            messages.error(request, "Payment exceeds outstanding amount (overpayment not allowed here).")
-            return redirect('customer_invoice_receive_payment', pk=invoice.pk)
-
-        # find creditors/debtors account (Debtors)
-        debtors_acc = Account.objects.filter(account_type__iexact='asset').first()
-        if not debtors_acc:
-            messages.error(request, "No Debtors (asset) account configured.")
+        # CustomerPayment.post() takes the amount off the open item atomically and
+        # posts Dr bank/cash, Cr debtors; overpayment raises ValueError
+        try:
+            with transaction.atomic():
+                payment = CustomerPayment.objects.create(
+                    invoice=invoice,
+                    date=timezone.localdate(),
+                    amount=amount,
+                    account=account,
+                    method=method if method in dict(CustomerPayment.PAYMENT_METHODS) else 'other',
+                    reference=reference,
+                    created_by=getattr(request, 'user', None) and getattr(request.user, 'username', None) or 'system',
+                )
+                je = payment.post()
+        except ValueError as e:
+            messages.error(request, f"{e} (overpayment not allowed here).")
             return redirect('customer_invoice_receive_payment', pk=invoice.pk)
 
-        # create journal entry for payment: debit bank/cash (asset), credit debtors (reduces receivable)
-        je = JournalEntry.objects.create(
-            date = timezone.localdate(),
-            narration = f"Payment for Invoice {invoice.number or invoice.pk} ref:{reference}"
-        )
-        # debit bank account (increase asset)
-        JournalLine.objects.create(entry=je, account=account, debit=amount, credit=Decimal('0.00'),
-                                   narration=f"Received via {method} ref:{reference}", date=je.date)
-        # credit debtors (reduce receivable)
-        JournalLine.objects.create(entry=je, account=debtors_acc, debit=Decimal('0.00'), credit=amount,
-                                   narration=f"Payment applied to Invoice {invoice.number or invoice.pk}", date=je.date)
-
-        # Optionally mark invoice as paid if fully paid
-        paid += amount
-        if paid >= total_invoice:
-            invoice.status = CustomerInvoice.CONFIRMED  # already confirmed; you might set a separate PAID flag if you have it
-            # if you have invoice.PAID constant, set invoice.status = invoice.PAID
-            invoice.save(update_fields=['status'])
+        request.idempotency_object = payment
         messages.success(request, f"Payment of {amount} recorded (JE #{je.id}).")
         return redirect('customer_invoice_detail', pk=invoice.pk)
 
@@ -1912,6 +2147,8 @@ def sales_order_list(request):
     orders = SalesOrder.objects.order_by('-date', '-pk')[:200]
     return render(request, 'sales/order_list.html', {'orders': orders})
 
+@idempotent
+@transaction.atomic
 def sales_order_create(request):
     products = Product.objects.order_by('name')
     contacts = Contact.objects.filter(contact_type__in=['customer','both']).order_by('name')
@@ -1922,32 +2159,34 @@ def sales_order_create(request):
         reference = (request.POST.get('reference') or '').strip() or None
         parsed_date = parse_date_safe(so_date_raw) or timezone.now().date()
 
+        try:
+            rows = posted_document_lines(request)
+        except ValueError as e:
+            messages.error(request, str(e))
+            return redirect('sales_order_create')
+
         so = SalesOrder.objects.create(
             customer_id=int(customer_id),
             date=parsed_date,
             reference=reference
         )
 
-        for i in range(1, 6):
-            pid = request.POST.get(f'product_{i}')
-            if not pid: continue
-            try:
-                product_obj = Product.objects.get(pk=int(pid))
-            except Product.DoesNotExist:
-                continue
-            qty = Decimal(request.POST.get(f'qty_{i}') or '0')
-            unit_price = Decimal(request.POST.get(f'unit_price_{i}') or '0')
-            tax_percent = Decimal(request.POST.get(f'tax_percent_{i}') or '0')
-
-            SalesOrderLine.objects.create(
+        # lines: JSON `lines` array or product_N / qty_N / ... fields, any number of them;
+        # unknown products are skipped, the rest go in with one bulk insert
+        products_by_id = Product.objects.in_bulk({r['product_id'] for r in rows})
+        SalesOrderLine.objects.bulk_create([
+            SalesOrderLine(
                 order=so,
-                product=product_obj,
-                qty=qty,
-                unit_price=unit_price,
-                tax_percent=tax_percent
+                product=products_by_id[r['product_id']],
+                qty=r['qty'],
+                unit_price=r['unit_price'],
+                tax_percent=r['tax_percent']
             )
+            for r in rows if r['product_id'] in products_by_id
+        ])
 
         # so.recompute_totals()
+        request.idempotency_object = so
         messages.success(request, f"Sales Order {so.id} created.")
         return redirect('sales_order_detail', pk=so.pk)
 
@@ -2073,29 +2312,16 @@ def customer_portal_invoices(request):
     # Query invoices for this contact
     qs = CustomerInvoice.objects.filter(customer=contact).order_by('-issue_date', '-id')
 
-    # Build a small list with precomputed paid & amount_due to avoid template DB hits
-    invoice_rows = []
-    for inv in qs:
-        # total invoice amount from lines (best-effort)
-        total_amount = Decimal('0.00')
-        for L in getattr(inv, 'lines').all():
-            # prefer line.line_total if present, else compute
-            try:
-                lt = Decimal(getattr(L, 'line_total', 0) or 0)
-            except Exception:
-                lt = Decimal('0.00')
-            total_amount += lt
-
-        # total paid from Payment objects (if you keep reverse FK 'payments')
-        paid = inv.payments.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-        amount_due = total_amount - Decimal(paid)
-
-        invoice_rows.append({
+    # totals are stored on the invoice row, so this is one query for the whole list
+    invoice_rows = [
+        {
             'invoice': inv,
-            'total_amount': total_amount,
-            'paid': paid,
-            'amount_due': amount_due,
-        })
+            'total_amount': inv.grand_total,
+            'paid': inv.amount_paid,
+            'amount_due': inv.amount_due,
+        }
+        for inv in qs
+    ]
 
     ctx = {
         'contact': contact,
@@ -2119,9 +2345,7 @@ def customer_portal_invoice_detail(request, pk):
     if invoice.customer_id != contact.id:
         return HttpResponseForbidden("You can only view your own invoices.")
 
-    # compute amount due: invoice.total - payments
-    paid_sum = invoice.payments.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-    amount_due = (invoice.total_amount or Decimal('0.00')) - paid_sum
+    amount_due = invoice.open_amount()
 
     return render(request, 'core/portal_invoice_detail.html', {
         'contact': contact,
@@ -2146,10 +2370,7 @@ def portal_invoice_pay(request, pk):
     if invoice.customer_id != contact.id:
         return HttpResponseForbidden("You can only pay your own invoices.")
 
-    # calculate amount due
-    paid_sum = invoice.payments.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-    total_amount = invoice.total_amount or Decimal('0.00')
-    amount_due = total_amount - paid_sum
+    amount_due = invoice.open_amount()
     if amount_due <= 0:
         messages.info(request, "Invoice is already fully paid.")
         return redirect(reverse('core:customer_portal_invoice_detail', args=[invoice.pk]))
@@ -2167,8 +2388,8 @@ def portal_invoice_pay(request, pk):
             except Account.DoesNotExist:
                 account = None
         else:
-            # fallback: pick first Asset account
-            account = Account.objects.filter(account_type__iexact='asset').first()
+            # fallback: the cash account (first asset account when none is named Cash)
+            account = resolve_posting_accounts()['cash']
 
         # amount to pay (we'll trust the server-side amount_due)
         to_pay = amount_due
@@ -2190,10 +2411,7 @@ def portal_invoice_pay(request, pk):
         #   Debit: Bank/Cash (asset) = amount_received (increase asset)
         #   Credit: Debtors (asset) = amount_received (decrease debtor) — but accounting convention: Debtors is asset; clearing a debtor reduces asset (credit)
         # We'll find Debtors account then build lines.
-        try:
-            debtors_acc = Account.objects.get(name__iexact='Debtors A/c')
-        except Account.DoesNotExist:
-            debtors_acc = Account.objects.filter(account_type__iexact='asset').first()
+        debtors_acc = resolve_posting_accounts()['debtors']
 
         lines = [
             {'account': account, 'debit': Decimal(to_pay), 'credit': Decimal('0.00'),
@@ -2212,8 +2430,7 @@ def portal_invoice_pay(request, pk):
         # if different adapt accordingly.
 
         # After payment, recompute invoice paid status / amount due
-        paid_sum2 = invoice.payments.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-        if paid_sum2 >= total_amount:
+        if invoice.open_amount() <= 0:
             invoice.status = 'paid'  # adapt to your status field values
             invoice.save(update_fields=['status'])
 
@@ -2263,10 +2480,10 @@ def customer_portal_pay(request, invoice_id):
     if invoice.customer_id != contact.pk:
         return HttpResponseForbidden("You may only pay your own invoices.")
 
-    # compute totals
-    total_amount = invoice.lines.aggregate(total=Sum('line_total'))['total'] or Decimal('0.00')
-    paid = invoice.payments.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-    amount_due = (Decimal(total_amount) - Decimal(paid)).quantize(Decimal('0.01'))
+    total_amount = invoice.grand_total
+    paid = invoice.amount_paid
+    # the open item's residual: what CustomerPayment.post() will actually let through
+    amount_due = invoice.open_amount()
 
     if request.method == 'POST':
         # parse/validate amount
@@ -2289,7 +2506,7 @@ def customer_portal_pay(request, invoice_id):
                 messages.error(request, "Selected account not found.")
                 return redirect('customer_portal_pay', invoice_id=invoice.pk)
         else:
-            account = Account.objects.filter(account_type__iexact='asset').first()
+            account = resolve_posting_accounts()['cash']
             if not account:
                 messages.error(request, "No asset (bank/cash) account configured. Contact admin.")
                 return redirect('customer_portal_pay', invoice_id=invoice.pk)
@@ -2321,8 +2538,8 @@ def customer_portal_pay(request, invoice_id):
 
 
         # refresh paid/outstanding after post
-        paid = invoice.payments.aggregate(total=Sum('amount'))['total'] or Decimal('0.00')
-        amount_due = (Decimal(total_amount) - Decimal(paid)).quantize(Decimal('0.01'))
+        invoice.refresh_from_db(fields=['amount_paid', 'amount_due'])
+        paid, amount_due = invoice.amount_paid, invoice.amount_due
 
         # if fully paid, mark invoice paid (use constant if present)
         try:
@@ -2365,31 +2582,10 @@ client = razorpay.Client(auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_S
 
 def compute_invoice_amounts(invoice):
     """
-    Return (total_amount, paid_amount, amount_due) as Decimal
-    Adjust this function if your invoice model stores totals differently.
+    Return (total_amount, paid_amount, amount_due) as Decimal, read from the
+    totals stored on the invoice.
     """
-    # Try to get invoice total from invoice.total or sum lines
-    total = getattr(invoice, "total", None)
-    if total is None:
-        # fallback: sum invoice.lines.line_total if available
-        total = Decimal('0.00')
-        for L in getattr(invoice, "lines", []).all():
-            total += Decimal(getattr(L, "line_total", 0) or 0)
-    else:
-        total = Decimal(total or 0)
-
-    # Sum payments already recorded against this invoice if your model stores them
-    paid = Decimal('0.00')
-    # adapt if invoice has .payments relationship
-    if hasattr(invoice, "payments"):
-        agg = invoice.payments.aggregate(total=Sum('amount'))
-        paid = agg.get('total') or Decimal('0.00')
-    else:
-        # maybe journal entries or payment model: adapt as needed
-        paid = Decimal('0.00')
-
-    amount_due = (total - Decimal(paid)).quantize(Decimal('0.01'))
-    return total, Decimal(paid), amount_due
+    return invoice.grand_total, invoice.amount_paid, invoice.amount_due
 
 
 # ---- Create Razorpay order and render checkout page ----
@@ -2495,13 +2691,11 @@ def portal_invoice_razorpay_verify(request, invoice_id):
     if payment_obj and payment_obj.get('amount'):
         paid_amt = (Decimal(payment_obj['amount']) / Decimal(100)).quantize(Decimal('0.01'))
     else:
-        # fallback: compute current amount_due
-        total = invoice.lines.aggregate(t=Sum('line_total'))['t'] or Decimal('0.00')
-        paid = invoice.payments.aggregate(t=Sum('amount'))['t'] or Decimal('0.00')
-        paid_amt = (Decimal(total) - Decimal(paid)).quantize(Decimal('0.01'))
+        # fallback: what is still open on the invoice
+        paid_amt = invoice.open_amount()
 
     # choose deposit account
-    account = Account.objects.filter(account_type__iexact='asset').first()
+    account = resolve_posting_accounts()['cash']
     if not account:
         logger.error("No asset account found to post payment into.")
         return JsonResponse({'status': 'error', 'message': 'No asset account configured'}, status=500)
@@ -2541,9 +2735,7 @@ def portal_invoice_razorpay_verify(request, invoice_id):
         return JsonResponse({'status': 'ok', 'message': 'recorded_but_post_failed'}, status=200)
 
     # optionally: mark invoice paid if fully paid
-    total = invoice.lines.aggregate(t=Sum('line_total'))['t'] or Decimal('0.00')
-    paid_total = invoice.payments.aggregate(t=Sum('amount'))['t'] or Decimal('0.00')
-    if (Decimal(total) - Decimal(paid_total)) <= Decimal('0.001'):
+    if invoice.open_amount() <= Decimal('0.001'):
         try:
             if hasattr(CustomerInvoice, 'PAID'):
                 invoice.status = getattr(CustomerInvoice, 'PAID')
@@ -2592,7 +2784,7 @@ def razorpay_webhook(request):
             except Exception:
                 invoice = None
 
-        account = Account.objects.filter(account_type__iexact="asset").first()
+        account = resolve_posting_accounts()['cash']
         create_kwargs = {
             "date": timezone.now().date(),
             "amount": amount,
@@ -2629,10 +2821,7 @@ def portal_invoice_pay_create_order(request, invoice_id):
     if invoice.customer_id != contact_id:
         return HttpResponseForbidden("You may only pay your own invoices.")
 
-    # compute outstanding
-    total = invoice.lines.aggregate(t=Sum('line_total'))['t'] or Decimal('0.00')
-    paid = invoice.payments.aggregate(t=Sum('amount'))['t'] or Decimal('0.00')
-    amount_due = (total - paid).quantize(Decimal('0.01'))
+    amount_due = invoice.open_amount()
     if amount_due <= 0:
         messages.info(request, "Invoice already paid.")
         return redirect('customer_portal_invoices')
@@ -29,6 +29,7 @@ DEBUG = True
 ALLOWED_HOSTS = []
 
 import os
+import tempfile
 # Application definition
 
 INSTALLED_APPS = [
@@ -93,6 +94,54 @@ DATABASES = {
 }
 
 
+# Cache
+# Reports are cached in the 'reports' alias keyed by ledger version (see core.utils.cached_report).
+# Point REPORT_CACHE_BACKEND / REPORT_CACHE_LOCATION at redis or memcached to share it across workers.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'reports': {
+        'BACKEND': os.environ.get('REPORT_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('REPORT_CACHE_LOCATION', 'reports'),
+        'TIMEOUT': 24 * 3600,
+    },
+}
+REPORT_CACHE_ALIAS = 'reports'
+
+# File based caches go under CACHE_DIR, outside the source tree; every worker on a host must share it.
+CACHE_DIR = Path(os.environ.get('CACHE_DIR') or Path(tempfile.gettempdir()) / 'shivproj-cache')
+
+# Generation token of the in-process master data copies (core.utils). Every worker must see the same
+# cache for an Account/Tax change to reach all of them; copies are reloaded after MASTER_DATA_TTL anyway.
+CACHES['masterdata'] = {
+    'BACKEND': os.environ.get('MASTER_DATA_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+    'LOCATION': os.environ.get('MASTER_DATA_CACHE_LOCATION', str(CACHE_DIR / 'masterdata')),
+}
+MASTER_DATA_CACHE_ALIAS = 'masterdata'
+MASTER_DATA_TTL = 300
+
+
+# External HSN / tax APIs (core.gst_client)
+# Answers are cached in the 'gst_api' alias, file based by default so every worker shares them and
+# they survive restarts. Run `manage.py run_gst_stub` and point the two URLs at it to work offline.
+
+GST_HSN_SEARCH_URL = os.environ.get('GST_HSN_SEARCH_URL', 'https://services.gst.gov.in/commonservices/hsn/search/qsearch')
+TAX_API_BASE = os.environ.get('TAX_API_BASE') or None
+CACHES['gst_api'] = {
+    'BACKEND': os.environ.get('GST_API_CACHE_BACKEND', 'django.core.cache.backends.filebased.FileBasedCache'),
+    'LOCATION': os.environ.get('GST_API_CACHE_LOCATION', str(CACHE_DIR / 'gst_api')),
+}
+GST_API_CACHE_ALIAS = 'gst_api'
+GST_API_CACHE_TTL = 24 * 3600
+GST_API_NEGATIVE_TTL = 600
+GST_API_CONNECT_TIMEOUT = 3.05
+GST_API_READ_TIMEOUT = 8
+GST_API_FAILURE_THRESHOLD = 5
+GST_API_COOLDOWN = 30
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
 